@@ -1,11 +1,14 @@
 # Chang Xu. 07MAR2016
 import pysam
 
+# our modules
+import core.panel
+
 #----------------------------------------------------------------------------------------------
 # Reconstruct complex variants from primitives
 #----------------------------------------------------------------------------------------------
 def recon(cluster, combined, genomeFile, vc):
-    refseq = pysam.FastaFile(genomeFile)
+    refseq = core.panel.getFastaFile(genomeFile)
     lastR = -1
     refStr = ''
     refAlt = ''
@@ -66,7 +69,7 @@ def verifyCluster(bam, cluster, genomeFile, vc):
         raise Exception("Need at least two variants")
 
     # open input data files
-    refseq = pysam.FastaFile(genomeFile)
+    refseq = core.panel.getFastaFile(genomeFile)
     samfile = pysam.AlignmentFile(bam, 'rb')
 
     # check if the adjacent two variants are on the same reads
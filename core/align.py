@@ -1,6 +1,21 @@
 import subprocess
 import os
 import os.path
+import Queue
+import threading
+
+# our modules
+import cpu_tokens
+import prep
+import scratch
+import umi_filter
+
+# FASTQ lines per chunk passed from the named pipe readers to bwa
+FASTQ_CHUNK_LINES = 4 * 10000
+
+# chunks buffered per mate - covers the trimmer writing up to 500k reads of one mate ahead of the other (about
+# 250 MB per mate), beyond that the reader blocks, so the trimmer waits for bwa
+FASTQ_QUEUE_CHUNKS = 50
 
 #-------------------------------------------------------------------------
 # align reads to refernce genome using BWA MEM
@@ -15,30 +30,243 @@ def run(cfg, readFile1, readFile2, bamFileOut):
     bwaDir           = cfg.bwaDir
     samtoolsDir      = cfg.samtoolsDir
     deleteLocalFiles = cfg.deleteLocalFiles
-    numCores         = cfg.numCores
     
     # make file names for local BWA and samtools log files
     logFileBase     = os.path.basename(bamFileOut)
     logFileBwa      = logFileBase.replace(".bam",".bwa.log")
     logFileSamtools = logFileBase.replace(".bam",".samtools.log")
  
-    # align reads to reference genome using BWA-MEM, and convert to BAM format
-    cmd = bwaDir + "bwa mem -C -t " +  numCores \
-    + " " + genomeFile   \
-    + " " + readFile1    \
-    + " " + readFile2    \
-    + " 2>" + logFileBwa \
-    + " | " + samtoolsDir + "samtools view -1 -@ " + numCores \
-    + " - " \
-    + " 1> " + bamFileOut \
-    + " 2> " + logFileSamtools
-    subprocess.check_call(cmd, shell=True)
+    # align reads to reference genome using BWA-MEM, and convert to BAM format, with the cores free now
+    with cpu_tokens.Cores(cfg) as numCores:
+        cmd = bwaDir + "bwa mem -C -t " +  str(numCores) \
+        + " " + genomeFile   \
+        + " " + readFile1    \
+        + " " + readFile2    \
+        + " 2>" + logFileBwa \
+        + " | " + samtoolsDir + "samtools view -1 -@ " + str(numCores) \
+        + " - " \
+        + " 1> " + bamFileOut \
+        + " 2> " + logFileSamtools
+        subprocess.check_call(cmd, shell=True)
  
     # delete local fastq files if not needed anymore, to conserve local disk space
-    if deleteLocalFiles:
+    deleteReadFiles(cfg, readFile1, readFile2)
+       
+    # report completion
+    print("align: done aligning reads to genome, bam file: " + bamFileOut)
+
+#-------------------------------------------------------------------------
+# delete local fastq files if not needed anymore, to conserve local disk space
+#-------------------------------------------------------------------------
+def deleteReadFiles(cfg, readFile1, readFile2):
+    if cfg.deleteLocalFiles:
         for readFile in (readFile1, readFile2):
             if len(os.path.dirname(readFile)) == 0:
                 os.remove(readFile)
-       
+
+#-------------------------------------------------------------------------
+# run umi_filter on the live bwa output, then check the aligner exit status
+#-------------------------------------------------------------------------
+def filterAlignments(cfg, bwa, bamFileOut, checkAligner):
+    ''' Filter the SAM stream from bwa with umi_filter
+    :param Popen bwa: aligner process, with stdout a pipe
+    :param str bamFileOut: output BAM of the read pairs kept by umi_filter
+    :param function checkAligner: waits for the aligner and raises if it failed
+    '''
+    # a truncated stream can look like a low on-target read set, so report aligner errors first
+    warning = None
+    try:
+        umi_filter.run(cfg, bwa.stdout, bamFileOut)
+    except UserWarning, ex:
+        warning = ex
+    bwa.stdout.close()
+    checkAligner()
+    if warning is not None:
+        raise warning
+
+#-------------------------------------------------------------------------
+# align reads with BWA MEM, filtering the alignments as they are made
+#-------------------------------------------------------------------------
+def runUmiFilter(cfg, readFile1, readFile2, bamFileOut):
+    ''' Align reads and run umi_filter on the SAM stream, without writing the full alignment BAM
+    :param str bamFileOut: output BAM of the read pairs kept by umi_filter
+    '''
+    print("align: starting read alignment, with umi_filter on the aligner output")
+    logFileBwa = cfg.readSet + ".align.bwa.log"
+    with cpu_tokens.Cores(cfg) as numCores:
+        cmd = cfg.bwaDir + "bwa mem -C -t " +  str(numCores) \
+        + " " + cfg.genomeFile \
+        + " " + readFile1    \
+        + " " + readFile2    \
+        + " 2>" + logFileBwa
+        bwa = subprocess.Popen(cmd, stdout = subprocess.PIPE, shell = True)
+        def checkAligner():
+            if bwa.wait():
+                raise Exception("align: bwa mem failed, see " + logFileBwa)
+        filterAlignments(cfg, bwa, bamFileOut, checkAligner)
+    deleteReadFiles(cfg, readFile1, readFile2)
+    print("align: done aligning and filtering reads, bam file: " + bamFileOut)
+
+#-------------------------------------------------------------------------
+# read a FASTQ named pipe in chunks of whole records - runs in a thread
+#-------------------------------------------------------------------------
+def readFastq(fileName, chunks, status):
+    IN = open(fileName, "r")
+    while True:
+        chunk = []
+        for line in IN:
+            chunk.append(line)
+            if len(chunk) == FASTQ_CHUNK_LINES:
+                break
+        if len(chunk) == 0:
+            break
+        putChunk(chunks, chunk, status)
+    IN.close()
+    putChunk(chunks, None, status)
+
+#-------------------------------------------------------------------------
+# queue a FASTQ chunk, waiting while the queue is full - after a bwa feeder error the chunk is dropped
+# instead, so the reader runs on to the end of the pipe and the trimmer is not left blocked on it
+#-------------------------------------------------------------------------
+def putChunk(chunks, chunk, status):
+    while "error" not in status:
+        try:
+            chunks.put(chunk, timeout = 5)
+            return
+        except Queue.Full:
+            pass
+
+#-------------------------------------------------------------------------
+# get next FASTQ chunk, failing if the trimmer died or got too far ahead on the other mate
+#-------------------------------------------------------------------------
+def getChunk(chunks, chunksOther, trimmer):
+    numStalled = 0
+    while True:
+        try:
+            return chunks.get(timeout = 5)
+        except Queue.Empty:
+            # a trimmer that fails before opening the pipes leaves the readers blocked in open()
+            if trimmer.poll():
+                raise Exception("Trimming of Fastqs failed !")
+            # the other mate's queue stays full while this one is empty - the trimmer is blocked writing the other mate
+            numStalled = numStalled + 1 if chunksOther.full() else 0
+            if numStalled == 12:
+                raise Exception("align: trimmer wrote more than {} reads of one mate ahead of the other, increase FASTQ_QUEUE_CHUNKS".format(FASTQ_QUEUE_CHUNKS * FASTQ_CHUNK_LINES / 4))
+
+#-------------------------------------------------------------------------
+# feed interleaved read pairs to bwa - runs in a thread when umi_filter reads the bwa output
+#-------------------------------------------------------------------------
+def feedBwa(queues, trimmer, bwaIn, status):
+    try:
+        # bwa -p takes R1,R2,R1,R2,... - both trimmer outputs hold the same pairs in the same order
+        numReads = 0
+        while True:
+            chunk1 = getChunk(queues[0], queues[1], trimmer)
+            chunk2 = getChunk(queues[1], queues[0], trimmer)
+            if chunk1 is None or chunk2 is None:
+                if chunk1 is not chunk2:
+                    raise Exception("align: R1 and R2 trimmer outputs have different read counts")
+                break
+            if len(chunk1) != len(chunk2):
+                raise Exception("align: R1 and R2 trimmer outputs have different read counts")
+            for i in range(0, len(chunk1), 4):
+                bwaIn.write("".join(chunk1[i:i+4]))
+                bwaIn.write("".join(chunk2[i:i+4]))
+            numReads += len(chunk1) / 4
+        status["numReads"] = numReads
+    except Exception, ex:
+        status["error"] = ex
+    finally:
+        # end of input lets bwa finish, also after an error
+        bwaIn.close()
+
+#-------------------------------------------------------------------------
+# trim and align in one pass, without writing the trimmed reads to disk
+#-------------------------------------------------------------------------
+def runStreaming(cfg, bamFileOut, umiFilter = False):
+    ''' Run the read trimmer and BWA MEM concurrently - the trimmer writes R1 and R2 to named pipes,
+    the pairs are interleaved in memory and fed to bwa mem -p, so trimming and alignment overlap
+    :param lambda obj cfg: run config
+    :param str bamFileOut: output BAM - all alignments, or the read pairs kept by umi_filter
+    :param bool umiFilter: run umi_filter on the bwa output instead of writing all alignments
+    '''
+    print("align: starting streaming read prep and alignment")
+    readSet     = cfg.readSet
+    genomeFile  = cfg.genomeFile
+    bwaDir      = cfg.bwaDir
+    samtoolsDir = cfg.samtoolsDir
+
+    # debug check
+    if cfg.readFile1 == cfg.readFile2:
+        raise UserWarning("R1 and R2 have the same filename. Please fix the file paths for the input files.")
+
+    # named pipes for the trimmer output, in the scratch dir
+    fifos = (scratch.getFile(cfg, readSet + ".prep.R1.fastq"), scratch.getFile(cfg, readSet + ".prep.R2.fastq"))
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+    logFileBwa      = readSet + ".align.bwa.log"
+    logFileSamtools = readSet + ".align.samtools.log"
+    logFileTrimmer  = scratch.getFile(cfg, readSet + ".prep.log")
+
+    with cpu_tokens.Cores(cfg) as numCores:
+        # the trimmer is much faster than bwa - give it a quarter of the cores
+        numCoresTrimmer = max(1, numCores / 4)
+        numCoresBwa     = max(1, numCores - numCoresTrimmer)
+
+        # start the trimmer, writing into the named pipes
+        logTrimmer = open(logFileTrimmer, "w")
+        trimmer = subprocess.Popen(prep.getReadTrimmerCmd(cfg, fifos[0], fifos[1], numCoresTrimmer),
+            stdout = logTrimmer, stderr = subprocess.STDOUT, shell = True)
+        logTrimmer.close()
+
+        # read both pipes into bounded memory queues - the trimmer need not write R1 and R2 in lockstep with
+        # bwa's reads, which could otherwise deadlock on a full pipe, and a slow bwa still holds the trimmer back
+        queues = (Queue.Queue(FASTQ_QUEUE_CHUNKS), Queue.Queue(FASTQ_QUEUE_CHUNKS))
+        status = {}
+        for (fifo, chunks) in zip(fifos, queues):
+            reader = threading.Thread(target = readFastq, args = (fifo, chunks, status))
+            reader.daemon = True
+            reader.start()
+
+        # align interleaved read pairs, and convert to BAM format or pass the SAM to umi_filter
+        cmd = bwaDir + "bwa mem -p -C -t " + str(numCoresBwa) \
+        + " " + genomeFile   \
+        + " -"               \
+        + " 2>" + logFileBwa
+        if not umiFilter:
+            cmd += " | " + samtoolsDir + "samtools view -1 -@ " + str(numCoresBwa) \
+            + " - " \
+            + " 1> " + bamFileOut \
+            + " 2> " + logFileSamtools
+        bwa = subprocess.Popen(cmd, stdin = subprocess.PIPE, stdout = subprocess.PIPE if umiFilter else None, shell = True)
+        feeder = threading.Thread(target = feedBwa, args = (queues, trimmer, bwa.stdin, status))
+        feeder.daemon = True
+        feeder.start()
+
+        def checkAligner():
+            feeder.join()
+            retcodeBwa = bwa.wait()
+            retcodeTrimmer = trimmer.wait()
+            # redirect trimmer stdout and stderr to main logfile so upstream error trapping modules can find UserWarning exception
+            print(open(logFileTrimmer, "r").read())
+            for fileName in fifos + (logFileTrimmer,):
+                os.remove(fileName)
+            if retcodeTrimmer:
+                raise Exception("Trimming of Fastqs failed !")
+            if "error" in status:
+                raise status["error"]
+            if retcodeBwa:
+                raise Exception("align: bwa mem or samtools view failed, see " + logFileBwa)
+            prep.writeSummary(cfg)
+            print("align: {} read pairs aligned".format(status["numReads"]))
+
+        if umiFilter:
+            filterAlignments(cfg, bwa, bamFileOut, checkAligner)
+        else:
+            checkAligner()
+
     # report completion
-    print("align: done aligning reads to genome, bam file: " + bamFileOut)
+    print("align: done streaming read prep and alignment, bam file: " + bamFileOut)
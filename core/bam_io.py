@@ -0,0 +1,137 @@
+import os
+import signal
+import subprocess
+
+# 3rd party modules
+import pysam
+
+# our modules
+import cpu_tokens
+
+# BGZF compression level for intermediate BAM files, read once by a later stage
+LEVEL_TEMP = 1
+
+# most cores used for BGZF (de)compression of one BAM file - more rarely helps
+THREADS_MAX = 4
+
+#----------------------------------------------------------------------
+# a pysam AlignmentFile, with BGZF (de)compression done by a samtools process using cores from the pool
+#----------------------------------------------------------------------
+class BamFile(object):
+    def __init__(self, bam, proc, numCores, fileName):
+        self.bam = bam
+        self.proc = proc
+        self.numCores = numCores
+        self.fileName = fileName
+
+    def __getattr__(self, name):
+        return getattr(self.bam, name)
+
+    def __iter__(self):
+        return iter(self.bam)
+
+    def next(self):
+        return self.bam.next()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self.bam is None:
+            return
+        self.bam.close()
+        self.bam = None
+        try:
+            if self.proc is not None:
+                # a reader closed before the end of the file stops samtools with SIGPIPE
+                returnCode = self.proc.wait()
+                if returnCode != 0 and returnCode != -signal.SIGPIPE:
+                    raise Exception("bam_io: command failed for {}, exit code {}".format(self.fileName, returnCode))
+        finally:
+            cpu_tokens.release(self.numCores)
+            self.numCores = 0
+
+#----------------------------------------------------------------------
+# samtools child processes get the default SIGPIPE action (python ignores it)
+#----------------------------------------------------------------------
+def resetSigpipe():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+#----------------------------------------------------------------------
+# open a BAM file with multithreaded BGZF compression or decompression
+#----------------------------------------------------------------------
+def openBam(cfg, fileName, mode, level = None, threads = None, **kwargs):
+    ''' Open a BAM file for pysam - when cores are free (or for a compression level) the BGZF blocks are
+    decompressed or compressed by "samtools view -@", and pysam reads or writes uncompressed BAM through a pipe
+    :param lambda obj cfg: run config, for cfg.samtoolsDir and cfg.numCores
+    :param str fileName: BAM file
+    :param str mode: "rb", "wb", or "wbu" (uncompressed, pysam only)
+    :param int level: BGZF compression level of an output file (e.g. LEVEL_TEMP), None for the default
+    :param int threads: extra cores wanted, default up to THREADS_MAX - taken from the core pool if free (the
+                        calling stage's own core runs pysam), and held until close()
+    :param kwargs: other pysam.AlignmentFile arguments, e.g. template (a BamFile or pysam file) or check_sq
+    :returns BamFile - use like a pysam AlignmentFile
+    '''
+    if mode not in ("rb", "wb", "wbu"):
+        raise Exception("bam_io: unsupported mode " + mode)
+    template = kwargs.get("template")
+    if isinstance(template, BamFile):
+        kwargs["template"] = template.bam
+
+    # never wait for cores - a stage holding the last core of the pool would wait for itself
+    want = min(THREADS_MAX, int(cfg.numCores)) if threads is None else threads
+    numCores = cpu_tokens.acquire(want, 0) if mode != "wbu" else 0
+
+    # no free cores and the default compression - pysam only
+    if numCores == 0 and (mode != "wb" or level is None):
+        return BamFile(pysam.AlignmentFile(fileName, mode, **kwargs), None, 0, fileName)
+
+    # samtools (de)compresses, pysam reads or writes uncompressed BAM on the other end of a pipe
+    samtools = os.path.join(cfg.samtoolsDir, "samtools")
+    if mode == "rb":
+        cmd = [samtools, "view", "-u", "-@", str(numCores), fileName]
+    else:
+        cmd = [samtools, "view", "-b", "-@", str(numCores), "-o", fileName, "-"]
+        if level is not None:
+            cmd[3:3] = ["-l", str(level)]
+    return openCommand(cmd, fileName, mode[0], numCores, **kwargs)
+
+#----------------------------------------------------------------------
+# open a pipe from or to a command reading or writing uncompressed BAM
+#----------------------------------------------------------------------
+def openCommand(cmd, fileName, mode, numCores = 0, stderr = None, **kwargs):
+    ''' Start a command, and open its stdout ("r") or stdin ("w") for pysam - e.g. "samtools sort ... -"
+    :param list cmd: command and arguments
+    :param str fileName: file read or written by the command, for error messages
+    :param str mode: "r" or "w"
+    :param int numCores: cores taken from the pool for the command, released at close()
+    :param file stderr: file for the command stderr, None to inherit
+    :param kwargs: other pysam.AlignmentFile arguments, e.g. template
+    :returns BamFile - close() waits for the command to finish
+    '''
+    template = kwargs.get("template")
+    if isinstance(template, BamFile):
+        kwargs["template"] = template.bam
+    try:
+        if mode == "r":
+            proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = stderr, preexec_fn = resetSigpipe, close_fds = True)
+            pipe = proc.stdout
+            modePipe = "rb"
+        else:
+            proc = subprocess.Popen(cmd, stdin = subprocess.PIPE, stderr = stderr, preexec_fn = resetSigpipe, close_fds = True)
+            pipe = proc.stdin
+            modePipe = "wbu"
+
+        # pysam opens its own descriptor for the pipe, so closing the AlignmentFile ends the stream
+        try:
+            bam = pysam.AlignmentFile("/dev/fd/{}".format(pipe.fileno()), modePipe, **kwargs)
+        finally:
+            pipe.close()
+    except:
+        cpu_tokens.release(numCores)
+        raise
+    return BamFile(bam, proc, numCores, fileName)
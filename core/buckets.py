@@ -0,0 +1,123 @@
+import os
+import os.path
+import shutil
+import subprocess
+
+# genomic bin size of a bucket - buckets are sorted in memory by the stages that read them
+BIN_SIZE = 100000
+
+# bytes buffered for one bucket, and for all buckets, before appending to the bucket files
+FLUSH_BYTES_BUCKET = 1 << 20
+FLUSH_BYTES_TOTAL  = 1 << 28
+
+# buckets larger than this (e.g. a primer-dimer hotspot) are sorted with GNU sort instead of in memory
+SORT_BYTES_MAX = 1 << 30
+
+#----------------------------------------------------------------------
+# write lines into per chrom/strand/genomic bin bucket files
+#----------------------------------------------------------------------
+class Writer(object):
+    def __init__(self, dirName):
+        ''' Start an empty bucket directory, removing buckets left by a previous run
+        :param str dirName: bucket directory, e.g. <readSet>.umi_filter.buckets
+        '''
+        if os.path.isdir(dirName):
+            shutil.rmtree(dirName)
+        os.makedirs(dirName)
+        self.dirName = dirName
+        self.buckets = {}
+        self.bytesBuffered = 0
+
+    def write(self, chrom, strand, loc, line):
+        ''' Buffer a line for the bucket of a genome position
+        :param str chrom
+        :param int strand
+        :param int loc: sort position - the bucket records its min and max
+        :param str line: text line, including newline
+        '''
+        key = (chrom, strand, loc // BIN_SIZE)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            # file name, bytes, min loc, max loc, buffered lines, buffered bytes
+            bucket = [str(len(self.buckets)) + ".txt", 0, loc, loc, [], 0]
+            self.buckets[key] = bucket
+        bucket[2] = min(bucket[2], loc)
+        bucket[3] = max(bucket[3], loc)
+        bucket[4].append(line)
+        bucket[5] += len(line)
+        self.bytesBuffered += len(line)
+        if bucket[5] >= FLUSH_BYTES_BUCKET:
+            self.flush(bucket)
+        if self.bytesBuffered >= FLUSH_BYTES_TOTAL:
+            for bucket in self.buckets.itervalues():
+                self.flush(bucket)
+
+    def flush(self, bucket):
+        if bucket[5] == 0:
+            return
+        fileout = open(os.path.join(self.dirName, bucket[0]), "a")
+        fileout.writelines(bucket[4])
+        fileout.close()
+        bucket[1] += bucket[5]
+        self.bytesBuffered -= bucket[5]
+        del(bucket[4][:])
+        bucket[5] = 0
+
+    def close(self):
+        ''' Flush all buckets, and write the bucket index - index.txt
+        '''
+        fileout = open(os.path.join(self.dirName, "index.txt"), "w")
+        for (key, bucket) in sorted(self.buckets.iteritems()):
+            self.flush(bucket)
+            outvec = key + tuple(bucket[:4])
+            fileout.write("|".join((str(x) for x in outvec)))
+            fileout.write("\n")
+        fileout.close()
+
+#----------------------------------------------------------------------
+# read the bucket index
+#----------------------------------------------------------------------
+def readIndex(dirName):
+    ''' Get the buckets of a bucket directory
+    :param str dirName: bucket directory
+    :returns list of (chrom, strand, bin, file name, bytes, min loc, max loc), in (chrom, strand, bin) order
+    '''
+    buckets = []
+    for line in open(os.path.join(dirName, "index.txt"), "r"):
+        (chrom, strand, binNum, fileName, numBytes, locMin, locMax) = line.strip().split("|")
+        buckets.append((chrom, int(strand), int(binNum), os.path.join(dirName, fileName), int(numBytes), int(locMin), int(locMax)))
+    return buckets
+
+#----------------------------------------------------------------------
+# read all lines of all buckets, in no particular order
+#----------------------------------------------------------------------
+def readLines(dirName):
+    for bucket in readIndex(dirName):
+        for line in open(bucket[3], "r"):
+            yield line
+
+#----------------------------------------------------------------------
+# read the lines of one bucket, sorted
+#----------------------------------------------------------------------
+def readSorted(bucket, getKey, sortCmd, tempDir):
+    ''' Sort a bucket in memory, or with GNU sort if it is too large for that
+    :param tuple bucket: bucket from readIndex()
+    :param function getKey: sort key of a line - ties are broken by the whole line, as in GNU sort
+    :param str sortCmd: GNU sort key options giving the same order, e.g. "-k9,9n -k2,2n -t\|"
+    :param str tempDir: directory for GNU sort spill files
+    :returns generator of the sorted lines
+    '''
+    fileName = bucket[3]
+    if bucket[4] <= SORT_BYTES_MAX:
+        lines = open(fileName, "r").readlines()
+        lines.sort(key = lambda line: (getKey(line), line))
+        for line in lines:
+            yield line
+        return
+    print("buckets: sorting large bucket {} ({} bytes) on disk".format(fileName, bucket[4]))
+    cmd = "LC_ALL=C sort {} --parallel=1 -T{} {}".format(sortCmd, tempDir, fileName)
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    for line in proc.stdout:
+        yield line
+    if proc.wait() != 0:
+        raise Exception("buckets: sort failed for " + fileName)
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+
+# shared count of free cores - made by the top-level process before it forks read set
+# workers and stage processes, so every process in the run draws from the same pool
+pool = None
+
+# cores held by this process - [process id, count], as a forked child inherits the parent's count
+held = [None, 0]
+
+#----------------------------------------------------------------------
+# number of cores held by this process
+#----------------------------------------------------------------------
+def getHeld():
+    return held[1] if held[0] == os.getpid() else 0
+
+def setHeld(num):
+    held[0] = os.getpid()
+    held[1] = max(0, num)
+
+#----------------------------------------------------------------------
+# create the core token pool
+#----------------------------------------------------------------------
+def init(numCores):
+    ''' Create the core token pool, if not made already by a parent process
+    :param int numCores: number of cores for the whole process tree
+    '''
+    global pool
+    if pool is None:
+        pool = (multiprocessing.Value("i", int(numCores), lock = False), multiprocessing.Condition(), int(numCores))
+        print("cpu_tokens: {} cores".format(numCores))
+
+#----------------------------------------------------------------------
+# take cores from the pool
+#----------------------------------------------------------------------
+def acquire(want, minimum = None):
+    ''' Take up to want cores, waiting until at least minimum are free
+    :param int want: cores wanted, e.g. cfg.numCores
+    :param int minimum: cores needed to start, default half of want (so a long-running tool
+                        does not start with one thread just because most cores were busy) - 0 to not wait.
+                        A process already holding cores never waits (it would wait on itself, e.g. a sort
+                        nested in the aligner's cores), and may get 0 cores
+    :returns int number of cores taken - all of want if there is no pool, 0 if want is 0
+    '''
+    want = max(0, int(want))
+    if want == 0 or pool is None:
+        return want
+    (free, condition, total) = pool
+    if minimum is None:
+        minimum = max(1, min(want / 2, want, total))
+    else:
+        minimum = max(0, min(minimum, want, total))
+    if getHeld() > 0:
+        minimum = 0
+    with condition:
+        while free.value < minimum:
+            condition.wait()
+        num = min(want, free.value)
+        free.value -= num
+    setHeld(getHeld() + num)
+    return num
+
+#----------------------------------------------------------------------
+# give cores back to the pool
+#----------------------------------------------------------------------
+def release(num):
+    if pool is None:
+        return
+    (free, condition, total) = pool
+    with condition:
+        free.value += num
+        condition.notify_all()
+    setHeld(getHeld() - num)
+
+#----------------------------------------------------------------------
+# cores held for the duration of a with block - "with Cores(cfg) as numCores:"
+#----------------------------------------------------------------------
+class Cores(object):
+    def __init__(self, cfg, want = None, minimum = None):
+        self.want = int(cfg.numCores) if want is None else want
+        self.minimum = minimum
+        self.num = 0
+
+    def __enter__(self):
+        self.num = acquire(self.want, self.minimum)
+        return self.num
+
+    def __exit__(self, excType, excValue, tb):
+        release(self.num)
+        self.num = 0
+        return False
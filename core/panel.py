@@ -0,0 +1,39 @@
+import os
+import pysam
+
+# per process caches - filled before forking batch workers, so read sets on the same panel share them
+primerTables = {}
+fastaFiles = {}
+
+#----------------------------------------------------------------------
+# read primer file - tab delimited chrom, 3' end loc, direction (L/R or 0/1), primer sequence
+#----------------------------------------------------------------------
+def readPrimerFile(primerFile):
+    ''' Read a primer file, parsing it only once per process (unless the file changes)
+    :param str primerFile: path to the panel primer file
+    :returns tuple of (chrom, loc3, strand, primer) in file order
+    '''
+    stat = os.stat(primerFile)
+    key = (os.path.abspath(primerFile), stat.st_size, stat.st_mtime)
+    if key not in primerTables:
+        primers = []
+        for line in open(primerFile, "r"):
+            (chrom, loc3, direction, primer) = line.strip().split("\t")
+            strand = 0 if direction == "L" or direction == "0" else 1
+            primers.append((chrom, int(loc3), strand, primer))
+        primerTables[key] = tuple(primers)
+    return primerTables[key]
+
+#----------------------------------------------------------------------
+# open reference genome FASTA
+#----------------------------------------------------------------------
+def getFastaFile(genomeFile):
+    ''' Get an open pysam FastaFile for the reference genome, opened once per process
+    (a handle is not shared across fork, since the file offset would be shared)
+    :param str genomeFile: path to indexed genome FASTA
+    :returns pysam.FastaFile
+    '''
+    key = (os.getpid(), os.path.abspath(genomeFile))
+    if key not in fastaFiles:
+        fastaFiles[key] = pysam.FastaFile(genomeFile)
+    return fastaFiles[key]
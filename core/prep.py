@@ -6,11 +6,15 @@ import math
 import subprocess
 
 # our modules
+import cpu_tokens
 import misc.prep_ion
 
 #-------------------------------------------------------------------------------------
-def runReadTrimmer(cfg):
-    ''' Use paired-end read trimmer for Illumina sequencing
+def getReadTrimmerCmd(cfg, outR1, outR2, numCores):
+    ''' Build the shell command for the paired-end read trimmer
+    :param str outR1: trimmed R1 output, a file or named pipe
+    :param str outR2: trimmed R2 output, a file or named pipe
+    :param int numCores: trimmer worker processes
     '''
     readTrimmerPath = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
@@ -32,24 +36,35 @@ def runReadTrimmer(cfg):
     if cfg.multimodal:
         cmd = cmd + "--is-multimodal "
     
-    cmd = cmd.format(
+    return cmd.format(
         trimmer = readTrimmerPath,
         R1 = cfg.readFile1, R2 = cfg.readFile2, primer = cfg.primerFile,
         summary = cfg.readSet + '.prep.detail.summary.txt',
-        outR1 = cfg.readSet + '.prep.R1.fastq',
-        outR2 = cfg.readSet + '.prep.R2.fastq',
+        outR1 = outR1,
+        outR2 = outR2,
         primer3R1 = cfg.primer3Bases, primer3R2 = cfg.primer3Bases,
-        ncpu = int(cfg.numCores),
+        ncpu = numCores,
         pr = cfg.tagNamePrimer, pe = cfg.tagNamePrimerErr, mi = cfg.tagNameUmiSeq,
         log = cfg.readSet + '.prep.log')
-    p = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, shell=True)
-    stdout, stderr = p.communicate()
+
+#-------------------------------------------------------------------------------------
+def runReadTrimmer(cfg):
+    ''' Use paired-end read trimmer for Illumina sequencing
+    '''
+    with cpu_tokens.Cores(cfg) as numCores:
+        cmd = getReadTrimmerCmd(cfg, cfg.readSet + '.prep.R1.fastq', cfg.readSet + '.prep.R2.fastq', numCores)
+        p = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, shell=True)
+        stdout, stderr = p.communicate()
     print(stdout) # redirect stderr and stdout to main logfile so upstream error trapping modules can find UserWarning exception
     print(stderr)
     if p.returncode:
         raise Exception("Trimming of Fastqs failed !")
+    writeSummary(cfg)
 
-    # create a less dense summary file for customers
+#-------------------------------------------------------------------------------------
+def writeSummary(cfg):
+    ''' Create a less dense summary file for customers, from the trimmer detail summary
+    '''
     minimal_metrics = [
         lambda x: x == "read fragments total", lambda x: x == "read fragments dropped, no duplex adapter",
         lambda x: x.startswith("read fragments with duplex tag")]
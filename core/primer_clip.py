@@ -1,9 +1,21 @@
+import collections
+import multiprocessing
 import os
 import os.path
 
 # 3rd party
 import pysam
 
+# our modules
+import bam_io
+import cpu_tokens
+import samtools
+import scratch
+
+# read pairs per chunk clipped by a worker process, and chunks in flight per worker (bounds the scratch space used)
+CHUNK_PAIRS = 50000
+CHUNKS_PER_WORKER = 2
+
 #-----------------------------------------------------------------------
 # soft clip one read
 #-----------------------------------------------------------------------
@@ -145,16 +157,16 @@ def clipRead(read, aligmentReoriented, cigar, basesGenomeNeeded):
         return dropFlag
   
 #-----------------------------------------------------------------------
-# main
+# soft clip the read pairs of a BAM file
 #-----------------------------------------------------------------------
-def run(cfg, bamFileIn, bamFileOut, resampleOnly):
-    print("primer_clip starting...")
-    deleteLocalFiles = cfg.deleteLocalFiles
-    
-    # open files
-    bamIn  = pysam.AlignmentFile(bamFileIn , "rb")
-    bamOut = pysam.AlignmentFile(bamFileOut, "wb", template=bamIn)
-    
+def clipPairs(bamIn, bamOut, resampleOnly, reportProgress):
+    ''' Clip primers (and R1 3' umi/common oligo) from each read pair, dropping pairs with a read 100% soft clipped
+    :param bamIn: pysam file, sorted by read id, mates adjacent
+    :param bamOut: pysam file for the clipped read pairs
+    :param bool resampleOnly: clip only the internal-resample read pairs
+    :param bool reportProgress: print the read pair count every 1M pairs
+    :returns tuple (read pairs, read pairs with R1 trimmed, read pairs dropped)
+    '''
     # loop over input BAM - must be sorted by read id
     numReadPairs = 0
     numReadPairsTrimmed = 0
@@ -179,7 +191,7 @@ def run(cfg, bamFileIn, bamFileOut, resampleOnly):
          
         # report progress
         numReadPairs += 1
-        if numReadPairs % 1000000 == 0:
+        if reportProgress and numReadPairs % 1000000 == 0:
             print("# read pairs processed: " + "{0:,}".format(numReadPairs))
    
         # check for internal-resample-only request
@@ -266,10 +278,139 @@ def run(cfg, bamFileIn, bamFileOut, resampleOnly):
         else:
             bamOut.write(read1)
             bamOut.write(read2)
-   
-    # done         
+    return (numReadPairs, numReadPairsTrimmed, numReadPairsDropped)
+
+#-----------------------------------------------------------------------
+# clip one chunk of read pairs - in a worker process
+#-----------------------------------------------------------------------
+def clipChunk(args):
+    (bamFileIn, bamFileOut, resampleOnly) = args
+    bamIn  = pysam.AlignmentFile(bamFileIn, "rb")
+    bamOut = pysam.AlignmentFile(bamFileOut, "wbu", template=bamIn)
+    counts = clipPairs(bamIn, bamOut, resampleOnly, False)
     bamIn.close()
     bamOut.close()
+    os.remove(bamFileIn)
+    return counts
+
+#-----------------------------------------------------------------------
+# append the output of a clipped chunk to the output BAM, and add up its counts
+#-----------------------------------------------------------------------
+def mergeChunk(chunk, bamOut, counts):
+    (bamFileChunk, result) = chunk
+    countsChunk = result.get()
+    bamIn = pysam.AlignmentFile(bamFileChunk, "rb")
+    for read in bamIn:
+        bamOut.write(read)
+    bamIn.close()
+    os.remove(bamFileChunk)
+    numReadPairsLast = counts[0]
+    for i in range(len(counts)):
+        counts[i] += countsChunk[i]
+    if counts[0] / 1000000 > numReadPairsLast / 1000000:
+        print("# read pairs processed: " + "{0:,}".format(counts[0] / 1000000 * 1000000))
+
+#-----------------------------------------------------------------------
+# split the input into chunks of whole read pairs, clip the chunks in a worker pool, and merge the outputs in input order
+#-----------------------------------------------------------------------
+def clipParallel(cfg, bamIn, bamOut, resampleOnly, pool, numWorkers):
+    filePrefix = scratch.getFile(cfg, os.path.basename(cfg.readSet) + ".primer_clip")
+    counts = [0, 0, 0]
+    chunks = collections.deque()
+    chunkIdx = 0
+    chunkOut = None
+    while True:
+        try:
+            read1 = bamIn.next()
+        except StopIteration:
+            read1 = None
+
+        # chunk full, or end of input - clip it in the pool, and merge finished chunks
+        if chunkOut is not None and (read1 is None or numChunkPairs == CHUNK_PAIRS):
+            chunkOut.close()
+            chunkOut = None
+            job = (bamFileChunk, bamFileChunk + ".clipped", resampleOnly)
+            chunks.append((job[1], pool.apply_async(clipChunk, (job,))))
+            while len(chunks) > 0 and (len(chunks) >= numWorkers * CHUNKS_PER_WORKER or chunks[0][1].ready()):
+                mergeChunk(chunks.popleft(), bamOut, counts)
+        if read1 is None:
+            break
+
+        # crash if read is not paired, or the mate is not next - chunks must hold whole read pairs
+        if not read1.is_paired:
+            raise Exception("read not paired! " + read1.qname)
+        read2 = bamIn.next()
+        if read1.qname != read2.qname:
+            print(read1.qname, read2.qname)
+            raise Exception("read mate is not next in BAM record order!")
+
+        # start a new chunk - uncompressed, read once by a worker
+        if chunkOut is None:
+            bamFileChunk = "{}.{}.bam".format(filePrefix, chunkIdx)
+            chunkOut = bam_io.openBam(cfg, bamFileChunk, "wbu", template=bamIn)
+            chunkIdx += 1
+            numChunkPairs = 0
+        chunkOut.write(read1)
+        chunkOut.write(read2)
+        numChunkPairs += 1
+
+    # merge the remaining chunks
+    while len(chunks) > 0:
+        mergeChunk(chunks.popleft(), bamOut, counts)
+    print("primer_clip: clipped {} chunks with {} workers".format(chunkIdx, numWorkers))
+    return tuple(counts)
+
+#-----------------------------------------------------------------------
+# main
+#-----------------------------------------------------------------------
+def run(cfg, bamFileIn, bamFileOut, resampleOnly, sortOutput = False):
+    ''' Soft clip primers from read pairs
+    :param lambda obj cfg: run config
+    :param str bamFileIn: BAM file sorted by read id
+    :param str bamFileOut: BAM file of clipped read pairs
+    :param bool resampleOnly: clip only the internal-resample read pairs
+    :param bool sortOutput: feed the clipped reads straight into samtools sort, making a coordinate sorted and indexed bamFileOut -
+                            samtools sort is the bounded-memory sorter (spills sorted runs of cfg.samtoolsMem per thread to the
+                            scratch dir, k-way merges them at the end), and samtools index runs after it, as samtools 1.5 cannot
+                            write the index during the sort
+    '''
+    print("primer_clip starting...")
+    deleteLocalFiles = cfg.deleteLocalFiles
+
+    # read pairs are independent - the stage core splits and merges, spare cores from the pool clip chunks and,
+    # if sorting, run the sort threads (busy spilling sorted runs, and in the final merge after clipping)
+    numCoresSpare = int(cfg.numCores) - 1
+    with cpu_tokens.Cores(cfg, numCoresSpare, 0) as numSpare:
+        numSortThreads = (numSpare + 2) / 4 if sortOutput else 0
+        numWorkers = numSpare - numSortThreads
+
+        # start the workers before opening the BAM files, so they do not hold the samtools pipes open
+        pool = multiprocessing.Pool(numWorkers) if numWorkers > 0 else None
+
+        # open files - output is sorted next, so fast compression - or sorted as it is written
+        bamIn  = bam_io.openBam(cfg, bamFileIn , "rb")
+        if sortOutput:
+            bamOut = samtools.sortPipe(cfg, bamFileOut, numSortThreads, bamIn)
+        else:
+            bamOut = bam_io.openBam(cfg, bamFileOut, "wb", bam_io.LEVEL_TEMP, template=bamIn)
+        if pool is None:
+            (numReadPairs, numReadPairsTrimmed, numReadPairsDropped) = clipPairs(bamIn, bamOut, resampleOnly, True)
+        else:
+            try:
+                (numReadPairs, numReadPairsTrimmed, numReadPairsDropped) = clipParallel(cfg, bamIn, bamOut, resampleOnly, pool, numWorkers)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        # done
+        bamIn.close()
+        bamOut.close()
+    if sortOutput:
+        # index pass over the sorted output (samtools sort --write-index needs samtools 1.10)
+        samtools.index(cfg, bamFileOut)
  
     # report debug count
     print("# read pairs total", numReadPairs)
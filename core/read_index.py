@@ -0,0 +1,154 @@
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+
+# file layout: header, then start record of each 16-bit key prefix (NUM_PREFIXES + 1 values), then the records
+# sorted by key - each record is KEY_BYTES of key, then the payload padded with NUL bytes to a fixed width
+MAGIC = "RIDX0001"
+HEADER = struct.Struct("<8sQQ")
+KEY_BYTES = 12
+NUM_PREFIXES = 1 << 16
+
+# records are first spread over partition files by the first key byte, so each partition sorts in memory
+NUM_PARTITIONS = 256
+FLUSH_BYTES_TOTAL = 1 << 26
+
+#----------------------------------------------------------------------
+# hash a read id - the first 8 bytes are the 64-bit hash the index is sorted on, the last 4 a check against collisions
+#----------------------------------------------------------------------
+def getKey(readId):
+    return hashlib.md5(readId).digest()[:KEY_BYTES]
+
+#----------------------------------------------------------------------
+# build a read id index file
+#----------------------------------------------------------------------
+class Writer(object):
+    def __init__(self, fileName, tempDir):
+        ''' Start a read id index - add(readId, payload) for each read, then close()
+        :param str fileName: index file to make, e.g. <readSet>.umi_merge.index
+        :param str tempDir: directory for the partition files, e.g. the read set scratch dir
+        '''
+        self.fileName = fileName
+        self.fileNamesPart = [os.path.join(tempDir, "{}.{}".format(os.path.basename(fileName), i)) for i in xrange(NUM_PARTITIONS)]
+        for fileNamePart in self.fileNamesPart:
+            open(fileNamePart, "wb").close()
+        self.buffers = [[] for i in xrange(NUM_PARTITIONS)]
+        self.bytesBuffered = 0
+        self.payloadLenMax = 0
+
+    def add(self, readId, payload):
+        ''' Add a read
+        :param str readId
+        :param str payload: value returned by Reader.get() - no NUL bytes, under 64K
+        '''
+        key = getKey(readId)
+        record = key + struct.pack("<H", len(payload)) + payload
+        self.buffers[ord(key[0])].append(record)
+        self.bytesBuffered += len(record)
+        self.payloadLenMax = max(self.payloadLenMax, len(payload))
+        if self.bytesBuffered >= FLUSH_BYTES_TOTAL:
+            self.flush()
+
+    def flush(self):
+        for (fileNamePart, buffer) in zip(self.fileNamesPart, self.buffers):
+            if len(buffer) > 0:
+                fileout = open(fileNamePart, "ab")
+                fileout.write("".join(buffer))
+                fileout.close()
+                del(buffer[:])
+        self.bytesBuffered = 0
+
+    def readPartition(self, fileNamePart):
+        ''' Read the records of a partition file as fixed width records, sorted
+        '''
+        data = open(fileNamePart, "rb").read()
+        records = []
+        pos = 0
+        while pos < len(data):
+            key = data[pos:pos + KEY_BYTES]
+            (payloadLen,) = struct.unpack_from("<H", data, pos + KEY_BYTES)
+            pos += KEY_BYTES + 2
+            records.append(key + data[pos:pos + payloadLen].ljust(self.payloadLenMax, "\0"))
+            pos += payloadLen
+        records.sort()
+        return records
+
+    def close(self):
+        ''' Sort the records, and write the index file
+        '''
+        self.flush()
+        fileout = open(self.fileName + ".tmp", "wb")
+        fileout.write("\0" * (HEADER.size + 8 * (NUM_PREFIXES + 1)))
+
+        # sort each partition in memory - partitions are by first key byte, so are written in key order
+        prefixCounts = [0] * NUM_PREFIXES
+        numRecords = 0
+        for fileNamePart in self.fileNamesPart:
+            records = self.readPartition(fileNamePart)
+            os.remove(fileNamePart)
+            for i in xrange(len(records)):
+                key = records[i][:KEY_BYTES]
+                if i > 0 and key == records[i - 1][:KEY_BYTES]:
+                    raise Exception("read_index: duplicate read id in " + self.fileName)
+                prefixCounts[(ord(key[0]) << 8) | ord(key[1])] += 1
+            fileout.write("".join(records))
+            numRecords += len(records)
+
+        # write the header and the prefix table
+        prefixStarts = [0] * (NUM_PREFIXES + 1)
+        for i in xrange(NUM_PREFIXES):
+            prefixStarts[i + 1] = prefixStarts[i] + prefixCounts[i]
+        fileout.seek(0)
+        fileout.write(HEADER.pack(MAGIC, KEY_BYTES + self.payloadLenMax, numRecords))
+        fileout.write(struct.pack("<{}Q".format(NUM_PREFIXES + 1), *prefixStarts))
+        fileout.close()
+        os.rename(self.fileName + ".tmp", self.fileName)
+        print("read_index: {} reads in {}".format(numRecords, self.fileName))
+
+#----------------------------------------------------------------------
+# look up reads in a read id index file, memory-mapped
+#----------------------------------------------------------------------
+class Reader(object):
+    def __init__(self, fileName):
+        self.IN = open(fileName, "rb")
+        self.mm = mmap.mmap(self.IN.fileno(), 0, access = mmap.ACCESS_READ)
+        (magic, self.recordLen, self.numRecords) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception("read_index: not a read id index file: " + fileName)
+        self.prefixStarts = struct.unpack_from("<{}Q".format(NUM_PREFIXES + 1), self.mm, HEADER.size)
+        self.dataStart = HEADER.size + 8 * (NUM_PREFIXES + 1)
+
+    def __len__(self):
+        return self.numRecords
+
+    def get(self, readId, default = None):
+        ''' Get the payload of a read, by binary search within its key prefix
+        :param str readId
+        :param default: returned if the read is not in the index
+        :returns str payload
+        '''
+        key = getKey(readId)
+        prefix = (ord(key[0]) << 8) | ord(key[1])
+        lo = self.prefixStarts[prefix]
+        end = hi = self.prefixStarts[prefix + 1]
+        mm = self.mm
+        recordLen = self.recordLen
+        dataStart = self.dataStart
+        while lo < hi:
+            mid = (lo + hi) / 2
+            offset = dataStart + mid * recordLen
+            if mm[offset:offset + KEY_BYTES] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end:
+            offset = dataStart + lo * recordLen
+            if mm[offset:offset + KEY_BYTES] == key:
+                return mm[offset + KEY_BYTES:offset + recordLen].rstrip("\0")
+        return default
+
+    def close(self):
+        self.mm.close()
+        self.IN.close()
@@ -1,4 +1,5 @@
 import ConfigParser
+import os.path
 from multiprocessing.dummy import cpu_count as cpu_count
 
 #--------------------------------------------------------------------------------------
@@ -40,8 +41,24 @@ def run(readSet,paramFile):
         cfg.deleteLocalFiles = cfg.deleteLocalFiles.lower() == "true"
     else:
         cfg.deleteLocalFiles = False
+    if "resume" in cfg.__dict__:
+        cfg.resume = cfg.resume.lower() == "true"
+    else:
+        cfg.resume = False
+    if "streamAlign" in cfg.__dict__:
+        cfg.streamAlign = cfg.streamAlign.lower() == "true"
+    else:
+        cfg.streamAlign = False
+    if "keepAlignBam" in cfg.__dict__:
+        cfg.keepAlignBam = cfg.keepAlignBam.lower() == "true"
+    else:
+        cfg.keepAlignBam = False
     if "instrument" not in cfg.__dict__: # IonTorrent, or 
         cfg.instrument = "N/A"           # say the user forgot to specify this for Illumina - Use MiSeq as default
+     
+    # temp files go to a per read set directory under scratchDir (e.g. local disk or tmpfs), default run dir
+    scratchDir = cfg.scratchDir if "scratchDir" in cfg.__dict__ else "."
+    cfg.scratchDir = os.path.join(scratchDir, readSet + ".scratch")
  
     # return config object
     return cfg
@@ -0,0 +1,170 @@
+import multiprocessing
+import Queue
+import time
+import traceback
+
+# our modules
+import cpu_tokens
+import run_manifest
+import run_resources
+
+#----------------------------------------------------------------------
+# get the stages each stage must wait for, from the files they read and write
+#----------------------------------------------------------------------
+def getDependencies(stages):
+    ''' Build the stage dependency graph from declared files - a stage waits for
+    the last earlier stage that wrote a file it reads or writes, and for all earlier
+    stages that read a file it writes since that write (so in-place re-sorts and
+    deletions do not pull a file out from under a reader)
+    :param list stages: Stage objects, in serial execution order
+    :returns dict of stage name -> list of Stage objects it depends on
+    '''
+    lastWriter = {}
+    lastReaders = {}
+    depends = {}
+    for stage in stages:
+        reads  = set(stage.inputs)  | set(stage.rewrites)
+        writes = set(stage.outputs) | set(stage.rewrites)
+        upstream = []
+        for fileName in reads | writes:
+            writer = lastWriter.get(fileName)
+            if writer is not None:
+                upstream.append(writer)
+        for fileName in writes:
+            upstream.extend(lastReaders.get(fileName, []))
+
+        # update file state for later stages
+        for fileName in reads:
+            lastReaders.setdefault(fileName, []).append(stage)
+        for fileName in writes:
+            lastWriter[fileName] = stage
+            lastReaders[fileName] = []
+
+        # keep declaration order, drop duplicates and self
+        names = set()
+        depends[stage.name] = []
+        for x in upstream:
+            if x is not stage and x.name not in names:
+                names.add(x.name)
+                depends[stage.name].append(x)
+    return depends
+
+#----------------------------------------------------------------------
+# stage entry point in a child process - report result, cfg values and resources used to parent
+#----------------------------------------------------------------------
+def runChild(stage, cfg, queue):
+    snapshot = run_resources.start()
+    try:
+        # in-process python stages hold their declared cores for the whole stage - stages that
+        # launch tools (cores None) take cores from the pool around each tool instead
+        if stage.cores is None:
+            result = stage.func(*stage.args)
+        else:
+            with cpu_tokens.Cores(cfg, stage.cores, stage.cores):
+                result = stage.func(*stage.args)
+        values = dict((x, getattr(cfg, x)) for x in stage.values if hasattr(cfg, x))
+        queue.put((stage.name, True, result, values, run_resources.stop(snapshot)))
+    except BaseException:
+        queue.put((stage.name, False, traceback.format_exc(), None, run_resources.stop(snapshot)))
+
+#----------------------------------------------------------------------
+# wait for the next stage to finish
+#----------------------------------------------------------------------
+def getMessage(queue, running):
+    while True:
+        try:
+            return queue.get(timeout = 5)
+        except Queue.Empty:
+            # a child killed by a signal never reports back
+            for (stage, process, cores) in running.itervalues():
+                if process.exitcode is not None and process.exitcode != 0:
+                    return (stage.name, False, "stage process exited with code {}".format(process.exitcode), None, None)
+
+#----------------------------------------------------------------------
+# run stages concurrently as their inputs become ready, within the numCores budget
+#----------------------------------------------------------------------
+def run(cfg, stages):
+    ''' Run pipeline stages as a dependency graph, skipping stages completed in a previous run,
+    and write resources used by each stage to <readSet>.resources.tsv
+    :param lambda obj cfg: run config
+    :param list stages: Stage objects, in serial execution order
+    '''
+    timeStart = time.time()
+    numCores = int(cfg.numCores)
+    manifest = run_manifest.Manifest(cfg)
+    toRun = manifest.plan(stages)
+    depends = getDependencies(stages)
+
+    waiting = list(stages)
+    done = set()
+    running = {}
+    params = {}
+    failed = []
+    stageUsage = []
+    coresUsed = 0
+    queue = multiprocessing.Queue()
+    while True:
+        # start ready stages in declaration order - a stage needing more cores than are free
+        # waits, unless nothing is running (so stages larger than the budget still run). Stages
+        # taking cores from the pool (cores None) count as one core here - the pool shares
+        # out the rest, so they start alongside other stages rather than waiting for all cores
+        started = True
+        while started and len(failed) == 0:
+            started = False
+            for stage in list(waiting):
+                if any(x.name not in done for x in depends[stage.name]):
+                    continue
+                if stage.name not in toRun:
+                    manifest.restore(stage)
+                    print("run_graph: skipping stage {}, completed in previous run".format(stage.name))
+                    waiting.remove(stage)
+                    done.add(stage.name)
+                    started = True
+                    continue
+                cores = 1 if stage.cores is None else min(stage.cores, numCores)
+                if len(running) > 0 and coresUsed + cores > numCores:
+                    continue
+
+                # forget the old record before starting, in case this attempt does not finish
+                if stage.name in manifest.records:
+                    del(manifest.records[stage.name])
+                    manifest.save()
+                params[stage.name] = manifest.getParams(stage)
+                process = multiprocessing.Process(target = runChild, args = (stage, cfg, queue))
+                process.start()
+                print("run_graph: started stage {} ({} cores)".format(stage.name, "pool" if stage.cores is None else cores))
+                running[stage.name] = (stage, process, cores)
+                coresUsed += cores
+                waiting.remove(stage)
+                started = True
+
+        # done, or stopped after a failure
+        if len(running) == 0:
+            break
+
+        # collect the next finished stage
+        (name, ok, result, values, usage) = getMessage(queue, running)
+        if name not in running:
+            continue
+        (stage, process, cores) = running.pop(name)
+        process.join()
+        coresUsed -= cores
+        if usage is not None:
+            stageUsage.append((name, "pool" if stage.cores is None else cores, usage))
+        if not ok:
+            print("run_graph: stage {} failed\n{}".format(name, result))
+            failed.append(name)
+            continue
+
+        # apply cfg values set by the stage in the child process, and record it as done
+        for (valueName, val) in values.iteritems():
+            setattr(cfg, valueName, val)
+        stage.result = result
+        manifest.commit(stage, params[name])
+        done.add(name)
+        print("run_graph: finished stage {}".format(name))
+
+    run_resources.write(cfg.readSet, timeStart, stageUsage)
+    if len(failed) > 0:
+        raise Exception("run_graph: pipeline stage(s) failed: " + ", ".join(failed))
+    return stages
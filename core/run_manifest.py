@@ -0,0 +1,152 @@
+import json
+import os
+import os.path
+
+#----------------------------------------------------------------------
+# one pipeline stage - a function call plus the files and config params it depends on
+#----------------------------------------------------------------------
+class Stage(object):
+    def __init__(self, name, func, args = (), inputs = (), outputs = (), params = (), values = (), settings = None, rewrites = (), cores = None):
+        ''' Describe a pipeline stage for the run manifest
+        :param str name: stage name, unique within a read set
+        :param function func: stage entry point, called as func(*args)
+        :param tuple args: arguments for func
+        :param tuple inputs: files read by the stage
+        :param tuple outputs: files written by the stage
+        :param tuple params: names of cfg params the stage outputs depend on
+        :param tuple values: names of cfg attributes set by the stage, restored when the stage is skipped
+        :param dict settings: other settings the stage outputs depend on (not in cfg)
+        :param tuple rewrites: files made by earlier stages that the stage re-sorts in place or deletes
+        :param int cores: number of CPU cores held by the stage for its whole run (python stages), None if
+                          it takes cores from the pool around each tool it launches
+        '''
+        self.name    = name
+        self.func    = func
+        self.args    = args
+        self.inputs  = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.params  = tuple(params)
+        self.values  = tuple(values)
+        self.settings = settings if settings is not None else {}
+        self.rewrites = tuple(rewrites)
+        self.cores   = cores
+        self.result  = None
+
+#----------------------------------------------------------------------
+# file size and modification time, or None if the file does not exist
+#----------------------------------------------------------------------
+def fingerprint(fileName):
+    if not os.path.isfile(fileName):
+        return None
+    stat = os.stat(fileName)
+    return [stat.st_size, int(stat.st_mtime)]
+
+#----------------------------------------------------------------------
+# per read set stage manifest - <readSet>.manifest.json
+#----------------------------------------------------------------------
+class Manifest(object):
+    def __init__(self, cfg):
+        ''' Load the manifest of a previous run, if resuming
+        :param lambda obj cfg: run config, cfg.resume enables skipping of completed stages
+        '''
+        self.cfg = cfg
+        self.fileName = cfg.readSet + ".manifest.json"
+        self.records = {}
+        if cfg.resume and os.path.isfile(self.fileName):
+            with open(self.fileName, "r") as IN:
+                self.records = json.load(IN)
+            print("run_manifest: resuming from " + self.fileName)
+
+    def getParams(self, stage):
+        params = dict((name, str(getattr(self.cfg, name, None))) for name in stage.params)
+        for (name, val) in stage.settings.iteritems():
+            params[name] = str(val)
+        return params
+
+    def isCurrent(self, stage, producers):
+        ''' True if the stage completed in a previous run with the same params and external inputs
+        '''
+        record = self.records.get(stage.name)
+        if record is None or record["status"] != "done":
+            return False
+        if record["params"] != self.getParams(stage):
+            return False
+        # files not made by the pipeline (reads, primers, genome) must be unchanged
+        for fileName in stage.inputs:
+            if fileName not in producers and record["inputs"].get(fileName) != fingerprint(fileName):
+                return False
+        return True
+
+    def plan(self, stages):
+        ''' Get names of the stages that need to be run
+        :param list stages: Stage objects, in execution order
+        :returns set of stage names
+        '''
+        # map each file to the stage that makes it and the later stages that read it
+        producers = {}
+        consumers = {}
+        for stage in stages:
+            for fileName in stage.inputs:
+                if fileName in producers:
+                    consumers[fileName].append(stage)
+            for fileName in stage.outputs:
+                if fileName not in producers:
+                    producers[fileName] = stage
+                    consumers[fileName] = []
+
+        toRun = set(stage.name for stage in stages if not self.isCurrent(stage, producers))
+
+        # propagate: a stage must rerun if an upstream stage reruns, or if one of its outputs
+        # is missing and still needed (final output, or read by a stage that reruns)
+        changed = True
+        while changed:
+            changed = False
+            for stage in stages:
+                if stage.name in toRun:
+                    continue
+                upstream = False
+                for fileName in stage.inputs:
+                    producer = producers.get(fileName)
+                    if producer is not None and producer is not stage and producer.name in toRun:
+                        upstream = True
+                missing = False
+                for fileName in stage.outputs:
+                    if producers[fileName] is stage and not os.path.exists(fileName):
+                        readers = consumers[fileName]
+                        if len(readers) == 0 or any(x.name in toRun for x in readers):
+                            missing = True
+                if upstream or missing:
+                    toRun.add(stage.name)
+                    changed = True
+        return toRun
+
+    def restore(self, stage):
+        ''' Restore cfg values and return value of a skipped stage
+        '''
+        record = self.records[stage.name]
+        for (name, val) in record["values"].iteritems():
+            setattr(self.cfg, str(name), val)
+        stage.result = record["result"]
+
+    def commit(self, stage, params):
+        ''' Record a completed stage - the manifest is replaced atomically, so a crash
+        before this point leaves the stage uncommitted
+        :param dict params: stage params as they were when the stage started
+        '''
+        self.records[stage.name] = {
+            "status"  : "done",
+            "inputs"  : dict((x, fingerprint(x)) for x in stage.inputs),
+            "outputs" : dict((x, fingerprint(x)) for x in stage.outputs),
+            "params"  : params,
+            "values"  : dict((x, getattr(self.cfg, x)) for x in stage.values if hasattr(self.cfg, x)),
+            "result"  : stage.result,
+        }
+        self.save()
+
+    def save(self):
+        fileNameTemp = self.fileName + ".tmp"
+        with open(fileNameTemp, "w") as OUT:
+            json.dump(self.records, OUT, indent = 1, sort_keys = True)
+            OUT.flush()
+            os.fsync(OUT.fileno())
+        os.rename(fileNameTemp, self.fileName)
@@ -0,0 +1,72 @@
+import os.path
+import resource
+import time
+
+# /proc/<pid>/io counters reported - rchar/wchar count all read/write calls, read_bytes/write_bytes only storage I/O
+IO_COUNTERS = ("rchar", "wchar", "read_bytes", "write_bytes")
+
+#----------------------------------------------------------------------
+# read I/O counters of this process - on Linux these include reaped child processes
+#----------------------------------------------------------------------
+def getIoCounters():
+    counters = dict((x, 0) for x in IO_COUNTERS)
+    if os.path.isfile("/proc/self/io"):
+        for line in open("/proc/self/io", "r"):
+            (name, val) = line.split(":")
+            if name in counters:
+                counters[name] = int(val)
+    return counters
+
+#----------------------------------------------------------------------
+# resource snapshot at the start of a stage
+#----------------------------------------------------------------------
+def start():
+    usageSelf = resource.getrusage(resource.RUSAGE_SELF)
+    usageChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time(), usageSelf.ru_utime + usageSelf.ru_stime + usageChildren.ru_utime + usageChildren.ru_stime, getIoCounters())
+
+#----------------------------------------------------------------------
+# resources used since start() by this process and its waited-for children (bwa, samtools, sort, R, java, ...)
+#----------------------------------------------------------------------
+def stop(snapshot):
+    ''' Get resources used by a stage
+    :param tuple snapshot: return value of start()
+    :returns dict with wall and CPU seconds, peak RSS in MB, and I/O byte counts
+    '''
+    (timeStart, cpuStart, ioStart) = snapshot
+    usageSelf = resource.getrusage(resource.RUSAGE_SELF)
+    usageChildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usageSelf.ru_utime + usageSelf.ru_stime + usageChildren.ru_utime + usageChildren.ru_stime
+    io = getIoCounters()
+    usage = {
+        "start" : timeStart,
+        "wall"  : time.time() - timeStart,
+        "cpu"   : cpu - cpuStart,
+        # ru_maxrss is in KB on Linux - the peak of the largest single process, not the sum
+        "rss"   : max(usageSelf.ru_maxrss, usageChildren.ru_maxrss) / 1024.0,
+    }
+    for name in IO_COUNTERS:
+        usage[name] = io[name] - ioStart[name]
+    return usage
+
+#----------------------------------------------------------------------
+# write per-stage resource table - <readSet>.resources.tsv
+#----------------------------------------------------------------------
+def write(readSet, timeStart, stageUsage):
+    ''' Write resources used by each stage that ran
+    :param str readSet
+    :param float timeStart: pipeline start time, stage start times are reported relative to it
+    :param list stageUsage: (stage name, cores, usage dict from stop()) in order of completion - cores is "pool"
+                            for stages taking cores from the pool around each tool
+    '''
+    fileout = open(readSet + ".resources.tsv", "w")
+    fileout.write("\t".join(("read set", "stage", "cores", "start (sec)", "wall (sec)", "CPU user+sys (sec)", "peak RSS (MB)",
+        "bytes read", "bytes written", "storage bytes read", "storage bytes written")))
+    fileout.write("\n")
+    for (name, cores, usage) in stageUsage:
+        outvec = [readSet, name, cores, "{:.1f}".format(usage["start"] - timeStart), "{:.1f}".format(usage["wall"]),
+            "{:.1f}".format(usage["cpu"]), "{:.1f}".format(usage["rss"])]
+        outvec.extend(usage[x] for x in IO_COUNTERS)
+        fileout.write("\t".join((str(x) for x in outvec)))
+        fileout.write("\n")
+    fileout.close()
@@ -2,28 +2,64 @@ import subprocess
 import os
 import os.path
 
+# our modules
+import bam_io
+import cpu_tokens
+import scratch
+
 def sort(cfg,bamFileIn,bamFileOut):
     # params
     deleteLocalFiles = cfg.deleteLocalFiles
     readSet          = cfg.readSet
     samtoolsDir      = cfg.samtoolsDir
     samtoolsMem      = cfg.samtoolsMem
-    numCores         = cfg.numCores
  
     # sort
-    cmd = samtoolsDir + "samtools sort"  \
-    + " -m " + samtoolsMem \
-    + " -@ " + numCores \
-    + " -T " + readSet \
-    + " -o " + bamFileOut \
-    + "    " + bamFileIn \
-    + " >> " + readSet + ".samtools.shell.log 2>&1"
-    subprocess.check_call(cmd, shell=True)
+    with cpu_tokens.Cores(cfg) as numCores:
+        cmd = samtoolsDir + "samtools sort"  \
+        + " -m " + samtoolsMem \
+        + " -@ " + str(numCores) \
+        + " -T " + scratch.getFile(cfg, readSet) \
+        + " -o " + bamFileOut \
+        + "    " + bamFileIn \
+        + " >> " + readSet + ".samtools.shell.log 2>&1"
+        subprocess.check_call(cmd, shell=True)
     
     # index
-    cmd = samtoolsDir + "samtools index " + bamFileOut
-    subprocess.check_call(cmd, shell=True)
+    index(cfg,bamFileOut)
  
     # delete input file if requested
     if deleteLocalFiles and len(os.path.dirname(bamFileIn)) == 0:
         os.remove(bamFileIn)
+
+#----------------------------------------------------------------------
+# index a coordinate sorted BAM file
+#----------------------------------------------------------------------
+def index(cfg,bamFile):
+    cmd = cfg.samtoolsDir + "samtools index " + bamFile
+    subprocess.check_call(cmd, shell=True)
+
+#----------------------------------------------------------------------
+# open a pysam writer feeding samtools sort - the records are coordinate sorted as they are written
+#----------------------------------------------------------------------
+def sortPipe(cfg,bamFileOut,numCores,template):
+    ''' Sort records written by pysam into a BAM file - samtools sort spills sorted runs to the scratch dir,
+    and merges them at close()
+    :param lambda obj cfg: run config
+    :param str bamFileOut: coordinate sorted BAM file to make
+    :param int numCores: samtools sort threads (-@) - cores held by the caller
+    :param template: pysam or bam_io file with the BAM header
+    :returns bam_io.BamFile - close() waits for the sort to finish
+    '''
+    readSet = cfg.readSet
+    cmd = [cfg.samtoolsDir + "samtools", "sort",
+        "-m", cfg.samtoolsMem,
+        "-@", str(numCores),
+        "-T", scratch.getFile(cfg, readSet),
+        "-o", bamFileOut,
+        "-"]
+    log = open(readSet + ".samtools.shell.log", "a")
+    try:
+        return bam_io.openCommand(cmd, bamFileOut, "w", stderr = log, template = template)
+    finally:
+        log.close()
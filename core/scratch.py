@@ -0,0 +1,33 @@
+import errno
+import os
+import os.path
+import shutil
+
+#----------------------------------------------------------------------
+# get the read set scratch directory, for sort spill files and other temp files
+#----------------------------------------------------------------------
+def getDir(cfg):
+    ''' Get the read set scratch directory, creating it if needed
+    :param lambda obj cfg: run config, cfg.scratchDir set by core.run_config
+    :returns str directory path
+    '''
+    try:
+        os.makedirs(cfg.scratchDir)
+    except OSError, ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    return cfg.scratchDir
+
+#----------------------------------------------------------------------
+# get a path in the scratch directory
+#----------------------------------------------------------------------
+def getFile(cfg, fileName):
+    return os.path.join(getDir(cfg), fileName)
+
+#----------------------------------------------------------------------
+# remove the read set scratch directory - stale temp files from a failed run, or when done
+#----------------------------------------------------------------------
+def clean(cfg):
+    if os.path.isdir(cfg.scratchDir):
+        print("scratch: removing " + cfg.scratchDir)
+        shutil.rmtree(cfg.scratchDir)
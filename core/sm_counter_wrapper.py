@@ -3,6 +3,7 @@ import os
 import sys
 
 # our modules
+import cpu_tokens
 sm_counter_v1 = __import__("qiaseq-smcounter-v1.sm_counter")
 sm_counter_v2 = __import__("qiaseq-smcounter-v2.run")
 
@@ -51,15 +52,16 @@ def run(cfg, paramFile, vc):
         cfgSmCounter["bedTarget"] = readSet + ".tvc_roi.bed"  # subset to tvc variants
     else:
         cfgSmCounter["bedTarget"] = cfg.roiBedFile
-    cfgSmCounter["nCPU"     ] = cfg.numCores
     cfgSmCounter["refGenome"] = cfg.genomeFile
     cfgSmCounter["isDuplex"]  = cfg.duplex
  
     if vc == 'v1':
         cfgSmCounter["rpb"      ] = cfg.readsPerUmi  # this comes from metrics.umi_frags module
         cfgSmCounter["mtDepth"] = cfg.umiDepthMean # this comes from metrics.umi_depths module
-        # run smCounter variant caller
-        smCounterThreshold = sm_counter_v1.sm_counter.main(cfgSmCounter)
+        # run smCounter variant caller, on the cores free now
+        with cpu_tokens.Cores(cfg) as numCores:
+            cfgSmCounter["nCPU"] = str(numCores)
+            smCounterThreshold = sm_counter_v1.sm_counter.main(cfgSmCounter)
         # create low PI file for v1
         makeLowPIFile(readSet,smCounterThreshold)
     else:
@@ -67,10 +69,17 @@ def run(cfg, paramFile, vc):
             cfgSmCounter["duplexTag"] = cfg.tagNameDuplex
         cfgSmCounter["rpu"      ] = cfg.readsPerUmi  # this comes from metrics.umi_frags module
         cfgSmCounter["runPath"] = os.getcwd()
-        sm_counter_v2.run.main(cfgSmCounter)
+        with cpu_tokens.Cores(cfg) as numCores:
+            cfgSmCounter["nCPU"] = str(numCores)
+            sm_counter_v2.run.main(cfgSmCounter)
         smCounterThreshold = 6
         # need to add the lod quantiles output from smCounter-v2 to umi_depths.summary file
-        fileoutSummary = open(readSet + ".umi_depths.summary.txt","a")
+        # (dropping LOD lines left by an earlier smCounter run, so a rerun does not duplicate them)
+        fileSummary = readSet + ".umi_depths.summary.txt"
+        with open(fileSummary,"r") as IN:
+            linesSummary = [line for line in IN if not line.rstrip().endswith("minimum detectible allele fraction (LOD)")]
+        fileoutSummary = open(fileSummary,"w")
+        fileoutSummary.writelines(linesSummary)
         fileLodQuantiles = readSet + ".umi_depths.variant-calling-lod.bedgraph.quantiles.txt"
         if os.path.exists(fileLodQuantiles):
             with open(fileLodQuantiles,"r") as IN:
@@ -82,6 +91,7 @@ def run(cfg, paramFile, vc):
                     fileoutSummary.write("{:6.4f}\t{:2d}{} percentile estimated minimum detectible allele fraction (LOD)\n".format(metricVal, metricName,thorst))
             # remove the temporary file
             os.remove(fileLodQuantiles)
+        fileoutSummary.close()
 
     # write smCounter threshold to disk file, for main summary table
     fileout = open(readSet + ".smCounter.summary.txt", "w")
@@ -3,6 +3,69 @@ import sys
 MAX_BC_LEN = 50
 mtx = [[0] *(MAX_BC_LEN+1) for idx in xrange(MAX_BC_LEN+1)]
 
+# 2-bit base codes for packed barcodes - N is also flagged in a separate mask
+BASE_CODES = {"A" : 0, "C" : 1, "G" : 2, "T" : 3, "N" : 0}
+
+# low bit of each 2-bit base slot, by barcode length
+LOW_BITS = [int("01" * n, 2) if n > 0 else 0 for n in xrange(MAX_BC_LEN+1)]
+
+#---------------------------------------------------------------------------------------
+# pack a barcode into integers
+#---------------------------------------------------------------------------------------
+def encode(bc):
+    ''' Pack a barcode, 2 bits per base with the first base most significant
+    :param str bc: barcode
+    :returns tuple (code, N mask with the low bit of each N slot set, length), or None if not all ACGTN
+    '''
+    if len(bc) > MAX_BC_LEN:
+        return None
+    code = 0
+    nMask = 0
+    for base in bc:
+        val = BASE_CODES.get(base)
+        if val is None:
+            return None
+        code = (code << 2) | val
+        nMask = (nMask << 2) | (base == "N")
+    return (code, nMask, len(bc))
+
+#---------------------------------------------------------------------------------------
+# isSimilar() for packed barcodes of the same length - a Hamming distance of 0 or 1, with N in barcodeB matching any base
+#---------------------------------------------------------------------------------------
+def isSimilarPacked(packedA, packedB, bcLen):
+    (codeA, nMaskA, aLen) = packedA
+    (codeB, nMaskB, bLen) = packedB
+
+    # one bit per mismatched base: code differs or N in barcodeA, unless N in barcodeB
+    diff = codeA ^ codeB
+    misMatch = (((diff | (diff >> 1)) & LOW_BITS[aLen]) | nMaskA) & ~nMaskB
+
+    # same (odd) mismatch position as isSimilar() - one past the matched prefix, capped at bcLen, 0-based
+    if misMatch == 0:
+        misMatchPos = aLen
+    else:
+        misMatchPos = aLen - (misMatch.bit_length() - 1) / 2
+    if misMatchPos > bcLen:
+        misMatchPos = bcLen
+    else:
+        misMatchPos -= 1
+    return (misMatch & (misMatch - 1) == 0, misMatchPos)
+
+#---------------------------------------------------------------------------------------
+# prefix and suffix hash keys - integers for packed barcodes, the same buckets as the prefix and suffix strings
+#---------------------------------------------------------------------------------------
+def getBucketKeys(bc, packed, prefixLen):
+    if packed is None:
+        return (bc[:prefixLen], bc[0-prefixLen:])
+    (code, nMask, bcLen) = packed
+    prefixBases = min(prefixLen, bcLen)
+    suffixBases = min(prefixLen, bcLen) if prefixLen > 0 else bcLen   # bc[-0:] is the whole barcode
+    shift = 2 * (bcLen - prefixBases)
+    mask = (1 << (2 * suffixBases)) - 1
+    prefixKey = ((((nMask >> shift) << (2 * prefixBases)) | (code >> shift)) << 6) | prefixBases
+    suffixKey = ((((nMask & mask) << (2 * suffixBases)) | (code & mask)) << 6) | suffixBases
+    return (prefixKey, suffixKey)
+
 #---------------------------------------------------------------------------------------
 # fast check to determine if a barcodeB can be merged with barcodeA
 #---------------------------------------------------------------------------------------
@@ -40,16 +103,52 @@ def isSimilar(bcA, bcB, bcLen, allowNs = True):
         return (False, misMatchPos)
 
 #---------------------------------------------------------------------------------------
-#function to cluster the barcodes for one amplicon
-# inPairs: list of (readID, barcode) tuples
-# bcLen: barcode length
-# minRealNum: minimum number of reads with a barcode for that barcode to be considered as real in the initial scan
-# minRealFrac: the barcode should a minimum of (minRealFrac * (no. of reads in the most frequent barcode) for it to be considered real in teh initial scan
-# minMergeFactor: reads(barcodeA) must be >= minMergeFactor * reads(barcodeB) for barcodeB to be merged with barcodeA
+# all strings made by deleting up to numDeletions bases - two strings within edit distance k share a k-deletion variant
 #---------------------------------------------------------------------------------------
-def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor = 6):
-    uniqueIDs = {}
-    totalCnt = 0
+def getDeletionVariants(bc, numDeletions = 2):
+    variants = set([bc])
+    last = variants
+    for i in xrange(numDeletions):
+        last = set(x[:j] + x[j+1:] for x in last for j in xrange(len(x)))
+        variants |= last
+    return variants
+
+#---------------------------------------------------------------------------------------
+# add a real barcode to the edit distance fallback index
+#---------------------------------------------------------------------------------------
+def addToIndex(index, bc, bcLen):
+    (deletionIndex, truncIndex) = index
+    for variant in getDeletionVariants(bc):
+        if variant not in deletionIndex:
+            deletionIndex[variant] = []
+        deletionIndex[variant].append(bc)
+    for truncated in (bc[3:], bc[0:bcLen-3]):
+        if truncated not in truncIndex:
+            truncIndex[truncated] = []
+        truncIndex[truncated].append(bc)
+
+#---------------------------------------------------------------------------------------
+# get real barcodes possibly within edit distance 2 of bcA, or matching it after a 3 base truncation
+#---------------------------------------------------------------------------------------
+def findCandidates(index, bcA, bcLen, rank):
+    ''' Look up fallback parent candidates for a barcode - a superset of the matches, to be checked
+    :returns list of barcodes in sortedBarcodeList order
+    '''
+    (deletionIndex, truncIndex) = index
+    candidates = set()
+    for variant in getDeletionVariants(bcA):
+        if variant in deletionIndex:
+            candidates.update(deletionIndex[variant])
+    if len(bcA) == bcLen-3 and bcA in truncIndex:
+        candidates.update(truncIndex[bcA])
+    return sorted(candidates, key = rank.get)
+
+#---------------------------------------------------------------------------------------
+# find the parent (real) barcode of each unique barcode, from barcode read counts only
+# bcCounts: dict of barcode -> number of reads, in the insertion order of the barcodes' first reads
+# (other params as in cluster() below)
+#---------------------------------------------------------------------------------------
+def getParents(bcCounts, bcLen, minRealNum, minRealFrac, minMergeFactor):
     prefixLen = bcLen/2
     misMatchCnt = [0] * (bcLen+1)
     distCnt = [0,0,0,0]
@@ -57,20 +156,13 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
     # garbage collector barcode
     allNBarcode = "N" * bcLen
 
-    # group reads by barcode
-    for (readID, barcode) in inPairs:
-        if barcode not in uniqueIDs:
-            uniqueIDs[barcode] = set()
-        uniqueIDs[barcode].add(readID)
-        totalCnt += 1
-
           # count how many times each unique barcode occurs, and get the read count for the most frequent barcode
     largestUniq = 0
     uniqBCCnts = {}
     barcodeParent = {}
     childBarcodes = {}
-    for barcode in uniqueIDs:
-        uniqBCCnts[barcode] = len(uniqueIDs[barcode])
+    for barcode in bcCounts:
+        uniqBCCnts[barcode] = bcCounts[barcode]
         barcodeParent[barcode] = "_UNKNOWN_" #ambiguous barcode
         childBarcodes[barcode] = []
         if uniqBCCnts[barcode] > largestUniq:
@@ -81,13 +173,22 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
         barcodeParent[allNBarcode] = "_SELF_"
         childBarcodes[allNBarcode] = []
 
+    # pack barcodes into integers, so most similarity checks are a XOR and a bit test
+    packedBarcodes = dict((bc, encode(bc)) for bc in uniqBCCnts)
+    def similar(bcB, bcA):
+        packedB = packedBarcodes[bcB]
+        packedA = packedBarcodes[bcA]
+        if packedA is not None and packedB is not None and packedA[2] == packedB[2]:
+            return isSimilarPacked(packedB, packedA, bcLen)
+        return isSimilar(bcB, bcA, bcLen)
+
     # iteration 1: mark barcodes as real or merge them with other barcodes if they are within  1 bp of a real barcode
     prefixHash = {}
     suffixHash = {}
+    bucketKeys = {}
     sortedBarcodeList = sorted(uniqBCCnts.iteritems(), key=lambda x: x[1] , reverse=True)
     for (bcA, bcACnt) in sortedBarcodeList:
-        prefix = bcA[:prefixLen]
-        suffix = bcA[0-prefixLen:]
+        (prefix, suffix) = bucketKeys[bcA] = getBucketKeys(bcA, packedBarcodes[bcA], prefixLen)
         if prefix not in prefixHash:
             prefixHash[prefix] = []
         if suffix not in suffixHash:
@@ -101,8 +202,8 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
             for bcB in realBCList:
                 if barcodeParent[bcB] != "_SELF_":
                     continue
-                (similar, misMatchPos) = isSimilar(bcB, bcA, bcLen)
-                if similar:
+                (isSim, misMatchPos) = similar(bcB, bcA)
+                if isSim:
                     barcodeParent[bcA] = bcB
                     childBarcodes[bcB].append(bcA)
                     misMatchCnt[misMatchPos] += bcACnt
@@ -114,16 +215,20 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
     # iteration 2: mark barcodes as real or merge them with other barcodes if they are within 1 bp of a another real or merged barcode
     level2Parent = {}
     level3Parent = {}
+
+    # index of the real barcodes that can be a parent in the edit distance fallback (at least minMergeFactor reads), built
+    # on first use - replaces a scan of the whole barcode list for each barcode
+    rank = dict((bc, i) for (i, (bc, bcCnt)) in enumerate(sortedBarcodeList))
+    fallbackIndex = None
     for (bcA, bcACnt) in sortedBarcodeList:
-        prefix = bcA[:prefixLen]
-        suffix = bcA[0-prefixLen:]
+        (prefix, suffix) = bucketKeys[bcA]
         if barcodeParent[bcA] != "_UNKNOWN_":
             continue
         for realBCList in (prefixHash[prefix], suffixHash[suffix]):
             for bcB in realBCList:
                 if barcodeParent[bcB] == "_SELF_":
-                    (similar, misMatchPos) = isSimilar(bcB, bcA, bcLen)
-                    if similar:
+                    (isSim, misMatchPos) = similar(bcB, bcA)
+                    if isSim:
                         barcodeParent[bcA] = bcB
                         childBarcodes[bcB].append(bcA)
                         misMatchCnt[misMatchPos] += bcACnt
@@ -131,8 +236,8 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
                         break
                     continue
                 elif barcodeParent[bcB] != "_UNKNOWN_":
-                    (similar, misMatchPos) = isSimilar(bcB, bcA, bcLen)
-                    if similar: # checking if bcA is within 1 bp of bcB
+                    (isSim, misMatchPos) = similar(bcB, bcA)
+                    if isSim: # checking if bcA is within 1 bp of bcB
                         if bcA not in level2Parent:
                             level2Parent[bcA] = set()
                             distCnt[2] += bcACnt
@@ -144,9 +249,13 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
 
         # do a complete global alignment if we do not still find similarity
         if barcodeParent[bcA] == "_UNKNOWN_" and bcA not in level2Parent:
-            for (bcB, bcBCnt) in sortedBarcodeList:
-                if barcodeParent[bcB] != "_SELF_":
-                    continue
+            if fallbackIndex is None:
+                fallbackIndex = ({}, {})
+                for (bcB, bcBCnt) in sortedBarcodeList:
+                    if barcodeParent[bcB] == "_SELF_" and bcBCnt >= minMergeFactor:
+                        addToIndex(fallbackIndex, bcB, bcLen)
+            for bcB in findCandidates(fallbackIndex, bcA, bcLen, rank):
+                bcBCnt = uniqBCCnts[bcB]
                 if bcBCnt < minMergeFactor * bcACnt:
                     break
                 editDistance = editdist.distance(bcB, bcA)
@@ -165,6 +274,8 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
                         break
         if barcodeParent[bcA] == "_UNKNOWN_" and bcA not in level2Parent and bcA not in level3Parent:
             barcodeParent[bcA] = "_SELF_" # not within 1-bp of any child of any real barcode: this must be real as well
+            if fallbackIndex is not None and bcACnt >= minMergeFactor:
+                addToIndex(fallbackIndex, bcA, bcLen)
 
     # clean up and make level2 parent as the full parent
     for bcA in uniqBCCnts:
@@ -187,11 +298,41 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
     #      for bcB in childBarcodes[bcA]:
     #         print("\t\t" + "\t".join((bcB, str(uniqBCCnts[bcB]))))
     #clusterInfo = []
-    #clusterInfo.append(totalCnt)
+    #clusterInfo.append(sum(bcCounts.itervalues()))
     #clusterInfo.extend(distCnt)
     #clusterInfo.extend(misMatchCnt)
     #print("cluster stats:\t" + "\t".join((str(x) for x in clusterInfo)))
 
+    # done
+    return (sortedBarcodeList, barcodeParent, childBarcodes)
+
+#---------------------------------------------------------------------------------------
+#function to cluster the barcodes for one amplicon
+# inPairs: list of (readID, barcode) tuples
+# bcLen: barcode length
+# minRealNum: minimum number of reads with a barcode for that barcode to be considered as real in the initial scan
+# minRealFrac: the barcode should a minimum of (minRealFrac * (no. of reads in the most frequent barcode) for it to be considered real in teh initial scan
+# minMergeFactor: reads(barcodeA) must be >= minMergeFactor * reads(barcodeB) for barcodeB to be merged with barcodeA
+#---------------------------------------------------------------------------------------
+def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor = 6):
+    uniqueIDs = {}
+    bcCounts = {}
+
+    # garbage collector barcode
+    allNBarcode = "N" * bcLen
+
+    # group reads by barcode
+    for (readID, barcode) in inPairs:
+        if barcode not in uniqueIDs:
+            uniqueIDs[barcode] = set()
+            bcCounts[barcode] = 0
+        uniqueIDs[barcode].add(readID)
+    for barcode in bcCounts:
+        bcCounts[barcode] = len(uniqueIDs[barcode])
+
+    # cluster the barcodes
+    (sortedBarcodeList, barcodeParent, childBarcodes) = getParents(bcCounts, bcLen, minRealNum, minRealFrac, minMergeFactor)
+
     # output
     readDict = {}
     for (bcA, bcACnt) in sortedBarcodeList:
@@ -215,3 +356,48 @@ def cluster(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor =
 
     # done
     return mts
+
+#---------------------------------------------------------------------------------------
+# same result as cluster(), without a set of read IDs for each barcode - for very deep windows
+#---------------------------------------------------------------------------------------
+def clusterStreamed(inPairs, bcLen, minRealNum = 3, minRealFrac = 0.1, minMergeFactor = 6):
+    # garbage collector barcode
+    allNBarcode = "N" * bcLen
+
+    # count reads by barcode (read IDs are unique within a window)
+    bcCounts = {}
+    for (readID, barcode) in inPairs:
+        if barcode not in bcCounts:
+            bcCounts[barcode] = 0
+        bcCounts[barcode] += 1
+
+    # cluster the barcodes
+    (sortedBarcodeList, barcodeParent, childBarcodes) = getParents(bcCounts, bcLen, minRealNum, minRealFrac, minMergeFactor)
+    uniqBCCnts = dict(sortedBarcodeList)
+
+    # barcodes of each molecule - the same dict order as the read lists in cluster(), so a barcode
+    # merged into two real barcodes goes to the same one
+    readDict = {}
+    for (bcA, bcACnt) in sortedBarcodeList:
+        if bcA == allNBarcode:
+            continue
+        if barcodeParent[bcA] == "_SELF_":
+            readDict[bcA] = [bcA]
+            readDict[bcA].extend(childBarcodes[bcA])
+
+    # molecule and its read count, by barcode
+    barcodeMts = {}
+    for (mt, barcodes) in readDict.iteritems():
+        mtInfo = (mt, sum((uniqBCCnts[bc] for bc in barcodes)))
+        for bc in barcodes:
+            if bc not in barcodeMts:
+                barcodeMts[bc] = mtInfo
+
+    # assign reads, streaming over the input again
+    mts = {}
+    for (readID, barcode) in inPairs:
+        if barcode in barcodeMts:
+            mts[readID] = barcodeMts[barcode]
+
+    # done
+    return mts
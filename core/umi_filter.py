@@ -8,6 +8,13 @@ from collections import defaultdict
 import pysam
 import editdist
 
+# our modules
+import bam_io
+import buckets
+import cpu_tokens
+import panel
+import scratch
+
 # constants for read pair accounting
 NUM_PRIMER_SIDE_NOT_MAPPED = 0
 NUM_RANDOM_SIDE_NOT_MAPPED = 1
@@ -37,7 +44,11 @@ def reverseComplement(seq):
 #---------------------------------------------------------------------
 # main function
 #---------------------------------------------------------------------
-def run(cfg,bamFileIn):
+def run(cfg,bamFileIn,bamFileOut=None):
+    ''' Filter read pair alignments and find the SPE primer of each pair
+    :param str/file bamFileIn: name-collated BAM file, or an open SAM stream from the aligner
+    :param str bamFileOut: BAM of the read pairs kept for UMI merging, if not None
+    '''
     print("umi_filter: starting...")
  
     # get parameters
@@ -46,7 +57,6 @@ def run(cfg,bamFileIn):
     endogenousLenMin = int(cfg.endogenousLenMin)
     tagNameUmiSeq    = cfg.tagNameUmiSeq   
     deleteLocalFiles = cfg.deleteLocalFiles
-    numCores         = cfg.numCores
     primer3Bases     = int(cfg.primer3Bases)
     maxSoftClipBp1   = min(primer3Bases + 4, 20) if primer3Bases != -1 else 20      # 16 + 4 = 20
     tagNamePrimer    = cfg.tagNamePrimer
@@ -58,10 +68,7 @@ def run(cfg,bamFileIn):
     # put primer seqs in two dictionaries, one for each read strand
     primerSeq = {}
     primerDicts = (defaultdict(list), defaultdict(list))
-    for line in open(primerFile, "r"):
-        (chrom, loc3, direction, primer) = line.strip().split("\t")
-        primerStrand = 0 if direction == "L" or direction == "0" else 1
-        loc3 = int(loc3)
+    for (chrom, loc3, primerStrand, primer) in panel.readPrimerFile(primerFile):
         key = (chrom,primerStrand,loc3)
         
         # debug check (need to modify code to handle same primer for multiple design loci)
@@ -73,12 +80,18 @@ def run(cfg,bamFileIn):
            
     print("# of primers:", len(primerSeq))
     
-    # open output files
-    fileout         = open(filePrefixOut + ".alignments.txt", "w")
+    # open output files - alignments go to per chrom/strand/genomic bin buckets, so umi_mark can sort them in memory
+    fileout         = buckets.Writer(filePrefixOut + ".buckets")
     fileoutNoPrimer = open(filePrefixOut + ".no-primer.txt" , "w")
  
-    # open BAM read alignment file
-    bam = pysam.Samfile(bamFileIn, "rb")
+    # open BAM read alignment file, or the SAM output of a running aligner
+    if isinstance(bamFileIn, str):
+        bam = bam_io.openBam(cfg, bamFileIn, "rb")
+    else:
+        bam = pysam.AlignmentFile(bamFileIn, "r")
+
+    # kept read pairs - fast compression, since umi_merge reads it straight back
+    bamOut = bam_io.openBam(cfg, bamFileOut, "wb", bam_io.LEVEL_TEMP, template = bam) if bamFileOut is not None else None
  
     # loop over read alignments
     primingSitesApprox = {}
@@ -272,10 +285,12 @@ def run(cfg,bamFileIn):
         cigar1 = "*" if read1.cigarstring == None else read1.cigarstring
         cigar2 = "*" if read2.cigarstring == None else read2.cigarstring
         
-        # write output (NOTE: field position hard coded in Linux sort below!)
+        # write output, bucketed by random fragmentation position (NOTE: field positions hard coded in umi_mark sort!)
         outvec = (chrom, loc5, primerStrand, primer, umiSeq, isIntendedSite, alignChrom, alignStrand, alignLocRand, alignLoc, readId, read1.pos, read1.aend, cigar1, read2.pos, read2.aend, cigar2)
-        fileout.write("|".join((str(x) for x in outvec)))
-        fileout.write("\n")      
+        fileout.write(alignChrom, alignStrand, alignLocRand, "|".join((str(x) for x in outvec)) + "\n")
+        if bamOut is not None:
+            bamOut.write(read1)
+            bamOut.write(read2)
         
         # count read depths for debug of multiple primers priming nearby
         key = (alignChrom, alignStrand, alignLoc, primer)
@@ -286,6 +301,8 @@ def run(cfg,bamFileIn):
    
     # done with bam input and the alignment output files
     bam.close()
+    if bamOut is not None:
+        bamOut.close()
     fileout.close()
     fileoutNoPrimer.close()
     
@@ -369,10 +386,12 @@ def run(cfg,bamFileIn):
     fileout.write("{0:.2f}\tread fragments with primer found, on-target percent\n".format(readPairsPrimerFoundOnTargetPct))
     fileout.close()
     
-    # sort the "no-primer" alignment file by locus (helpful for debug)
+    # sort the "no-primer" alignment file by locus (helpful for debug) - no cores are free if run on the aligner output
+    # inside the aligner's cores (the aligner is done by now), so the sort then uses one of those
     fileName = filePrefixOut + ".no-primer.txt"
-    cmd = "sort -k1,1 -k2,2n -k3,3n -k4,4n -k5,5n -t\| -T./ --parallel={1} {0} > {0}.tmp".format(fileName,numCores)
-    subprocess.check_call(cmd, shell=True)
+    with cpu_tokens.Cores(cfg) as numCores:
+        cmd = "sort -k1,1 -k2,2n -k3,3n -k4,4n -k5,5n -t\| -T{2} --parallel={1} {0} > {0}.tmp".format(fileName,max(1, numCores),scratch.getDir(cfg))
+        subprocess.check_call(cmd, shell=True)
     os.rename(fileName + ".tmp", fileName)
     
     # stop pipeline if very few reads on-target
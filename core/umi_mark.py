@@ -1,18 +1,43 @@
-import operator
+import heapq
+import itertools
+import multiprocessing
 import os
-import subprocess
+import shutil
 
 # our modules
+import buckets
+import cpu_tokens
 import umi_cluster
+import scratch
 
 # globals
 WINDOW_SIZE = 6
 WINDOW_OFFSET = 3
 
+#------------------------------------------------------------------------------------------------------------------------------------
+# one on-target read pair in the window buffers - positions as ints, output fields after isResample formatted once
+#------------------------------------------------------------------------------------------------------------------------------------
+class Read(object):
+    __slots__ = ("pChrom", "pStrand", "pLoc5", "primer", "umiSeq", "alignLocRand", "readId", "fragLen", "fieldsOut")
+
+    def __init__(self, vals):
+        ''' Make a read from an umi_filter alignment line split by "|" into 10 fields (the last is alignLocP onwards)
+        '''
+        self.pChrom       = intern(vals[0])
+        self.pStrand      = intern(vals[2])
+        self.pLoc5        = int(vals[1])          # primer-side genome position (from design)
+        self.primer       = intern(vals[3])
+        self.umiSeq       = vals[4]
+        self.alignLocRand = int(vals[8])          # random-side genome position
+        fieldsRest        = vals[9].strip()       # alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2
+        self.readId       = fieldsRest.split("|", 2)[1]
+        self.fragLen      = abs(self.pLoc5 - self.alignLocRand) + 1
+        self.fieldsOut    = "|".join((str(self.fragLen), vals[1], vals[3], vals[4], vals[8], fieldsRest))
+
 #------------------------------------------------------------------------------------------------------------------------------------
 # handle reads for one putative original input molecule
 #------------------------------------------------------------------------------------------------------------------------------------
-def handleOneMolecule(alignments, fileout1, fileout2):
+def handleOneMolecule(alignments, mtLoc, fileout1, fileout2):
 
     # nothing to do yet
     if len(alignments) == 0:
@@ -28,32 +53,26 @@ def handleOneMolecule(alignments, fileout1, fileout2):
     maxFragLen = 0
     fragPrimer = None
     
-    for vec in alignments:
- 
-        # unpack input
-        (pChrom, pStrand, mtLoc, mt, mtReads, fragLen, pLoc5, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = vec
-  
+    for (mt, mtReads, read) in alignments:
        
         # mark resampling internal-priming reads
         if mtReadIdx == 0:
-            pLoc5Original = pLoc5
-        isResample = 1 if pLoc5 != pLoc5Original else 0
+            pLoc5Original = read.pLoc5
+        isResample = 1 if read.pLoc5 != pLoc5Original else 0
         
-        # output
-        vec = (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, fragLen, pLoc5, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2)
-        fileout1.write("|".join((str(x) for x in vec)))
-        fileout1.write("\n")
+        # output (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, fragLen, pLoc5, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2)
+        fileout1.write("{}|{}|{}|{}|{}|{}|{}|{}|{}\n".format(read.pChrom, read.pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, read.fieldsOut))
         mtReadIdx += 1
   
         # identify primer causing longest fragment
-        if fragLen > maxFragLen:
-            maxFragLen = fragLen
-            fragPrimer = (primer,pLoc5)
+        if read.fragLen > maxFragLen:
+            maxFragLen = read.fragLen
+            fragPrimer = (read.primer, read.pLoc5)
             
    
     # write file used by sum.primer.umis.py to disk
     (primer, primerLoc5)  = fragPrimer
-    outvec = (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, maxFragLen, primer, primerLoc5)
+    outvec = (read.pChrom, read.pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, maxFragLen, primer, primerLoc5)
     outvec = (str(x) for x in outvec)
     fileout2.write("|".join(outvec))
     fileout2.write("\n")
@@ -80,19 +99,21 @@ def handleOneLocus(buffers, fileout1, fileout2):
     if len(buffer1) > 0:
     
         # buffer1: make UMI list including readId
-        umiSeqs = []
-        for vec in buffer1:
-            (pChrom, pLoc5, pStrand, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = vec
-            umiSeqs.append((readId, umiSeq))
+        umiSeqs = [(read.readId, read.umiSeq) for read in buffer1]
    
         # buffer1: cluster the UMI read seqs, save UMI centroid for each read
-        mts1 = umi_cluster.cluster(umiSeqs, 12)
+        if len(umiSeqs) > buffers.windowReadsMax:
+            # very deep window (e.g. primer-dimer hotspot) - cluster from UMI read counts, without a read ID set per UMI
+            print("umi_mark: {} reads in window at {}:{} strand {}, over umiWindowReadsMax - clustering UMIs by read counts".format(len(umiSeqs), buffer1[0].pChrom, buffers.end1 - WINDOW_SIZE, buffer1[0].pStrand))
+            mts1 = umi_cluster.clusterStreamed(umiSeqs, 12)
+        else:
+            mts1 = umi_cluster.cluster(umiSeqs, 12)
            
     # buffer0 - determine which window has the better UMI cluster
     alignmentsOut = []
     mtLoc = str(buffers.end1 - WINDOW_SIZE - WINDOW_OFFSET)
-    for vec in buffer0:
-        (pChrom, pLoc5, pStrand, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = vec 
+    for read in buffer0:
+        readId = read.readId
         
         # skip read if previously written out (but not physically removed from buffer0 list object, for speed)
         if readId not in mts0:
@@ -106,25 +127,23 @@ def handleOneLocus(buffers, fileout1, fileout2):
                 continue
             del(mts1[readId])
    
-        # save new alignment record from buffer0
-        fragLen = abs(pLoc5 - alignLocRand) + 1
-        vec = (pChrom, pStrand, mtLoc, mt, mtReads, fragLen, pLoc5, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2)
-        alignmentsOut.append(vec)
+        # save read from buffer0 with its UMI centroid
+        alignmentsOut.append((mt, mtReads, read))
         
     # buffer0 - sort reads by UMI centroid, frag len, primer loc, umi read
-    alignmentsOut.sort(key=operator.itemgetter(3,5,6,8), reverse=True)
+    alignmentsOut.sort(key=lambda x: (x[0], x[2].fragLen, x[2].pLoc5, x[2].umiSeq), reverse=True)
  
     # buffer0 - write read alignments to disk, by UMI in order to check for "bad cluster"
     mtLast = "foobar"
     alignments = []
     for vec in alignmentsOut:
-        (pChrom, pStrand, mtLoc, mt, mtReads, fragLen, pLoc5, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = vec
+        mt = vec[0]
   
         # new UMI centroid
         if mt != mtLast:
         
             # process UMI worth of reads
-            handleOneMolecule(alignments, fileout1, fileout2)
+            handleOneMolecule(alignments, mtLoc, fileout1, fileout2)
             
             # prepare for next UMI
             mtLast = mt
@@ -134,7 +153,7 @@ def handleOneLocus(buffers, fileout1, fileout2):
         alignments.append(vec)
   
     # process the final UMI
-    handleOneMolecule(alignments, fileout1, fileout2)
+    handleOneMolecule(alignments, mtLoc, fileout1, fileout2)
        
     # buffer0: clear for next iteration
     del(buffer0[:])
@@ -152,52 +171,85 @@ def handleOneLocus(buffers, fileout1, fileout2):
     # copy read alignment overlapping half of the two windows reads from the old buffer1 (now buffer0) into the new buffer1 
     buffer1 = buffers.buffer1
     buffer1Start = buffers.end1 - WINDOW_SIZE
-    for vec in buffers.buffer0:
-        (pChrom, pLoc5, pStrand, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = vec
-        if alignLocRand >= buffer1Start:
-            buffer1.append(vec)
+    for read in buffers.buffer0:
+        if read.alignLocRand >= buffer1Start:
+            buffer1.append(read)
    
 #----------------------------------------------------------------------------------------------------------------------------------------
-# main - mark putative input molecules using BOTH the partially-error-corrected UMI sequence AND the random fragmentation genome position
+# sort key of a umi_filter alignment line within a bucket - (alignLocRand, primerLoc5), the same as GNU sort with SORT_KEYS
 #----------------------------------------------------------------------------------------------------------------------------------------
-def run(cfg):
-    print("umi_mark starting...")
- 
-    # get params
-    readSet  = cfg.readSet
-    numCores = cfg.numCores
- 
-    # sort read alignments by R2 random fragmentation location (used to identify putative input molecules, in addition to UMI tag)
-    fileNameIn = readSet + ".umi_filter.alignments.txt"
-    cmd = "sort -k7,7 -k8,8n -k9,9n -k2,2n -t\| -T./ --parallel={1} {0} > {0}.tmp.txt".format(fileNameIn, numCores)  # sort order is (alignChrom, alignStrand, alignLocRandand, primerLoc5)
-    subprocess.check_call(cmd, shell=True)
-    os.rename(fileNameIn + ".tmp.txt", fileNameIn)
-    print("umi_mark: done sorting read alignments by random fragmentation position")
-    
+SORT_KEYS = "-k9,9n -k2,2n -t\|"
+def getSortKey(line):
+    vals = line.split("|", 9)
+    return (int(vals[8]), int(vals[1]))
+
+#----------------------------------------------------------------------------------------------------------------------------------------
+# group the alignment buckets into blocks that can be marked independently
+#----------------------------------------------------------------------------------------------------------------------------------------
+def getBlocks(bucketList, blockSize):
+    ''' Group consecutive buckets into blocks, each starting where markBlock() resets its window state anyway -
+    a chrom/strand change, or a gap of WINDOW_SIZE + WINDOW_OFFSET or more to the previous bucket (the window end is
+    at most WINDOW_SIZE past the last read, so such a read is past the window even after it slides)
+    :param list bucketList: umi_filter alignment buckets from buckets.readIndex(), in sort order
+    :param int blockSize: minimum block size in bytes
+    :returns list of blocks, each a list of buckets of one chrom/strand
+    '''
+    blocks = []
+    block = []
+    blockBytes = 0
+    for bucket in bucketList:
+        (chrom, strand, binNum, fileName, numBytes, locMin, locMax) = bucket
+        if len(block) > 0:
+            bucketLast = block[-1]
+            if (chrom, strand) != bucketLast[:2] or (blockBytes >= blockSize and locMin - bucketLast[6] >= WINDOW_SIZE + WINDOW_OFFSET):
+                blocks.append(block)
+                block = []
+                blockBytes = 0
+        block.append(bucket)
+        blockBytes += numBytes
+    if len(block) > 0:
+        blocks.append(block)
+    return blocks
+
+#----------------------------------------------------------------------------------------------------------------------------------------
+# read the lines of a block, each bucket sorted by random fragmentation position
+#----------------------------------------------------------------------------------------------------------------------------------------
+def readBlock(block, tempDir):
+    for bucket in block:
+        for line in buckets.readSorted(bucket, getSortKey, SORT_KEYS, tempDir):
+            yield line
+
+#----------------------------------------------------------------------------------------------------------------------------------------
+# mark molecules in one block of the sorted alignments - runs in a worker process
+#----------------------------------------------------------------------------------------------------------------------------------------
+def markBlock(args):
+    (block, tempDir, windowReadsMax, fileNameOut1, fileNameOut2) = args
+
     # open output file
-    fileout1 = open(readSet + ".umi_mark.alignments.txt"  , "w")
-    fileout2 = open(readSet + ".umi_mark.for.sum.primer.txt","w")
+    fileout1 = open(fileNameOut1, "w")
+    fileout2 = open(fileNameOut2, "w")
  
-    # read on-target read pair alignment positions (already sorted by random fragment locus), buffer by locus
+    # read on-target read pair alignment positions (sorted by random fragment locus), buffer by locus
     buffers = lambda:0
     buffers.buffer0 = []
     buffers.buffer1 = []
     buffers.mts0 = {}
     buffers.mts1 = {}
     buffers.end1 = None
+    buffers.windowReadsMax = windowReadsMax
     chromStrandLast = None
-    for line in open(fileNameIn, "r"):
-        # unpack read line
-        (pChrom, pLoc5, pStrand, primer, umiSeq, isIntendedSite, alignChrom, alignStrand, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = line.strip().split("|")
+    for line in readBlock(block, tempDir):
+        # split read line - fields from alignLocP on are only needed for output
+        vals = line.split("|", 9)
   
         # skip over read alignments from off-target priming
-        if isIntendedSite == "0":
+        if vals[5] == "0":
             continue
          
-        # parse line
-        pLoc5 = int(pLoc5)          # primer-side genome position (from design)
-        alignLocRand = int(alignLocRand)  # random-side genome position
-        chromStrand = pChrom + "-" + pStrand  # chrom and strand combined
+        # parse line (removes redundant fields - alignChrom, alignStrand match the primer design)
+        read = Read(vals)
+        alignLocRand = read.alignLocRand
+        chromStrand = (read.pChrom, read.pStrand)  # chrom and strand combined
         
         # start new buffer if this is the first read pair alignment record
         if buffers.end1 == None:
@@ -218,9 +270,8 @@ def run(cfg):
                 if chromStrand != chromStrandLast:
                     chromStrandLast = chromStrand
            
-        # removed redundant fields (alignChrom, alignStrand match the primer design), save the current read
-        vec = (pChrom, pLoc5, pStrand, primer, umiSeq, alignLocRand, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2)
-        buffers.buffer1.append(vec)
+        # save the current read
+        buffers.buffer1.append(read)
   
     # process last two windows
     if buffers.end1 != None:
@@ -230,4 +281,76 @@ def run(cfg):
     # done
     fileout1.close()
     fileout2.close()
+
+#----------------------------------------------------------------------------------------------------------------------------------------
+# read the alignment output of one block as (mtLoc, line), sorted - mtLoc only increases within a block of one chrom/strand,
+# so only the lines of one molecule locus need sorting
+#----------------------------------------------------------------------------------------------------------------------------------------
+def readMarked(fileName):
+    group = []
+    mtLocLast = None
+    for line in open(fileName, "r"):
+        mtLoc = int(line.split("|", 3)[2])
+        if mtLoc != mtLocLast:
+            group.sort()
+            for x in group:
+                yield x
+            del(group[:])
+            mtLocLast = mtLoc
+        group.append((mtLoc, line))
+    group.sort()
+    for x in group:
+        yield x
+
+#----------------------------------------------------------------------------------------------------------------------------------------
+# main - mark putative input molecules using BOTH the partially-error-corrected UMI sequence AND the random fragmentation genome position
+#----------------------------------------------------------------------------------------------------------------------------------------
+def run(cfg):
+    print("umi_mark starting...")
+ 
+    # get params
+    readSet  = cfg.readSet
+    windowReadsMax = int(getattr(cfg, "umiWindowReadsMax", 20000))
+ 
+    # umi_filter bucketed the read alignments by R2 random fragmentation location (used to identify putative input molecules,
+    # in addition to UMI tag) - each bucket is sorted in memory as it is read, giving (alignChrom, alignStrand, alignLocRand, primerLoc5) order
+    bucketList = buckets.readIndex(readSet + ".umi_filter.buckets")
+
+    # split into independent blocks, about 4 per core for load balance
+    blockSize = max(1 << 20, sum((x[4] for x in bucketList)) / (4 * int(cfg.numCores)))
+    blocks = getBlocks(bucketList, blockSize)
+    jobs = []
+    for (i, block) in enumerate(blocks):
+        fileNamesOut = [scratch.getFile(cfg, "{}.umi_mark.{}.{}.txt".format(readSet, x, i)) for x in ("alignments", "for.sum.primer")]
+        jobs.append([block, scratch.getDir(cfg), windowReadsMax] + fileNamesOut)
+
+    # mark molecules in each block, in parallel
+    with cpu_tokens.Cores(cfg, min(len(jobs), int(cfg.numCores)), 1) as numCores:
+        if numCores > 1:
+            pool = multiprocessing.Pool(numCores)
+            pool.map(markBlock, jobs, chunksize = 1)
+            pool.close()
+            pool.join()
+        else:
+            map(markBlock, jobs)
+    print("umi_mark: done marking molecules in {} blocks".format(len(jobs)))
+
+    # merge the alignment outputs of the blocks of each chrom by molecule locus - (pChrom, mtLoc) order, used by umi_depths
+    fileout = open(readSet + ".umi_mark.alignments.txt", "w")
+    for (chrom, chromJobs) in itertools.groupby(jobs, lambda job: job[0][0][0]):
+        chromJobs = list(chromJobs)
+        for (mtLoc, line) in heapq.merge(*[readMarked(job[3]) for job in chromJobs]):
+            fileout.write(line)
+        for job in chromJobs:
+            os.remove(job[3])
+    fileout.close()
+
+    # concatenate the primer outputs in block order - the same as marking all buckets at once
+    fileout = open(readSet + ".umi_mark.for.sum.primer.txt", "w")
+    for job in jobs:
+        IN = open(job[4], "r")
+        shutil.copyfileobj(IN, fileout)
+        IN.close()
+        os.remove(job[4])
+    fileout.close()
     print("umi_mark: done")
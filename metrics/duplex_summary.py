@@ -4,6 +4,9 @@ import sys
 import pysam
 import numpy as np
 
+# our modules
+import core.bam_io
+
 # metrics
 TOTAL_UMIS = 0
 NUM_UMIS_NN_ONLY  = 1
@@ -52,7 +55,7 @@ def run(cfg):
     
     metric_vals     = [0]*NUM_METRICS_TOTAL
 
-    IN = pysam.AlignmentFile(inbam,"rb")
+    IN = core.bam_io.openBam(cfg,inbam,"rb")
 
     duplex_by_umi = defaultdict(lambda:defaultdict(int))
     umi_reads     = defaultdict(lambda:defaultdict(int))
@@ -2,56 +2,49 @@ import sys
 
 import numpy as np
 
+# our modules
+import metrics.umi_stream
+
+
+class Accumulator(object):
+    ''' Fragment lengths of the UMIs with 1, 2 and 3 read fragments - for metrics.umi_stream
+    '''
+    def __init__(self):
+        self.frag_lens = ([], [], [])
+
+    def addMolecule(self, molecule):
+        num_reads = molecule.numReads
+        if 1 <= num_reads <= 3: # this is read frags
+            self.frag_lens[num_reads - 1].append(molecule.fragLen)
+
 
 def run(cfg):
     '''
     '''
     print('starting fraglen_by_rpu...')
-    
-    # input
-    readset                 = cfg.readSet
-    umi_mark_for_sum_primer = readset + '.umi_mark.for.sum.primer.txt'
+    accumulator = Accumulator()
+    metrics.umi_stream.run(cfg, [accumulator])
+    write(cfg, accumulator)
+
+
+def write(cfg, accumulator):
+    '''
+    '''
+    readset = cfg.readSet
 
     # output
     outfile = readset + '.fraglen_by_rpu.distrib.txt'
     out_header = "|".join(
         ("read set", "read frags per umi", "num umis", "num read frags" , "mean frag len", \
          "25th percentile frag len", "50th percentile frag len", "75th percentile frag len"))
-    
-    
-    umis_with_1_readfrag = []
-    umis_with_2_readfrag = []
-    umis_with_3_readfrag = []
-    umis_1rpu = 0
-    read_frags_1rpu = 0
-    umis_2rpu = 0
-    read_frags_2rpu = 0
-    umis_3rpu = 0
-    read_frags_3rpu = 0
-
-    with open(umi_mark_for_sum_primer, "r") as IN:
-        for line in IN:
-            chrom,strand,umi_loc,umi,num_reads,num_alignments,mt_read_idx,is_resample,frag_len,primer,primer_loc5 = line.strip("\n").split("|")
-
-            loc3 = int(primer_loc5) + len(primer) - 1 if strand == "0" else int(primer_loc5) - len(primer)
-            molecule = "-".join([chrom, strand, umi_loc, umi])
-            num_reads = int(num_reads)
-
-            if num_reads == 1: # this is read frags
-                umis_with_1_readfrag.append(int(frag_len))
-                umis_1rpu += 1
-                read_frags_1rpu += num_reads
-
-
-            elif num_reads == 2: # this is read frags
-                umis_with_2_readfrag.append(int(frag_len))
-                umis_2rpu += 1
-                read_frags_2rpu += num_reads
-
-            elif num_reads == 3: # this is read frags
-                umis_with_3_readfrag.append(int(frag_len))
-                umis_3rpu += 1
-                read_frags_3rpu += num_reads
+
+    (umis_with_1_readfrag, umis_with_2_readfrag, umis_with_3_readfrag) = accumulator.frag_lens
+    umis_1rpu = len(umis_with_1_readfrag)
+    read_frags_1rpu = umis_1rpu
+    umis_2rpu = len(umis_with_2_readfrag)
+    read_frags_2rpu = 2 * umis_2rpu
+    umis_3rpu = len(umis_with_3_readfrag)
+    read_frags_3rpu = 3 * umis_3rpu
 
     umis_with_1_readfrag = np.array(umis_with_1_readfrag)
     umis_with_2_readfrag = np.array(umis_with_2_readfrag)
@@ -3,6 +3,9 @@ import sys
 
 import pysam
 
+# our modules
+import core.bam_io
+
 
 def run(cfg):
     '''
@@ -24,7 +27,7 @@ def run(cfg):
          "NN Only UMIs", "Duplex UMIs (1 read frag CC and TT)"])
 
     # store duplex tag for each UMI
-    IN = pysam.AlignmentFile(inbam,"rb")
+    IN = core.bam_io.openBam(cfg,inbam,"rb")
     duplex_by_umi = defaultdict(lambda:defaultdict(int))    
     for read in IN:
         umi = read.get_tag(cfg.tagNameUmi)
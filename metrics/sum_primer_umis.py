@@ -1,6 +1,10 @@
 import math
 from collections import defaultdict
 
+# our modules
+import core.panel
+import metrics.umi_stream
+
 #----------------------------------------------------------------------------
 # get read-per-barcode metrics
 def getRpmtMetrics(readCounts):
@@ -39,26 +43,35 @@ def getRpmtMetrics(readCounts):
     return outvec
  
  
+#----------------------------------------------------------------------------
+# accumulate MT supporting read counts by primer - for metrics.umi_stream
+class Accumulator(object):
+    def __init__(self, cfg):
+        # read primers, init data structure
+        self.primers = {}
+        for (chrom, loc3, strand, primer) in core.panel.readPrimerFile(cfg.primerFile):
+            loc5 = loc3 - len(primer) + 1 if strand == 0 else loc3 + len(primer) - 1
+            self.primers[primer] = (strand, chrom, loc5, loc3, [])
+
+    def addMolecule(self, molecule):
+        self.primers[molecule.primer][-1].append(molecule.numReads)
+
 #----------------------------------------------------------------------------
 # main function
 def run(cfg):
     print("sum_primer_umis starting...")
+
+    # get MTs and supporting read counts from the umi_mark alignments
+    accumulator = Accumulator(cfg)
+    metrics.umi_stream.run(cfg, [accumulator])
+    write(cfg, accumulator)
+
+#----------------------------------------------------------------------------
+# write the primer-level metrics file
+def write(cfg, accumulator):
     readSet = cfg.readSet
- 
-    # read primers, init data structure
-    primers = {}
-    for line in open(cfg.primerFile, "r"):
-        (chrom, loc3, direction, primer) = line.strip().split("\t")
-        strand = 0 if direction == "L" or direction == "0" else 1
-        loc3 = int(loc3)
-        loc5 = loc3 - len(primer) + 1 if strand == 0 else loc3 + len(primer) - 1
-        primers[primer] = (strand, chrom, loc5, loc3, [])
-  
-    # get MTs and supporting read counts from disk
-    for line in open(readSet + ".umi_mark.for.sum.primer.txt", "r"):
-        (chrom, strand, umiLoc, umi, numReads, numAlignments, mtReadIdx, isResample, fragLen, primer, primerLoc5) = line.strip().split("|")
-        primers[primer][-1].append(int(numReads))
-  
+    primers = accumulator.primers
+
     # define metric names
     metricNames = ("UMIs", "read fragments"
     ,"read fragments per UMI, mean"
@@ -1,3 +1,7 @@
+# our modules
+import core.buckets
+import core.panel
+
 def run(cfg):
     print("sum_specificity starting...")
     readSet = cfg.readSet
@@ -12,7 +16,7 @@ def run(cfg):
     # get read depth at all primer sites (WARNING: this is memory unbounded! fix later.)
     siteDepthsOnT  = {}
     siteDepthsOffT = {}
-    for line in open(readSet + ".umi_filter.alignments.txt", "r"):
+    for line in core.buckets.readLines(readSet + ".umi_filter.buckets"):
         (pChrom, pLoc5, pStrand, primer, barcode, isIntendedSite, alignChrom, alignStrand, alignLoc1, alignLoc2, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = line.strip().split("|")
   
         (pLoc5, pStrand, alignLoc, alignStrand, isIntendedSite) = (int(x) for x in (pLoc5, pStrand, alignLoc2, alignStrand, isIntendedSite))
@@ -57,10 +61,7 @@ def run(cfg):
             stacksOffT[primer] = vec[0:10]
    
     # read primers, output read depths
-    for line in open(cfg.primerFile, "r"):
-        (chrom, loc3, direction, primer) = line.strip().split("\t")
-        strand = 0 if direction == "L" or direction == "0" else 1
-        loc3 = int(loc3)
+    for (chrom, loc3, strand, primer) in core.panel.readPrimerFile(cfg.primerFile):
         loc5 = loc3 - len(primer) + 1 if strand == 0 else loc3 + len(primer) - 1
         
         # start outvec
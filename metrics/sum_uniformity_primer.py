@@ -1,34 +1,11 @@
+# our modules
+import metrics.uniformity
+
 #------------------------------------------------------------------------------------------
 def getUniformityMetrics(depths):
 
-    # get total cumulative depth
-    depthTotal = sum(depths)
-    
-    # if zero depth at all primers/sites, return zeros
-    if depthTotal == 0:
-        outvec = [0] * 5
-        return tuple(outvec)
-     
-    # sort
-    depths.sort()
-    
-    # get mean depth
-    depthMean = 1.00 * depthTotal / len(depths)
-       
-    # get % of mean metrics
-    pctGtVec = []
-    for pct in (5.0, 10.0, 20.0, 30.0):
-        for idx in range(len(depths)):
-            pctMean = 100.00 * depths[idx] / depthMean
-            if pctMean >= pct:
-                x = 100.00 - (100.00 * idx) / len(depths)
-                pctGtVec.append(x)
-                break
-    
-    # done
-    outvec = [depthMean]
-    outvec.extend(pctGtVec)
-    return tuple(outvec)
+    # one depth per primer - (mean, % of primers >= 5, 10, 20, 30% of mean), zeros if zero depth at all primers
+    return metrics.uniformity.getUniformityMetrics(depths)
     
 #------------------------------------------------------------------------------------------
 def run(cfg):
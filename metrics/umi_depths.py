@@ -1,6 +1,25 @@
+import math
 import os
 import os.path
-import subprocess
+
+# 3rd party
+import numpy as np
+import scipy.special
+
+# our modules
+import core.panel
+import metrics.umi_stream
+import metrics.uniformity
+
+# initial size of a locus island coverage array - grows as needed
+ISLAND_BASES_MIN = 4096
+
+# LOD model - average prediction index for each barcode, set to 3.5, which is the PI for a 8-read pair barcode with
+# 7 read pairs being the true allele - and the root finding tolerance of R uniroot(), and the LOD percentiles reported
+PI_PER_BARCODE = 3.5
+DBL_EPSILON = 2.220446049250313e-16
+LOD_TOL = DBL_EPSILON ** 0.25
+LOD_QUANTILES = (1, 5, 10, 50, 90, 95, 99)
 
 #------------------------------------------------------------------------
 # bed merge
@@ -83,10 +102,7 @@ def getTargetBed(cfg):
     # if no ROI file, use primer regions
     else:
         targetWindowSize = 150
-        for line in open(cfg.primerFile, "r"):
-            (chrom, loc3, direction, primer) = line.strip().split("\t")
-            strand = 0 if direction == "L" or direction == "0" else 1
-            loc3 = int(loc3)
+        for (chrom, loc3, strand, primer) in core.panel.readPrimerFile(cfg.primerFile):
             if strand == 0:
                 loc5 = loc3 - len(primer) + 1
                 bedRow = (chrom, loc3+1,loc5+targetWindowSize)
@@ -190,38 +206,18 @@ def getDepthsInRoi(bedTarget,depthFile):
 #------------------------------------------------------------------------------------------
 def getUniformityMetrics(cfg,bedgraphDepths,fileout,metricType):
 
-    # make depth vector - as big as the target region
-    depths = []
-    for chrom, locL, locR, depth in bedgraphDepths:
-        for loc in range(locL,locR):
-            depths.append(depth)
-   
-    # get total cummulative depth
-    depthTotal = sum(depths)
+    # get metrics from the (length, depth) runs of the bedgraph - no per-base depth vector
+    outvec = metrics.uniformity.getUniformityMetrics([x[3] for x in bedgraphDepths], [x[2] - x[1] for x in bedgraphDepths])
     
     # if zero depth at all primers/sites, return zeros
-    if depthTotal == 0:
-        outvec = [0] * 5
+    if outvec[0] == 0:
         cfg.umiDepthMean = 0
-        return tuple(outvec)
+        return outvec
      
-    # sort
-    depths.sort()
-    
     # get mean depth        
-    depthMean = 1.00 * depthTotal / len(depths)
+    depthMean = outvec[0]
     if metricType == "UMI":
         cfg.umiDepthMean = depthMean # for v2 since getLodEstimates() is called for only v1
-       
-    # get % of mean metrics
-    outvec = [depthMean]
-    for pct in (5.0, 10.0, 20.0, 30.0):
-        for idx in range(len(depths)):
-            pctMean = 100.00 * depths[idx] / depthMean
-            if pctMean >= pct:
-                x = 100.00 - (100.00 * idx) / len(depths)
-                outvec.append(x)
-                break
     
     # write to summary file
     metricNames = ("mean"
@@ -232,6 +228,100 @@ def getUniformityMetrics(cfg,bedgraphDepths,fileout,metricType):
     for metricVal, metricName in zip(outvec, metricNames):
         fileout.write("{:.2f}\t{} {} depth\n".format(metricVal,metricName,metricType))
      
+#------------------------------------------------------------------------
+# find a root of f in [a, b] - port of R uniroot() (Brent's zeroin, R_zeroin2), so roots match the R LOD script
+#------------------------------------------------------------------------
+def findRoot(f,a,b,tol=LOD_TOL,maxit=1000):
+    fa = f(a)
+    fb = f(b)
+
+    # uniroot stops if the end points are not of opposite sign
+    if fa * fb > 0:
+        return None
+    if fa == 0.0:
+        return a
+    if fb == 0.0:
+        return b
+    c = a
+    fc = fa
+    for it in xrange(maxit + 1):
+        prevStep = b - a
+        if abs(fc) < abs(fb):
+            # swap data for b to be the best approximation
+            a = b;  b = c;  c = a
+            fa = fb;  fb = fc;  fc = fa
+        tolAct = 2 * DBL_EPSILON * abs(b) + tol / 2
+        newStep = (c - b) / 2
+        if abs(newStep) <= tolAct or fb == 0.0:
+            return b
+
+        # try interpolation, if the previous step was large enough and in the right direction
+        if abs(prevStep) >= tolAct and abs(fa) > abs(fb):
+            cb = c - b
+            if a == c:
+                # linear interpolation
+                t1 = fb / fa
+                p = cb * t1
+                q = 1.0 - t1
+            else:
+                # inverse quadratic interpolation
+                q = fa / fc;  t1 = fb / fc;  t2 = fb / fa
+                p = t2 * (cb * q * (q - t1) - (b - a) * (t1 - 1.0))
+                q = (q - 1.0) * (t1 - 1.0) * (t2 - 1.0)
+            if p > 0:
+                q = -q
+            else:
+                p = -p
+            if p < (0.75 * cb * q - abs(tolAct * q) / 2) and p < abs(prevStep * q / 2):
+                newStep = p / q
+
+        # step at least the tolerance
+        if abs(newStep) < tolAct:
+            newStep = tolAct if newStep > 0 else -tolAct
+        a = b;  fa = fb
+        b += newStep;  fb = f(b)
+        if (fb > 0 and fc > 0) or (fb < 0 and fc < 0):
+            c = a;  fc = fa
+    return b
+
+#------------------------------------------------------------------------
+# LOD of a UMI depth - smallest allele fraction with P(# of variant UMIs >= barcodesNeeded) >= 0.95
+#------------------------------------------------------------------------
+def getLod(umiDepth,barcodesNeeded):
+    # requires at least 5 UMIs on the locus - and fewer UMIs than needed never reach it (uniroot fails in R)
+    if umiDepth < 5 or barcodesNeeded > umiDepth:
+        return 1.0
+    lod = findRoot(lambda p: scipy.special.bdtr(barcodesNeeded - 1, umiDepth, p) - 0.05, 0.0, 1.0)
+    return 1.0 if lod is None else round(lod, 4)
+
+#------------------------------------------------------------------------
+# format a number as R as.character() / paste() does - up to 15 significant digits, fixed or scientific, whichever is shorter
+#------------------------------------------------------------------------
+def formatR(x):
+    if x == 0:
+        return "0"
+    val = float("{:.15g}".format(x))
+    for numDigits in range(1, 16):
+        if float("{:.{}g}".format(x, numDigits)) == val:
+            break
+    sci = "{:.{}e}".format(x, numDigits - 1)
+    exponent = int(sci.split("e")[1])
+    fixed = "{:.{}f}".format(x, max(0, numDigits - 1 - exponent))
+    return fixed if len(fixed) <= len(sci) else sci
+
+#------------------------------------------------------------------------
+# quantiles as R quantile() type 7
+#------------------------------------------------------------------------
+def getQuantiles(vals,probs):
+    vals = np.sort(vals)
+    index = 1 + (len(vals) - 1) * np.asarray(probs)
+    lo = np.floor(index).astype(np.int64)
+    hi = np.ceil(index).astype(np.int64)
+    h = index - lo
+    qs = vals[lo - 1]
+    qsHi = vals[hi - 1]
+    return np.where((h > 0) & (qsHi != qs), (1 - h) * qs + h * qsHi, qs)
+
 #------------------------------------------------------------------------
 # get LOD estimates
 #------------------------------------------------------------------------
@@ -239,13 +329,6 @@ def getLodEstimates(cfg,fileoutSummary,bedgraphDepths):
     # get read set
     readSet = cfg.readSet
  
-    # write bedgraph to disk for use by R script, without track name
-    fileout = open(readSet + ".umi_depths.lod.txt", "w")
-    for row in bedgraphDepths:
-        fileout.write("|".join((str(x) for x in row)))
-        fileout.write("\n")
-    fileout.close()
- 
     # compute mean MT depth
     mtSum = 0
     bpSum = 0
@@ -257,99 +340,123 @@ def getLodEstimates(cfg,fileoutSummary,bedgraphDepths):
     cfg.umiDepthMean = umiDepthMean
     print("umi_depths: mean UMI depth over target region:", umiDepthMean)
  
-    # get path to this script - R script in same dir
-    scriptName = os.path.abspath(__file__)
-    (scriptName, ext) = os.path.splitext(scriptName)
-    scriptName = scriptName + "_lod.R"
- 
-    # call R script for LOD estimate
-    fileInName  = readSet + ".umi_depths.lod.txt"
-    fileOutName = readSet + ".umi_depths.variant-calling-lod.bedgraph" 
-    cmd = "Rscript {} {} {} {} {}".format(scriptName, umiDepthMean, fileInName, fileOutName, readSet)
-    subprocess.check_call(cmd,shell=True) 
+    # compute the cutoff and the number of variant barcodes needed to call, based on 20 FP/Mb
+    cutoff = 14.0 + 0.012 * umiDepthMean
+    barcodesNeeded = int(math.ceil(cutoff / PI_PER_BARCODE))
+    print("umi_depths: LOD cutoff: {} barcodes needed: {}".format(cutoff, barcodesNeeded))
+
+    # LOD for each ROI interval - solved once per distinct UMI depth
+    (depths, idxDepths) = np.unique(np.array([x[3] for x in bedgraphDepths], dtype = np.int64), return_inverse = True)
+    lods = np.array([getLod(int(x), barcodesNeeded) for x in depths])[idxDepths]
+
+    # write LOD bedgraph - runs of intervals with the same LOD on a chrom (gaps included) are collapsed, and each
+    # row starts 1 bp before the right end of its first interval, as in the R script
+    chroms = [x[0] for x in bedgraphDepths]
+    isRunStart = np.ones(len(lods), dtype = np.bool_)
+    isRunStart[1:] = (lods[1:] != lods[:-1]) | np.array([chroms[i] != chroms[i-1] for i in xrange(1, len(chroms))], dtype = np.bool_)
+    runStarts = np.flatnonzero(isRunStart).tolist()
+    runEnds = runStarts[1:] + [len(lods)]
+    fileout = open(readSet + ".umi_depths.variant-calling-lod.bedgraph", "w")
+    fileout.write("track type=bedGraph name='{}.variant-calling-lod'\n".format(readSet))
+    for (idxL, idxR) in zip(runStarts, runEnds):
+        numDigits = 3 if idxR == len(lods) else 5
+        outvec = (chroms[idxL], bedgraphDepths[idxL][2] - 1, bedgraphDepths[idxR - 1][2], formatR(round(lods[idxL], numDigits)))
+        fileout.write("\t".join((str(x) for x in outvec)))
+        fileout.write("\n")
+    fileout.close()
     
     # format the LOD percentiles and write to summary file
-    for line in open(readSet + ".umi_depths.variant-calling-lod.bedgraph.quantiles.txt","r"):
-        (metricName, metricVal) = line.strip().split("|")
-        metricName = int(metricName.replace("%",""))
-        metricVal = float(metricVal)
+    for (metricName, metricVal) in zip(LOD_QUANTILES, getQuantiles(lods, [0.01 * x for x in LOD_QUANTILES])):
         thorst = "st" if metricName == 1 else "th"
         fileoutSummary.write("{:6.4f}\t{:2d}{} percentile estimated minimum detectible allele fraction (LOD)\n".format(metricVal, metricName,thorst))
-  
-    # remove the temporary files
-    os.remove(readSet + ".umi_depths.lod.txt")
-    os.remove(readSet + ".umi_depths.variant-calling-lod.bedgraph.quantiles.txt")
  
 #------------------------------------------------------------------------
-# output one locus for UMI depth bedgraph   
+# read fragment coverage of one locus island, for the UMI depth bedgraph
 #------------------------------------------------------------------------
-def handleOneLocus(bedIn,fileout):
+class Island(object):
+    def __init__(self,chrom):
+        self.chrom = chrom
+        self.start = None
+        self.diff = None    # depth change at each position of the island span
+        self.ends = None    # fragment start/end at each position - bedgraph rows break there, even if the depth does not change
 
-    # done if nothing to do yet
-    if len(bedIn) == 0:
-        return
-  
-    # prep input
-    vec = []
-    for row in bedIn:
-        (chrom, locL, locR) = row
-        vec.append((chrom, locL,  1))
-        vec.append((chrom, locR, -1))
-    vec.sort()
-    
-    # count coverage depth
-    depthVec = []
-    depthNet = 0
-    for (chrom, loc, depth) in vec:
-        depthNet += depth
-        depthVec.append((chrom, loc, depthNet))
-        
-    # convert to bedgraph format
-    bedgraph = []
-    (chrom_, loc_, depth_) = depthVec[0]
-    for (chrom, loc, depth) in depthVec[1:]:
-        if loc != loc_ or chrom != chrom_:
-            bedgraph.append((chrom, loc_, loc, depth_))
-        chrom_ = chrom
-        loc_   = loc
-        depth_ = depth
-        
-    # output
-    for row in bedgraph:
-        fileout.write("\t".join((str(x) for x in row)))
-        fileout.write("\n")
+    def grow(self,locL,locR):
+        ''' Reallocate the arrays to cover [locL, locR), doubling toward the side that overflowed
+        '''
+        if self.diff is None:
+            (spanL, spanR) = (locL, locR)
+        else:
+            spanL = min(locL, self.start)
+            spanR = max(locR, self.start + len(self.diff))
+        size = max(ISLAND_BASES_MIN, 2 * (spanR - spanL))
+        start = spanR - size if self.diff is not None and locL < self.start else spanL
+        diff = np.zeros(size, dtype = np.int32)
+        ends = np.zeros(size, dtype = np.bool_)
+        if self.diff is not None:
+            offset = self.start - start
+            diff[offset:offset + len(self.diff)] = self.diff
+            ends[offset:offset + len(self.ends)] = self.ends
+        (self.start, self.diff, self.ends) = (start, diff, ends)
+
+    def add(self,locL,locR):
+        # make room - fragments may extend the island either way
+        (lo, hi) = (locL, locR + 1) if locL <= locR else (locR, locL + 1)
+        if self.diff is None or lo < self.start or hi > self.start + len(self.diff):
+            self.grow(lo, hi)
+        locL -= self.start
+        locR -= self.start
+        self.diff[locL] += 1
+        self.diff[locR] -= 1
+        self.ends[locL] = True
+        self.ends[locR] = True
+
+    def write(self,fileout):
+        # done if nothing to do
+        if self.diff is None:
+            return
+
+        # depth at each fragment start/end is the sum of the depth changes up to it - one bedgraph row to the next one
+        idx = np.flatnonzero(self.ends)
+        depths = np.cumsum(self.diff)[idx].tolist()
+        locs = (idx + self.start).tolist()
+        chrom = self.chrom
+        for i in xrange(len(locs) - 1):
+            fileout.write("{}\t{}\t{}\t{}\n".format(chrom, locs[i], locs[i+1], depths[i]))
      
 #------------------------------------------------------------------------
-# make a UMI depth bedgraph   
+# make a UMI depth bedgraph from the umi_mark alignments - for metrics.umi_stream
 #------------------------------------------------------------------------
-def makeUmiDepthBedgraph(cfg,readSupportMin,trackName):
-    # params
-    readSet = cfg.readSet
-    
-    # open output file
-    trackName = readSet + "." + trackName
-    fileout = open(trackName + ".bedgraph", "w")
-    fileout.write("track type=bedGraph name='" + trackName + "'\n")
-    
-    # init genome locus buffer
-    locusChrom = "foobar"
-    locusLocR = -2001
-    locusBedFrags = []
-    
-    # read unique molecule information from "umi" module (file must be sorted by random fragmentation position)
-    for line in open(readSet + ".umi_mark.alignments.txt", "r"):
-    
-        # parse line
-        (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, fragLen, pLoc5, primer, umiSeq, alignLocR, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = line.strip().split("|")
-        mtReadIdx = int(mtReadIdx)
+class Accumulator(object):
+    def __init__(self,cfg,readSupportMin,trackName):
+        ''' Start a depth bedgraph
+        :param lambda obj cfg: run config
+        :param int readSupportMin: 0 for raw read depth, else minimum reads for a molecule to count in UMI depth
+        :param str trackName: bedgraph track name, after the read set
+        '''
+        self.readSupportMin = readSupportMin
+
+        # open output file
+        trackName = cfg.readSet + "." + trackName
+        self.fileout = open(trackName + ".bedgraph", "w")
+        self.fileout.write("track type=bedGraph name='" + trackName + "'\n")
+
+        # init genome locus buffer
+        self.locusChrom = "foobar"
+        self.locusLocR = -2001
+        self.island = Island(self.locusChrom)
+
+    def addRead(self,vals):
+        # unique molecule information from "umi" module (umi_mark writes it sorted by chrom and random fragmentation position)
+        (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, fragLen, pLoc5, primer, umiSeq, alignLocR, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = vals
+        readSupportMin = self.readSupportMin
         
         # skip PCR replicates, unless requested
-        if mtReadIdx > 0 and readSupportMin > 0:
-            continue
+        if readSupportMin > 0 and mtReadIdx != "0":
+            return
             
         # filter molecules with insufficient read support
         if int(mtReads_) < readSupportMin:
-            continue
+            return
    
         # covert to int
         pLoc5, read1L, read1R, read2L, read2R  = map(int,(pLoc5, read1L, read1R, read2L, read2R))
@@ -366,47 +473,51 @@ def makeUmiDepthBedgraph(cfg,readSupportMin,trackName):
             read1L = max(read1L, pLoc3)
             locs = (read1L,read1R,read2L,read2R)
    
-        # merge R1 and R2
         loc0,loc1,loc2,loc3 = locs
-        if loc2 > loc1 or readSupportMin == 0:
-            bedFrag = [(pChrom, loc0, loc1), (pChrom, loc2, loc3)]
-        else:
-            bedFrag = [(pChrom, loc0, loc3)]
    
-        # flush previous data to disk, if new locus island found (note: lot of memory needed for long contigous single locus panel!)
-        if pChrom != locusChrom or loc0 > locusLocR + 2000:
-            handleOneLocus(locusBedFrags,fileout)
-            del(locusBedFrags[:])
-            locusChrom = pChrom
-            locusLocR = loc3
+        # flush previous data to disk, if new locus island found (memory is by island length)
+        if pChrom != self.locusChrom or loc0 > self.locusLocR + 2000:
+            self.island.write(self.fileout)
+            self.island = Island(pChrom)
+            self.locusChrom = pChrom
+            self.locusLocR = loc3
    
-        # save for later
-        locusBedFrags.extend(bedFrag)
-        locusLocR = max(locusLocR,loc3)
-  
-    # process final locus
-    handleOneLocus(locusBedFrags,fileout)
-    fileout.close()
+        # add to island coverage, merging R1 and R2
+        if loc2 > loc1 or readSupportMin == 0:
+            self.island.add(loc0, loc1)
+            self.island.add(loc2, loc3)
+        else:
+            self.island.add(loc0, loc3)
+        self.locusLocR = max(self.locusLocR,loc3)
+
+    def close(self):
+        # process final locus
+        self.island.write(self.fileout)
+        self.fileout.close()
  
+#---------------------------------------------------------------------   
+# get the depth bedgraph accumulators for metrics.umi_stream
+#---------------------------------------------------------------------   
+def getAccumulators(cfg):
+    return [Accumulator(cfg,0, "umi_depths.raw_reads"),  # raw read depth
+            Accumulator(cfg,1, "umi_depths.enrichment-output")]  # UMI depth
+
 #---------------------------------------------------------------------   
 # main function
 #---------------------------------------------------------------------   
 def run(cfg,vc):
     print("umi_depths starting...")
-    readSet  = cfg.readSet
-    numCores = cfg.numCores
-    
-    # sort read alignments by R2 random fragmentation location (to remove strand sort from previous step)
-    fileNameIn = readSet + ".umi_mark.alignments.txt"
-    cmd = "sort -k1,1 -k3,3n -t\| -T./ --parallel={1} {0} > {0}.temp.txt".format(fileNameIn, numCores)  # sort order is (alignChrom, mtLoc)
-    subprocess.check_call(cmd, shell=True)
-    os.rename(fileNameIn + ".temp.txt", fileNameIn)
-    print("umi_depths: done sorting UMI read alignment file by random fragmentation position")
     
     # make depth bedgraph files, save to disk
-    makeUmiDepthBedgraph(cfg,0, "umi_depths.raw_reads")  # raw read depth
-    makeUmiDepthBedgraph(cfg,1, "umi_depths.enrichment-output")            # UMI depth
+    metrics.umi_stream.run(cfg, getAccumulators(cfg))
     print("umi_depths: done making depth bedgraphs")
+    summarize(cfg,vc)
+
+#---------------------------------------------------------------------   
+# depth metrics over the target region, from the depth bedgraphs
+#---------------------------------------------------------------------   
+def summarize(cfg,vc):
+    readSet  = cfg.readSet
     
     # get target region from disk, or make it if not specified
     bedTarget,bpTarget = getTargetBed(cfg)
@@ -1,5 +1,8 @@
 import math
 
+# our modules
+import metrics.umi_stream
+
 # constants
 FRAG_BINS = 46
 
@@ -40,45 +43,57 @@ def getMetrics(vals):
     # done
     return tuple(outvec)
  
+#---------------------------------------------------------------------   
+# accumulate read and molecule counts from the umi_mark alignments - for metrics.umi_stream
+#---------------------------------------------------------------------   
+class Accumulator(object):
+    def __init__(self):
+        # vector for molecule metrics - this can get long - as many as input molecule count!
+        self.moleculeData = []
+        self.totMolecules = 0
+        self.totMoleculesWithResampleRead = 0
+        self.totReads = 0
+        self.totReadsFromResample = 0
+
+    def addRead(self, vals):
+        # read accounting - isResample column
+        self.totReads += 1
+        if int(vals[7]) > 0:
+            self.totReadsFromResample += 1
+
+    def addMolecule(self, molecule):
+        # save one value per molecule in large list
+        self.moleculeData.append((molecule.fragLen, molecule.numAlignments))
+
+        # count unique molecules by whether the last read is a resampling read (molecules with more than one read)
+        if molecule.numAlignments > 1:
+            self.totMolecules += 1
+            if molecule.isResample > 0:
+                self.totMoleculesWithResampleRead += 1
+
 #---------------------------------------------------------------------   
 # main function
 #---------------------------------------------------------------------   
 def run(cfg):
     print("umi_frags starting...")
+
+    # read unique molecule information from "umi" module
+    accumulator = Accumulator()
+    metrics.umi_stream.run(cfg, [accumulator])
+    write(cfg, accumulator)
+
+#---------------------------------------------------------------------   
+# write the metrics files
+#---------------------------------------------------------------------   
+def write(cfg, accumulator):
     # params
     readSet = cfg.readSet
- 
-    # init counters and vector for molecule metrics - this can get long - as many as input molecule count!
-    moleculeData = []
-    totMolecules = 0
-    totMoleculesWithResampleRead = 0
-    totReads = 0
-    totReadsFromResample = 0
-    
-    # read unique molecule information from "umi" module
-    for line in open(readSet + ".umi_mark.alignments.txt", "r"):
-    
-        # parse line
-        (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, fragLen, pLoc5, primer, umiSeq, alignLocR, alignLocP, readId, read1L, read1R, cigar1, read2L, read2R, cigar2) = line.strip().split("|")
-        mtReadIdx = int(mtReadIdx)
-        numReads = int(mtReads_)
-        isResampleRead = int(isResample) > 0
-        
-        # read accounting
-        totReads += 1
-        if isResampleRead:
-            totReadsFromResample += 1
-         
-        # save one value per molecule in large list
-        if mtReadIdx == 0:
-            moleculeData.append((int(fragLen),numReads))
-         
-        # count unique molecules by whether it has a resampling read
-        elif mtReadIdx == numReads - 1:
-            totMolecules += 1
-            if isResampleRead:
-                totMoleculesWithResampleRead += 1
-    
+    moleculeData = accumulator.moleculeData
+    totMolecules = accumulator.totMolecules
+    totMoleculesWithResampleRead = accumulator.totMoleculesWithResampleRead
+    totReads = accumulator.totReads
+    totReadsFromResample = accumulator.totReadsFromResample
+
     # sort the molecule data vector by fragment length
     moleculeData.sort()
     
@@ -0,0 +1,29 @@
+# our modules
+import metrics.fraglen_by_rpu
+import metrics.sum_primer_umis
+import metrics.umi_depths
+import metrics.umi_frags
+import metrics.umi_stream
+
+#---------------------------------------------------------------------
+# main function - the umi_depths, umi_frags, sum_primer_umis (and duplex fraglen_by_rpu) metrics from one read of the umi_mark alignments
+#---------------------------------------------------------------------
+def run(cfg,vc):
+    print("umi_metrics starting...")
+
+    # stream the alignments once through all the metric accumulators
+    frags = metrics.umi_frags.Accumulator()
+    primers = metrics.sum_primer_umis.Accumulator(cfg)
+    accumulators = metrics.umi_depths.getAccumulators(cfg) + [frags, primers]
+    if cfg.duplex:
+        fragLensByRpu = metrics.fraglen_by_rpu.Accumulator()
+        accumulators.append(fragLensByRpu)
+    metrics.umi_stream.run(cfg, accumulators)
+    print("umi_metrics: done reading umi_mark alignments")
+
+    # write each module's outputs
+    metrics.umi_frags.write(cfg, frags)
+    metrics.sum_primer_umis.write(cfg, primers)
+    if cfg.duplex:
+        metrics.fraglen_by_rpu.write(cfg, fragLensByRpu)
+    metrics.umi_depths.summarize(cfg, vc)
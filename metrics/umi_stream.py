@@ -0,0 +1,62 @@
+#----------------------------------------------------------------------
+# one molecule (UMI) called by umi_mark - the fields umi_mark also writes to umi_mark.for.sum.primer.txt
+#----------------------------------------------------------------------
+class Molecule(object):
+    __slots__ = ("pChrom", "pStrand", "mtLoc", "mt", "numReads", "numAlignments", "isResample", "fragLen", "primer", "primerLoc5")
+
+    def __init__(self, vals):
+        self.pChrom        = vals[0]
+        self.pStrand       = vals[1]
+        self.mtLoc         = vals[2]
+        self.mt            = vals[3]
+        self.numAlignments = int(vals[5])
+        self.numReads      = None   # from the last read of the molecule
+        self.isResample    = None
+        self.fragLen       = None   # from the first read - umi_mark writes the longest fragment first
+        self.primer        = None
+        self.primerLoc5    = None
+
+#----------------------------------------------------------------------
+# read umi_mark.alignments.txt once, feeding each alignment and each molecule to metric accumulators
+#----------------------------------------------------------------------
+def run(cfg, accumulators):
+    ''' Stream the molecule-marked read alignments through metric accumulators
+    :param lambda obj cfg: run config
+    :param list accumulators: objects with any of addRead(vals) - vals the "|" split alignment line,
+                              addMolecule(molecule) - a Molecule, and close() - called at the end
+    '''
+    readSet = cfg.readSet
+    readFuncs = [x.addRead for x in accumulators if hasattr(x, "addRead")]
+    moleculeFuncs = [x.addMolecule for x in accumulators if hasattr(x, "addMolecule")]
+
+    # the reads of a molecule are adjacent - umi_mark writes them in (chrom, molecule locus, line) order
+    molecule = None
+    for line in open(readSet + ".umi_mark.alignments.txt", "r"):
+        vals = line.strip().split("|")
+        for addRead in readFuncs:
+            addRead(vals)
+        if len(moleculeFuncs) == 0:
+            continue
+
+        # (pChrom, pStrand, mtLoc, mt, mtReads, mtReads_, mtReadIdx, isResample, fragLen, pLoc5, primer, ...)
+        if molecule is None or vals[3] != molecule.mt or vals[2] != molecule.mtLoc or vals[1] != molecule.pStrand or vals[0] != molecule.pChrom:
+            if molecule is not None:
+                for addMolecule in moleculeFuncs:
+                    addMolecule(molecule)
+            molecule = Molecule(vals)
+        mtReadIdx = int(vals[6])
+        if mtReadIdx == 0:
+            molecule.fragLen = int(vals[8])
+            molecule.primerLoc5 = int(vals[9])
+            molecule.primer = vals[10]
+        if mtReadIdx == molecule.numAlignments - 1:
+            molecule.numReads = int(vals[4])
+            molecule.isResample = int(vals[7])
+
+    # last molecule
+    if molecule is not None:
+        for addMolecule in moleculeFuncs:
+            addMolecule(molecule)
+    for accumulator in accumulators:
+        if hasattr(accumulator, "close"):
+            accumulator.close()
@@ -0,0 +1,39 @@
+import numpy as np
+
+# % of mean depth thresholds of the uniformity metrics
+PCT_OF_MEAN = (5.0, 10.0, 20.0, 30.0)
+
+#------------------------------------------------------------------------------------------
+# depth uniformity metrics, from runs of equal depth
+#------------------------------------------------------------------------------------------
+def getUniformityMetrics(depths, lengths = None):
+    ''' Get the mean depth, and the % of bases (or primers) with depth >= 5, 10, 20 and 30% of the mean - computed
+    from the distinct depths weighted by their base counts, so memory is by run rather than by base
+    :param depths: depth of each run, e.g. of each bedgraph interval
+    :param lengths: bases in each run, default 1 (e.g. one depth per primer)
+    :returns tuple (mean, % >= 5%, % >= 10%, % >= 20%, % >= 30% of mean) - all 0 if the total depth is 0
+    '''
+    depths = np.asarray(depths, dtype = np.int64)
+    lengths = np.ones(len(depths), dtype = np.int64) if lengths is None else np.asarray(lengths, dtype = np.int64)
+
+    # if zero depth at all primers/sites, return zeros
+    depthTotal = int(np.dot(depths, lengths))
+    if depthTotal == 0:
+        return tuple([0] * 5)
+
+    # get mean depth
+    numBases = int(lengths.sum())
+    depthMean = 1.00 * depthTotal / numBases
+
+    # weighted sort - distinct depths in increasing order, and the number of bases below each
+    (depthsSorted, idxSorted) = np.unique(depths, return_inverse = True)
+    basesSorted = np.bincount(idxSorted, weights = lengths).astype(np.int64)
+    basesBelow = np.cumsum(basesSorted) - basesSorted
+
+    # get % of mean metrics - the bases below the first depth reaching pct % of mean are the bases under it
+    pctMean = 100.00 * depthsSorted / depthMean
+    outvec = [depthMean]
+    for pct in PCT_OF_MEAN:
+        idx = int(basesBelow[np.argmax(pctMean >= pct)])
+        outvec.append(100.00 - (100.00 * idx) / numBases)
+    return tuple(outvec)
@@ -4,6 +4,10 @@ import subprocess
 
 import pysam
 
+# our modules
+import core.bam_io
+import core.scratch
+
 #-------------------------------------------------------------------------
 # make unique molecule consensus reads FASTQ
 #-------------------------------------------------------------------------
@@ -94,7 +98,7 @@ def run(cfg,bamFileIn,primerFileIn):
     # sort unaligned BAM by readId (which is also the molecule tag), using Linux sort, not samtools sort -n
     cmd = samtoolsDir + "samtools view " \
     + readSet + ".consensus.temp3.bam" \
-    + " | sort -k1,1 -T./ --parallel=" + numCores \
+    + " | sort -k1,1 -T" + core.scratch.getDir(cfg) + " --parallel=" + numCores \
     + " 1>> " + readSet + ".consensus.temp4.sam" \
     + " 2>> " + readSet + ".consensus.shell.log"
     subprocess.check_call(cmd, shell=True)
@@ -112,7 +116,7 @@ def run(cfg,bamFileIn,primerFileIn):
     os.remove(readSet + ".consensus.temp4.sam")
     
     # sort primer info by molecule tag (which is also the read id)
-    cmd = "sort -k1,1 -T./ --parallel=" + numCores \
+    cmd = "sort -k1,1 -T" + core.scratch.getDir(cfg) + " --parallel=" + numCores \
     + "     " + primerFileIn \
     + " 1>  " + readSet + ".consensus.primers.txt" \
     + " 2>> " + readSet + ".consensus.shell.log"
@@ -188,8 +192,8 @@ def filter(cfg,bamFileIn,bamFileOut):
     NUM_METRICS_TOTAL = 8
     
     # open BAM read alignment files
-    bamIn  = pysam.Samfile(bamFileIn , "rb")
-    bamOut = pysam.Samfile(bamFileOut, "wb", template=bamIn)
+    bamIn  = core.bam_io.openBam(cfg, bamFileIn , "rb")
+    bamOut = core.bam_io.openBam(cfg, bamFileOut, "wb", core.bam_io.LEVEL_TEMP, template=bamIn)
  
     # loop over read alignments
     readPairCounts = [0] * NUM_METRICS_TOTAL
@@ -7,6 +7,7 @@ from multiprocessing.dummy import Pool as ThreadPool
 
 # our modules
 import primer_trim_ion
+import core.cpu_tokens
 
 #-------------------------------------------------------------------------------------
 def runShellCommand(cmd):
@@ -28,11 +29,15 @@ def runShellCommand(cmd):
 
 #-------------------------------------------------------------------------------------
 def worker(cmd):
+    # each trimming batch is a single-threaded process
+    numCores = core.cpu_tokens.acquire(1)
     try:
         subprocess.check_call(cmd, shell=True)
         return True
     except:
         return False
+    finally:
+        core.cpu_tokens.release(numCores)
   
 #-------------------------------------------------------------------------------------
 def splitReadFile(readFile,filePrefixOut,readSide,numBatchesMax,deleteLocalFiles):
@@ -4,13 +4,18 @@ import copy
 
 import pysam
 
+# our modules
+import core.bam_io
+import core.cpu_tokens
+import core.read_index
+import core.scratch
+
 #-------------------------------------------------------------------------------------------------------
 # Ion single-end reads - align single-end FASTQ using TMAP
 #-------------------------------------------------------------------------------------------------------
 def alignToGenomeIon(cfg,readFileIn1,bamFileOut):
     # get some parameters from config
     readSet = cfg.readSet
-    numCpus = cfg.numCores
     samtoolsDir = cfg.samtoolsDir
     samtoolsMem = cfg.samtoolsMem
     torrentBinDir = cfg.torrentBinDir
@@ -19,21 +24,24 @@ def alignToGenomeIon(cfg,readFileIn1,bamFileOut):
     tagNameUmiSeq    = cfg.tagNameUmiSeq
     tagNamePrimer    = cfg.tagNamePrimer
     tagNamePrimerErr = cfg.tagNamePrimerErr
+    bamFileTemp  = core.scratch.getFile(cfg, readSet + ".temp.bam")
+    bamFileTemp1 = core.scratch.getFile(cfg, readSet + ".temp1.bam")
     
     # align full-length reads to reference genome using TMAP
-    cmd = "{} mapall -n {} -r {} -f {} -v -Y -u --prefix-exclude 5 -o 2 stage1 map4 > ".format(tmap,numCpus,readFileIn1,torrentGenomeFile) \
-    + readSet + ".temp.bam 2> " \
-    + readSet + ".align.tmap.log "
-    subprocess.check_call(cmd, shell=True)
+    with core.cpu_tokens.Cores(cfg) as numCpus:
+        cmd = "{} mapall -n {} -r {} -f {} -v -Y -u --prefix-exclude 5 -o 2 stage1 map4 > ".format(tmap,numCpus,readFileIn1,torrentGenomeFile) \
+        + bamFileTemp + " 2> " \
+        + readSet + ".align.tmap.log "
+        subprocess.check_call(cmd, shell=True)
 
     # add tag to bam
-    bamIn = readSet + ".temp.bam"
-    bamOut = readSet + ".temp1.bam"
-    addBamTags(bamIn,bamOut,readSet,tagNameUmiSeq,tagNamePrimer,tagNamePrimerErr)
+    bamIn = bamFileTemp
+    bamOut = bamFileTemp1
+    addBamTags(bamIn,bamOut,readSet,tagNameUmiSeq,tagNamePrimer,tagNamePrimerErr,cfg)
 
     # add a fake reverse compliment read alignment (i.e. simulate paired-end primer-side read) for use in downstream code
-    bamIn  = pysam.Samfile(readSet + ".temp1.bam", "rb")
-    bamOut = pysam.AlignmentFile(bamFileOut, "wb", template=bamIn)
+    bamIn  = core.bam_io.openBam(cfg, bamFileTemp1, "rb")
+    bamOut = core.bam_io.openBam(cfg, bamFileOut, "wb", core.bam_io.LEVEL_TEMP, template=bamIn)
     for read1 in bamIn:
         read1.is_paired = True
         read1.is_read1 = False
@@ -54,48 +62,69 @@ def alignToGenomeIon(cfg,readFileIn1,bamFileOut):
     bamOut.close()
 
     # delete unneeded bam files
-    os.remove(readSet + ".temp.bam")
-    os.remove(readSet + ".temp1.bam")
+    os.remove(bamFileTemp)
+    os.remove(bamFileTemp1)
 
     # sort by locus for IGV viewing, and for mtMerge with hashing by chromosome
-    cmd = samtoolsDir + "samtools sort -m " + samtoolsMem + " -@" + numCpus \
-    + " -T " + readSet \
-    + " -o " + readSet + ".align.sorted.bam " \
-             + readSet + ".align.bam " \
-    + "> "   + readSet + ".align.sort.log 2>&1 "
-    subprocess.check_call(cmd, shell=True)
+    with core.cpu_tokens.Cores(cfg) as numCpus:
+        cmd = samtoolsDir + "samtools sort -m " + samtoolsMem + " -@" + str(numCpus) \
+        + " -T " + core.scratch.getFile(cfg, readSet) \
+        + " -o " + readSet + ".align.sorted.bam " \
+                 + readSet + ".align.bam " \
+        + "> "   + readSet + ".align.sort.log 2>&1 "
+        subprocess.check_call(cmd, shell=True)
 
     # make BAM index for IGV
     cmd = samtoolsDir + "samtools index " + readSet + ".align.sorted.bam "
     subprocess.check_call(cmd, shell=True)
 
-def addBamTags(bamIn,bamOut,readSet,tagNameUmiSeq,tagNamePrimer,tagNamePrimerErr):
+def addBamTags(bamIn,bamOut,readSet,tagNameUmiSeq,tagNamePrimer,tagNamePrimerErr,cfg):
     ''' Add tags to bam
     :param str bamIn : The input bam file to read
     :param str bamOut : The output bam file to write
     :param str readSet : The sample name
+    :param lambda obj cfg : Run config, for the scratch dir and BAM compression cores
     '''
-    # create a dict of read id -> tag
-    umi_dict = {}
+    tempDir = core.scratch.getDir(cfg)
+    # create on-disk indexes of read id -> umi, and read id -> (primer,primer_err)
+    umiIndexFile = os.path.join(tempDir, readSet + ".umi.tag.index")
+    primerIndexFile = os.path.join(tempDir, readSet + ".primer.tag.index")
+    umiIndex = core.read_index.Writer(umiIndexFile, tempDir)
     with open(readSet +  ".umi.tag.txt","r") as IN:
         for line in IN:
             read_id, umi, umi_qual = line.strip('\n').split('\t')
-            umi_dict[read_id] = [umi,None,None]
+            umiIndex.add(read_id, umi)
+    umiIndex.close()
+    umiIndex = core.read_index.Reader(umiIndexFile)
+    primerIndex = core.read_index.Writer(primerIndexFile, tempDir)
     with open(readSet + ".primer.tag.txt","r") as IN:
         for line in IN:
             read_id, primer, primer_err = line.strip('\n').split('\t')
-            umi_dict[read_id][1] = primer
-            umi_dict[read_id][2] = primer_err
-    print "\nDone creating readID -> (umi,primer,primer_err)  dict\n"            
+            # every primer tagged read must have a umi tag
+            if umiIndex.get(read_id) is None:
+                raise KeyError(read_id)
+            primerIndex.add(read_id, primer + '\t' + primer_err)
+    primerIndex.close()
+    primerIndex = core.read_index.Reader(primerIndexFile)
+    print "\nDone creating readID -> (umi,primer,primer_err)  indexes\n"            
 
-    with pysam.AlignmentFile(bamIn,"rb") as IN, pysam.AlignmentFile(bamOut,"wb", template=IN) as OUT:
+    with core.bam_io.openBam(cfg,bamIn,"rb") as IN, core.bam_io.openBam(cfg,bamOut,"wb",core.bam_io.LEVEL_TEMP,template=IN) as OUT:
         for read1 in IN:
             temp_tags = read1.tags
-            umi_tag = umi_dict["@"+read1.qname][0]
-            primer_tag = umi_dict["@"+read1.qname][1]
-            primer_err_tag = umi_dict["@"+read1.qname][2]
+            read_id = "@"+read1.qname
+            umi_tag = umiIndex.get(read_id)
+            if umi_tag is None:
+                raise KeyError(read_id)
+            primer_info = primerIndex.get(read_id)
+            (primer_tag, primer_err_tag) = primer_info.split('\t') if primer_info is not None else (None, None)
             temp_tags.append((tagNameUmiSeq,umi_tag))
             temp_tags.append((tagNamePrimer,primer_tag))
             temp_tags.append((tagNamePrimerErr,primer_err_tag))
             read1.tags = tuple(temp_tags)
             OUT.write(read1)
+
+    # remove the indexes
+    for index in (umiIndex, primerIndex):
+        index.close()
+    os.remove(umiIndexFile)
+    os.remove(primerIndexFile)
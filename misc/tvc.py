@@ -9,6 +9,10 @@ import pysam
 
 # our modules
 import bed
+import core.bam_io
+import core.cpu_tokens
+import core.read_index
+import core.scratch
 
 #----------------------------------------------------------------------------------------------------------
 # main TVC function - prepare primer-trimmed BAM and call TVC
@@ -18,14 +22,13 @@ def run(cfg):
     print("tvc: start...")
     readSet = cfg.readSet
     uBam = cfg.uBam
-    numCpus = cfg.numCores
     samtoolsMem = cfg.samtoolsMem
     samtoolsDir = cfg.samtoolsDir
     vcflibDir = cfg.vcflibDir
     flowTagsNeeded = set(("ZP","ZA","ZG","ZB","ZC","ZM","ZF","RG"))
 
     # open raw read file *.basecaller.bam
-    bam = pysam.AlignmentFile(uBam, "rb", check_sq = False)
+    bam = core.bam_io.openBam(cfg, uBam, "rb", check_sq = False)
 
     # save BAM header in a string for later
     bamHeaderRaw = bam.text
@@ -34,21 +37,26 @@ def run(cfg):
     fileout = open(readSet + ".tvc.flowtags.txt","w")
     fileIn3 = open(readSet + ".cutadapt.3.R1.txt","r")
 
-    # create a dict of read id -> tag
-    umi_dict = {}
+    # create an on-disk index of read id -> tag
+    umiIndexFile = core.scratch.getFile(cfg, readSet + ".umi.tag.index")
+    umiIndex = core.read_index.Writer(umiIndexFile, core.scratch.getDir(cfg))
     tag_name = "mi"
     with open(readSet +  ".umi.tag.txt","r") as IN:
         for line in IN:
             read_id, umi, umi_qual = line.strip('\n').split('\t')
-            umi_dict[read_id] = umi
+            umiIndex.add(read_id, umi)
+    umiIndex.close()
+    umiIndex = core.read_index.Reader(umiIndexFile)
 
-    print "\nDone creating readID -> UMI  dict\n"
+    print "\nDone creating readID -> UMI  index\n"
 
     # merge 5' trim, 3' trim, and raw read flow tags
     for line in open(readSet + ".cutadapt.5.R1.txt","r"):
         vals5 = line.strip().split("\t")
         readId = vals5[0]
-        umi = umi_dict["@"+readId]
+        umi = umiIndex.get("@"+readId)
+        if umi is None:
+            raise KeyError("@"+readId)
         # spin the 3' trim file, and the raw read file forward
         while True:
             line = fileIn3.readline()
@@ -117,25 +125,29 @@ def run(cfg):
     fileout.close()
     fileIn3.close()
     bam.close()
+    umiIndex.close()
+    os.remove(umiIndexFile)
 
     # sort the trimmed seq / flow tag file by read id
-    cmd = "sort -k1,1 -t\| --parallel={0} {1}.tvc.flowtags.txt > {1}.tvc.flowtags.sorted.txt".format(numCpus,readSet)
-    subprocess.check_call(cmd, shell=True)
+    with core.cpu_tokens.Cores(cfg) as numCpus:
+        cmd = "sort -k1,1 -t\| -T{2} --parallel={0} {1}.tvc.flowtags.txt > {1}.tvc.flowtags.sorted.txt".format(numCpus,readSet,core.scratch.getDir(cfg))
+        subprocess.check_call(cmd, shell=True)
     os.remove("{}.tvc.flowtags.txt".format(readSet))
 
     # sort oligoClip file by read id
-    cmd = samtoolsDir + "samtools sort -n -m " + samtoolsMem + " -@" + numCpus \
-    + " -T " + readSet \
-    + " -o " + readSet + ".tvc.temp.bam " \
-             + readSet + ".bam " \
-    + " > "  + readSet + ".tvc.sort.log 2>&1 "
-    subprocess.check_call(cmd, shell=True)
+    with core.cpu_tokens.Cores(cfg) as numCpus:
+        cmd = samtoolsDir + "samtools sort -n -m " + samtoolsMem + " -@" + str(numCpus) \
+        + " -T " + core.scratch.getFile(cfg, readSet) \
+        + " -o " + readSet + ".tvc.temp.bam " \
+                 + readSet + ".bam " \
+        + " > "  + readSet + ".tvc.sort.log 2>&1 "
+        subprocess.check_call(cmd, shell=True)
 
     # set up reverse comlement
     dnaComplementTranslation = string.maketrans("ATGC", "TACG")
 
     # open readId-sorted main BAM file, build header for TVC output bam
-    bamIn = pysam.AlignmentFile(readSet + ".tvc.temp.bam", "rb")
+    bamIn = core.bam_io.openBam(cfg, readSet + ".tvc.temp.bam", "rb")
 
     # dump bam header to sam file, because we are using older version of pysam that cannot directly take text lines for header
     headerTagsNeeded = set(["CO", "RG", "PG"])
@@ -152,7 +164,7 @@ def run(cfg):
     samHeaderOnly = pysam.AlignmentFile(readSet + ".tvc.header.sam", "r")
 
     # open output BAM file
-    bamOut = pysam.AlignmentFile(readSet + ".tvc.bam", "wb", template=samHeaderOnly)
+    bamOut = core.bam_io.openBam(cfg, readSet + ".tvc.bam", "wb", template=samHeaderOnly)
     samHeaderOnly.close()
     os.remove(readSet + ".tvc.header.sam")
 
@@ -261,12 +273,13 @@ def run(cfg):
     os.remove(readSet + ".tvc.temp.bam")
 
     # sort final TVC input bam
-    cmd = samtoolsDir + "samtools sort -m " + samtoolsMem + " -@" + numCpus \
-    + " -T " + readSet \
-    + " -o " + readSet + ".tvc.sorted.bam " \
-             + readSet + ".tvc.bam " \
-    + " > "  + readSet + ".tvc.sort.log 2>&1 "
-    subprocess.check_call(cmd, shell=True)
+    with core.cpu_tokens.Cores(cfg) as numCpus:
+        cmd = samtoolsDir + "samtools sort -m " + samtoolsMem + " -@" + str(numCpus) \
+        + " -T " + core.scratch.getFile(cfg, readSet) \
+        + " -o " + readSet + ".tvc.sorted.bam " \
+                 + readSet + ".tvc.bam " \
+        + " > "  + readSet + ".tvc.sort.log 2>&1 "
+        subprocess.check_call(cmd, shell=True)
 
     # index final TVC input bam
     cmd = samtoolsDir + "samtools index " + readSet + ".tvc.sorted.bam"
@@ -277,36 +290,37 @@ def run(cfg):
     torrentBinDir     = cfg.torrentBinDir
     torrentGenomeFile = cfg.genomeFile
     torrentVcfFile = readSet + ".tvc.vcf"
-    cmd = os.path.join(torrentBinDir , "tvc") + " --output-dir _TVC_ " \
-     + " -n " + numCpus \
-     + " -b " + readSet + ".tvc.sorted.bam" \
-     + " -t " + roiBedFile \
-     + " -r " + torrentGenomeFile \
-     + " -o " + torrentVcfFile \
-     + " --snp-min-allele-freq 0.005" \
-     + " --snp-min-cov-each-strand 0 " \
-     + " --snp-min-coverage 3" \
-     + " --snp-min-var-coverage 2" \
-     + " --snp-min-variant-score 6" \
-     + " --snp-strand-bias 1" \
-     + " --snp-strand-bias-pval 0" \
-     + " --mnp-min-allele-freq 0.005" \
-     + " --mnp-min-cov-each-strand 0" \
-     + " --mnp-min-coverage 3" \
-     + " --mnp-min-var-coverage 2" \
-     + " --mnp-min-variant-score 6" \
-     + " --mnp-strand-bias 1" \
-     + " --mnp-strand-bias-pval 0" \
-     + " --indel-min-allele-freq 0.005" \
-     + " --indel-min-cov-each-strand 0" \
-     + " --indel-min-coverage 3" \
-     + " --indel-min-var-coverage 2" \
-     + " --indel-min-variant-score 10" \
-     + " --indel-strand-bias 1" \
-     + " --indel-strand-bias-pval 0" \
-     + " > " + readSet + ".tvc.log 2>&1"
-    print("tvc: command line is " + cmd)
-    subprocess.check_call(cmd, shell=True)
+    with core.cpu_tokens.Cores(cfg) as numCpus:
+        cmd = os.path.join(torrentBinDir , "tvc") + " --output-dir _TVC_ " \
+         + " -n " + str(numCpus) \
+         + " -b " + readSet + ".tvc.sorted.bam" \
+         + " -t " + roiBedFile \
+         + " -r " + torrentGenomeFile \
+         + " -o " + torrentVcfFile \
+         + " --snp-min-allele-freq 0.005" \
+         + " --snp-min-cov-each-strand 0 " \
+         + " --snp-min-coverage 3" \
+         + " --snp-min-var-coverage 2" \
+         + " --snp-min-variant-score 6" \
+         + " --snp-strand-bias 1" \
+         + " --snp-strand-bias-pval 0" \
+         + " --mnp-min-allele-freq 0.005" \
+         + " --mnp-min-cov-each-strand 0" \
+         + " --mnp-min-coverage 3" \
+         + " --mnp-min-var-coverage 2" \
+         + " --mnp-min-variant-score 6" \
+         + " --mnp-strand-bias 1" \
+         + " --mnp-strand-bias-pval 0" \
+         + " --indel-min-allele-freq 0.005" \
+         + " --indel-min-cov-each-strand 0" \
+         + " --indel-min-coverage 3" \
+         + " --indel-min-var-coverage 2" \
+         + " --indel-min-variant-score 10" \
+         + " --indel-strand-bias 1" \
+         + " --indel-strand-bias-pval 0" \
+         + " > " + readSet + ".tvc.log 2>&1"
+        print("tvc: command line is " + cmd)
+        subprocess.check_call(cmd, shell=True)
     print("tvc: done running TVC")
 
     # move TVC VCF to current directory
@@ -2,27 +2,29 @@ import ConfigParser
 import sys
 import multiprocessing
 import shutil
+import traceback
 # our modules
 import core.run_log
 import core.run_config
+import core.run_manifest
+import core.run_graph
+import core.panel
+import core.scratch
+import core.cpu_tokens
 import core.prep
 import core.align
 import core.umi_filter
 import core.umi_mark
 import core.umi_merge
 import core.primer_clip
-import core.samtools
 import core.tumor_normal
 import core.sm_counter_wrapper
 import metrics.sum_specificity
 import metrics.sum_uniformity_primer
-import metrics.sum_primer_umis
 import metrics.sum_all
-import metrics.umi_frags
-import metrics.umi_depths
+import metrics.umi_metrics
 import metrics.duplex_summary
 import metrics.sum_primer_duplex
-import metrics.fraglen_by_rpu
 import misc.process_ion
 import misc.tvc
 import annotate.vcf_complex
@@ -40,61 +42,194 @@ def run(args,tumorNormal):
     # read run configuration file to memory
     cfg = core.run_config.run(readSet,paramFile)
 
-    # trim adapters , umi and primers (this module spawns multiple processes)
-    core.prep.run(cfg)
+    # tools take cores from a shared pool - made here, unless a batch or tumor-normal parent already did
+    core.cpu_tokens.init(cfg.numCores)
+
+    # remove temp files left by a failed earlier run of this read set
+    core.scratch.clean(cfg)
+    isIllumina = cfg.platform.lower() == "illumina"
+
+    # smCounter params live in their own section of the param file
+    parser = ConfigParser.SafeConfigParser()
+    parser.optionxform = str
+    parser.read(paramFile)
+    smCounterSettings = dict(parser.items("smCounter"))
+    smCounterSettings["vc"] = vc
 
+    # pipeline stages, in a valid serial order - each stage lists the files it reads and writes, so
+    # independent stages can run concurrently, and the params its output depends on, so a
+    # restarted run can skip stages that already finished
+    Stage = core.run_manifest.Stage
+    roiBedFile = getattr(cfg, "roiBedFile", None)
+    roiBedFiles = (roiBedFile,) if roiBedFile is not None else ()
+    deleteLocalFiles = cfg.deleteLocalFiles
+    stages = []
+  
+    # trim adapters , umi and primers (this module spawns multiple processes)
     readFileIn1 = readSet + ".prep.R1.fastq"
     readFileIn2 = readSet + ".prep.R2.fastq"
+    prepOutputs = [readFileIn1, readFileIn2, readSet + ".prep.summary.txt"]
+    ionTagFiles = [readSet + x for x in (".umi.tag.txt", ".primer.tag.txt", ".cutadapt.5.R1.txt", ".cutadapt.3.R1.txt")]
+    if not isIllumina: # read tags and trim info for tmap and tvc
+        prepOutputs.extend(ionTagFiles)
+    prepParams = ("platform", "instrument", "duplex", "multimodal", "primer3Bases", "tagNameUmiSeq", "tagNamePrimer", "tagNamePrimerErr", "tagNameDuplex")
     bamFileOut  = readSet + ".align.bam"    
-    if cfg.platform.lower() == "illumina":
-        # align trimmed reads to genome using BWA MEM
-        core.align.run(cfg, readFileIn1, readFileIn2, bamFileOut)
-    else: # use tmap for ion torrent reads        
-        misc.process_ion.alignToGenomeIon(cfg, readFileIn1, bamFileOut)
+
+    # Illumina alignments go straight from bwa into umi_filter, unless align.bam is wanted - umi_filter
+    # then writes the read pairs it keeps to umi_filter.bam, for umi_merge
+    keepAlignBam = cfg.keepAlignBam or not isIllumina
+    bamFileFilter = readSet + ".umi_filter.bam"
+    umiFilterOutputs = (readSet + ".umi_filter.buckets", readSet + ".umi_filter.summary.txt", readSet + ".umi_filter.detail.summary.txt")
+    umiFilterParams = ("endogenousLenMin", "primer3Bases", "tagNameUmiSeq", "tagNamePrimer", "tagNamePrimerErr")
+    if isIllumina and cfg.streamAlign:
+        # trim and align in one stage - the trimmed FASTQs go through named pipes, never to disk
+        if keepAlignBam:
+            stages.append(Stage("prep_align", core.align.runStreaming, (cfg, bamFileOut),
+                inputs  = (cfg.readFile1, cfg.readFile2, cfg.primerFile, cfg.genomeFile),
+                outputs = (readSet + ".prep.summary.txt", bamFileOut),
+                params  = prepParams + ("genomeFile",)))
+        else:
+            stages.append(Stage("prep_align", core.align.runStreaming, (cfg, bamFileFilter, True),
+                inputs  = (cfg.readFile1, cfg.readFile2, cfg.primerFile, cfg.genomeFile),
+                outputs = (readSet + ".prep.summary.txt", bamFileFilter) + umiFilterOutputs,
+                params  = prepParams + ("genomeFile",) + umiFilterParams))
+    else:
+        stages.append(Stage("prep", core.prep.run, (cfg,),
+            inputs  = (cfg.readFile1, cfg.readFile2, cfg.primerFile),
+            outputs = prepOutputs,
+            params  = prepParams))
+        if isIllumina and keepAlignBam:
+            # align trimmed reads to genome using BWA MEM
+            stages.append(Stage("align", core.align.run, (cfg, readFileIn1, readFileIn2, bamFileOut),
+                inputs  = (readFileIn1, readFileIn2, cfg.genomeFile),
+                outputs = (bamFileOut,),
+                params  = ("genomeFile",),
+                rewrites = (readFileIn1, readFileIn2) if deleteLocalFiles else ()))
+        elif isIllumina:
+            # align trimmed reads to genome using BWA MEM, and filter the alignments as they arrive
+            stages.append(Stage("align", core.align.runUmiFilter, (cfg, readFileIn1, readFileIn2, bamFileFilter),
+                inputs  = (readFileIn1, readFileIn2, cfg.genomeFile, cfg.primerFile),
+                outputs = (bamFileFilter,) + umiFilterOutputs,
+                params  = ("genomeFile",) + umiFilterParams,
+                rewrites = (readFileIn1, readFileIn2) if deleteLocalFiles else ()))
+        else: # use tmap for ion torrent reads        
+            stages.append(Stage("align", misc.process_ion.alignToGenomeIon, (cfg, readFileIn1, bamFileOut),
+                inputs  = [readFileIn1, cfg.genomeFile] + ionTagFiles[:2],
+                outputs = (bamFileOut,),
+                params  = ("genomeFile", "tagNameUmiSeq", "tagNamePrimer", "tagNamePrimerErr")))
   
     # call putative unique input molecules using BOTH UMI seq AND genome alignment position on random fragmentation side    
-    bamFileIn  = readSet + ".align.bam"     
-    core.umi_filter.run(cfg, bamFileIn)
-    core.umi_mark.run(cfg)   
-    metrics.umi_frags.run(cfg)
+    if keepAlignBam:
+        bamFileIn  = readSet + ".align.bam"     
+        stages.append(Stage("umi_filter", core.umi_filter.run, (cfg, bamFileIn),
+            inputs  = (bamFileIn, cfg.primerFile),
+            outputs = umiFilterOutputs,
+            params  = umiFilterParams))
+    else:
+        bamFileIn  = bamFileFilter
+    stages.append(Stage("umi_mark", core.umi_mark.run, (cfg,),
+        inputs  = (readSet + ".umi_filter.buckets",),
+        outputs = (readSet + ".umi_mark.alignments.txt", readSet + ".umi_mark.for.sum.primer.txt")))
        
-    metrics.umi_depths.run(cfg,vc)   
-    core.umi_merge.run(cfg, bamFileIn)
+    # umi depth, read-per-umi and primer-level umi metrics, from one read of the umi_mark alignments - umi_mark writes them
+    # in the (chrom, molecule locus) order the depth bedgraphs need, umi_merge reads them in any order
+    umiMetricsOutputs = [readSet + ".umi_depths.enrichment-output.bedgraph", readSet + ".umi_depths.summary.txt", readSet + ".umi_depths.LT20PctOfMean.txt",
+        readSet + ".umi_frags.len-distrib.txt", readSet + ".umi_frags.summary.txt", readSet + ".sum.primer.umis.txt"]
+    if cfg.duplex:
+        umiMetricsOutputs.append(readSet + ".fraglen_by_rpu.distrib.txt")
+    stages.append(Stage("umi_metrics", metrics.umi_metrics.run, (cfg,vc),
+        inputs  = (readSet + ".umi_mark.alignments.txt", cfg.primerFile) + roiBedFiles,
+        outputs = umiMetricsOutputs,
+        params  = ("roiBedFile",),
+        values  = ("umiDepthMean", "roiBedFile", "readsPerUmi"),
+        settings = {"vc" : vc},
+        cores   = 1))
+    stages.append(Stage("umi_merge", core.umi_merge.run, (cfg, bamFileIn),
+        inputs  = (bamFileIn, readSet + ".umi_mark.alignments.txt"),
+        outputs = (readSet + ".umi_merge.bam", readSet + ".umi_merge.primers.txt"),
+        params  = ("tagNameUmi", "tagNameResample"),
+        rewrites = (bamFileIn,) if deleteLocalFiles else (),
+        cores   = 1))
+
+    # additional metrics to generate - single core python stages, each holding one core; they start as soon as
+    # their inputs are ready, alongside other stages when cores are free
+    stages.append(Stage("sum_specificity", metrics.sum_specificity.run, (cfg,), # priming specificity
+        inputs  = (cfg.primerFile, readSet + ".umi_filter.buckets"),
+        outputs = (readSet + ".sum.specificity.txt",),
+        cores   = 1))
+    stages.append(Stage("sum_uniformity_primer", metrics.sum_uniformity_primer.run, (cfg,), # primer-level uniformity
+        inputs  = (readSet + ".sum.primer.umis.txt",),
+        outputs = (readSet + ".sum.uniformity.primer.summary.txt",),
+        cores   = 1))
+
+    if cfg.duplex: # additional metrics for Duplex reads (declared before primer_clip, which may delete umi_merge.bam)
+        stages.append(Stage("duplex_summary", metrics.duplex_summary.run, (cfg,),
+            inputs  = (readSet + ".umi_merge.bam",),
+            outputs = (readSet + ".duplex.summary.txt", readSet + ".duplex.detail.summary.txt"),
+            params  = ("tagNameUmi", "tagNameDuplex"),
+            cores   = 1))
+        stages.append(Stage("sum_primer_duplex", metrics.sum_primer_duplex.run, (cfg,),
+            inputs  = (readSet + ".umi_merge.bam", readSet + ".umi_mark.for.sum.primer.txt"),
+            outputs = (readSet + ".sum.primer.duplex.txt",),
+            params  = ("tagNameUmi", "tagNameDuplex"),
+            cores   = 1))
     
-    # soft clip primer regions from read alignments
+    # soft clip primer regions from read alignments, sorting the clipped reads into the final BAM file for downstream variant calling -
+    # the stage core splits and merges the reads, the clip workers and sort threads take spare cores from the pool, so the
+    # single core metrics run alongside primer clipping
     bamFileIn  = readSet + ".umi_merge.bam"
-    bamFileOut = readSet + ".primer_clip.bam"
-    core.primer_clip.run(cfg,bamFileIn,bamFileOut,False)
- 
-    # additional metrics to generate
-    metrics.sum_primer_umis.run(cfg) # primer-level umi and read metrics
-    metrics.sum_specificity.run(cfg) # priming specificity
-    metrics.sum_uniformity_primer.run(cfg) # primer-level uniformity
-
-    if cfg.duplex: # additional metrics for Duplex reads
-        metrics.duplex_summary.run(cfg)
-        metrics.sum_primer_duplex.run(cfg)
-        metrics.fraglen_by_rpu.run(cfg)
-
-    # sort the final BAM file, to prepare for downstream variant calling
-    bamFileIn  = readSet + ".primer_clip.bam"
     bamFileOut = readSet + ".bam"
-    core.samtools.sort(cfg,bamFileIn,bamFileOut)
+    stages.append(Stage("primer_clip", core.primer_clip.run, (cfg,bamFileIn,bamFileOut,False,True),
+        inputs  = (bamFileIn,),
+        outputs = (bamFileOut, bamFileOut + ".bai"),
+        rewrites = (bamFileIn,) if deleteLocalFiles else (),
+        cores   = 1))
     
-    if cfg.platform.lower() != "illumina": # ion reads
-        misc.tvc.run(cfg)
+    if not isIllumina: # ion reads
+        stages.append(Stage("tvc", misc.tvc.run, (cfg,),
+            inputs  = [readSet + ".bam", cfg.uBam] + ionTagFiles + list(roiBedFiles),
+            outputs = (readSet + ".tvc_roi.bed", readSet + ".tvc.primitives.vcf")))
 
-    # run smCounter variant calling
-    numVariants = core.sm_counter_wrapper.run(cfg, paramFile, vc)
-
-    if cfg.platform.lower() != "illumina":
-        numVariants = misc.tvc.smCounterFilter(cfg,vc)
+    # run smCounter variant calling (smCounter-v2 adds its LOD estimates to the umi_depths summary)
+    smCounterInputs = [readSet + ".bam", readSet + ".umi_frags.summary.txt", readSet + ".umi_depths.summary.txt", cfg.genomeFile]
+    if not isIllumina:
+        smCounterInputs.append(readSet + ".tvc_roi.bed")
+    smCounter = Stage("smCounter", runSmCounter, (cfg, paramFile, vc),
+        inputs  = smCounterInputs,
+        outputs = (readSet + ".smCounter.summary.txt",),
+        params  = ("duplex", "tagNameDuplex"),
+        settings = smCounterSettings,
+        rewrites = (readSet + ".umi_depths.summary.txt",))
+    stages.append(smCounter)
 
     # create complex variants, and annotate using snpEff
     if not tumorNormal:
-        post_smcounter_work(numVariants, readSet, cfg, tumorNormal=False)
+        summaryFiles = [readSet + "." + x + ".summary.txt" for x in ("prep", "umi_filter", "umi_frags", "sum.uniformity.primer", "umi_depths", "smCounter")]
+        if cfg.duplex:
+            summaryFiles.append(readSet + ".duplex.summary.txt")
+        stages.append(Stage("annotate", lambda: post_smcounter_work(smCounter.result, readSet, cfg, tumorNormal=False), (),
+            inputs  = [readSet + ".bam"] + summaryFiles,
+            outputs = (readSet + ".smCounter.anno.vcf", readSet + ".sum_all.summary.txt"),
+            params  = ("vcfComplexGapMax", "snpEffPath", "snpEffConfig", "snpEffData", "dbSnpFile", "cosmicFile", "clinVarFile", "outputDetail"),
+            settings = {"vc" : vc},
+            cores   = 1))
+
+    # run stages as their inputs become ready, skipping any completed by a previous run if resuming
+    core.run_graph.run(cfg, stages)
+    core.scratch.clean(cfg)
+
+    if not tumorNormal:
         # close log file
         core.run_log.close()
+
+def runSmCounter(cfg, paramFile, vc):
+    ''' Run smCounter, and filter with TVC variants for Ion reads
+    :returns int number of primitive variants called
+    '''
+    numVariants = core.sm_counter_wrapper.run(cfg, paramFile, vc)
+    if cfg.platform.lower() != "illumina":
+        numVariants = misc.tvc.smCounterFilter(cfg,vc)
+    return numVariants
         
 def post_smcounter_work(numVariants, readSet, cfg, tumorNormal):
     ''' Additional Steps after smCounter
@@ -125,6 +260,15 @@ def post_smcounter_work(numVariants, readSet, cfg, tumorNormal):
     # aggregate all metrics
     metrics.sum_all.run(cfg)
 
+def runArm(readSet,paramFile,vc,results):
+    ''' Run one arm of a tumor-normal analysis, report any error to the parent
+    '''
+    try:
+        run((readSet,paramFile,vc),tumorNormal=True)
+        results.put((readSet,None))
+    except BaseException:
+        results.put((readSet,traceback.format_exc()))
+
 def run_tumor_normal(readSet,paramFile,vc):
     ''' Wrapper for tumor-normal analysis
     '''
@@ -149,14 +293,30 @@ def run_tumor_normal(readSet,paramFile,vc):
      
     assert tumor!=None and normal!=None, "Could not sync read set names supplied with config file !"
     core.run_log.init(tumor)
-    run((tumor,paramFile,vc),tumorNormal=True)
+
+    ## Run the tumor and normal arms in parallel, sharing the cores, both logging to the tumor log
+    cfg = core.run_config.run(tumor,paramFile)
+    core.cpu_tokens.init(cfg.numCores)
+    results = multiprocessing.Queue()
+    arms = []
+    for readSetArm in (tumor,normal):
+        arm = multiprocessing.Process(target = runArm, args = (readSetArm,paramFile,vc,results))
+        arm.start()
+        arms.append(arm)
+    errors = [results.get() for arm in arms]
+    for arm in arms:
+        arm.join()
+    failed = [readSetArm for (readSetArm,error) in errors if error is not None]
+    for (readSetArm,error) in errors:
+        if error is not None:
+            print("run_tumor_normal: read set {} failed\n{}".format(readSetArm,error))
+    if len(failed) > 0:
+        raise Exception("run_tumor_normal: read set(s) failed: " + ", ".join(failed))
     print("--"*20)
-    run((normal,paramFile,vc),tumorNormal=True)
 
     ## Compare Tumor Normal variants and update filter
     if vc == 'v2': # use new TN filter
         print("--"*20)
-        cfg = core.run_config.run(tumor,paramFile)
         core.tumor_normal.tumorNormalVarFilter(cfg)
         print("--"*20)
 
@@ -182,13 +342,94 @@ def run_tumor_normal(readSet,paramFile,vc):
     # close log file
     core.run_log.close()
 
+def getReadSets(paramFile):
+    ''' Get the names of all read set sections in the param file
+    '''
+    parser = ConfigParser.SafeConfigParser()
+    parser.optionxform = str
+    parser.read(paramFile)
+    return [section for section in parser.sections() if section not in ['general','smCounter']]
+
+def batchWorker(queue, results, paramFile, vc):
+    ''' Run single read sets from the queue until a None is pulled
+    '''
+    while True:
+        readSet = queue.get()
+        if readSet is None:
+            break
+        try:
+            run((readSet,paramFile,vc),tumorNormal = False)
+            cfg = core.run_config.run(readSet,paramFile)
+            core.tumor_normal.runCopyNumberEstimates(cfg)
+            error = None
+        except BaseException:
+            error = traceback.format_exc()
+            # close the read set log if the failure left it open, so the next read set gets its own
+            if isinstance(sys.stdout, core.run_log.RedirectToLogger):
+                print(error)
+                core.run_log.close()
+        results.put((readSet,error))
+
+def run_batch(readSets,paramFile,vc):
+    ''' Run many single read sets from one param file in one process tree, on a bounded set of workers
+    :param list readSets: read set names, or empty list for all read sets in the param file
+    :param str paramFile
+    :param str vc: v1 or v2
+    '''
+    if len(readSets) == 0:
+        readSets = getReadSets(paramFile)
+    assert len(readSets) > 0, "No read sets found in param file !"
+
+    # each worker runs one read set at a time - the read sets share the cores through the core token pool
+    parser = ConfigParser.SafeConfigParser()
+    parser.optionxform = str
+    parser.read(paramFile)
+    numCores = parser.getint("general","numCores")
+    if numCores == 0:
+        numCores = multiprocessing.cpu_count()
+    numWorkers = parser.getint("general","batchWorkers") if parser.has_option("general","batchWorkers") else 1
+    numWorkers = max(1,min(numWorkers,len(readSets),numCores))
+    core.cpu_tokens.init(numCores)
+
+    # warm up panel data once in this process, so forked workers share it
+    for readSet in readSets:
+        cfg = core.run_config.run(readSet,paramFile)
+        core.panel.readPrimerFile(cfg.primerFile)
+    print("run_batch: {} read sets, {} workers sharing {} cores".format(len(readSets),numWorkers,numCores))
+
+    # start workers - not daemonic, as pipeline stages run in child processes of the workers
+    queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for readSet in readSets:
+        queue.put(readSet)
+    workers = []
+    for i in range(numWorkers):
+        queue.put(None)
+        worker = multiprocessing.Process(target = batchWorker, args = (queue,results,paramFile,vc))
+        worker.start()
+        workers.append(worker)
+
+    # collect outcomes, then report all failed read sets together
+    failed = []
+    for i in range(len(readSets)):
+        (readSet, error) = results.get()
+        if error is None:
+            print("run_batch: done read set " + readSet)
+        else:
+            print("run_batch: read set {} failed\n{}".format(readSet,error))
+            failed.append(readSet)
+    for worker in workers:
+        worker.join()
+    if len(failed) > 0:
+        raise Exception("run_batch: read set(s) failed: " + ", ".join(failed))
+
 #-------------------------------------------------------------------------------------
 # main program for running from shell 
 #-------------------------------------------------------------------------------------
 if __name__ == "__main__":
 
-    if len(sys.argv) > 6 :
-        print "\nRun as : python run_qiaseq_dna.py <param_file> <v1/v2> <single/tumor-normal> <readSet(s)>\n"
+    if len(sys.argv) > 6 and sys.argv[3].lower() != "batch":
+        print "\nRun as : python run_qiaseq_dna.py <param_file> <v1/v2> <single/tumor-normal/batch> <readSet(s)>\n"
         sys.exit(-1)
   
     paramFile = sys.argv[1]
@@ -198,6 +439,8 @@ if __name__ == "__main__":
  
     if analysis.lower() == "tumor-normal":      
         run_tumor_normal(readSet,paramFile,vc)
+    elif analysis.lower() == "batch": # all read sets in the param file, unless listed
+        run_batch(sys.argv[4:],paramFile,vc)
     else: # Single sample, might still need to run quandico
         run((readSet,paramFile,vc),tumorNormal = False)
         cfg = core.run_config.run(readSet,paramFile)
@@ -0,0 +1,84 @@
+import multiprocessing
+import signal
+
+import core.cpu_tokens as cpu_tokens
+
+
+def make_pool(numCores):
+    """ Start a fresh core token pool, and a cfg with numCores
+
+    numCores : int ; cores in the pool
+    """
+    cpu_tokens.pool = None
+    cpu_tokens.init(numCores)
+    cfg = lambda:0
+    cfg.numCores = numCores
+    return cfg
+
+def get_free():
+    """ Number of free cores in the pool
+    """
+    return cpu_tokens.pool[0].value
+
+def held_in_child(queue):
+    queue.put(cpu_tokens.getHeld())
+
+def test_nested_acquire_does_not_wait():
+    """ A process holding all cores (e.g. bwa, with umi_filter reading its output) must not
+    wait on itself when it asks for cores again
+    """
+    cfg = make_pool(2)
+    ## a hang fails the test instead of stalling the run
+    signal.alarm(10)
+    try:
+        with cpu_tokens.Cores(cfg) as numOuter:
+            assert numOuter == 2
+            assert cpu_tokens.getHeld() == 2
+            with cpu_tokens.Cores(cfg) as numInner:
+                assert numInner == 0
+        assert get_free() == 2
+        assert cpu_tokens.getHeld() == 0
+    finally:
+        signal.alarm(0)
+        cpu_tokens.pool = None
+
+def test_nested_acquire_takes_free_cores():
+    """ A nested acquire still takes the free cores, and gives them back
+    """
+    cfg = make_pool(4)
+    try:
+        with cpu_tokens.Cores(cfg, 1, 1) as numOuter:
+            assert numOuter == 1
+            with cpu_tokens.Cores(cfg) as numInner:
+                assert numInner == 3
+                assert get_free() == 0
+            assert get_free() == 3
+        assert get_free() == 4
+    finally:
+        cpu_tokens.pool = None
+
+def test_held_not_inherited():
+    """ A forked child, e.g. a pipeline stage, does not count the cores held by its parent
+    """
+    cfg = make_pool(2)
+    try:
+        with cpu_tokens.Cores(cfg):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target = held_in_child, args = (queue,))
+            process.start()
+            assert queue.get(timeout = 10) == 0
+            process.join()
+    finally:
+        cpu_tokens.pool = None
+
+def test_acquire_nothing():
+    """ Asking for no cores (e.g. primer_clip spare cores with numCores 1) takes no token
+    """
+    cfg = make_pool(1)
+    try:
+        with cpu_tokens.Cores(cfg, 0, 0) as num:
+            assert num == 0
+            assert get_free() == 1
+        assert get_free() == 1
+    finally:
+        cpu_tokens.pool = None
@@ -0,0 +1,73 @@
+import os
+import random
+import shutil
+import tempfile
+
+import core.read_index as read_index
+
+
+def make_index(tempDir, reads):
+    """ Write a read id index and open it for lookups
+
+    tempDir : str ; directory for the index and its partition files
+    reads : list ; (read id, payload) tuples
+    """
+    fileName = os.path.join(tempDir, "test.index")
+    index = read_index.Writer(fileName, tempDir)
+    for (readId, payload) in reads:
+        index.add(readId, payload)
+    index.close()
+    return read_index.Reader(fileName)
+
+def test_round_trip():
+    """ Every read added comes back with its payload, and unknown reads get the default
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        random.seed(1)
+        reads = [("@M00123:45:000000000-ABCDE:1:1101:{}:{}".format(i, random.randint(1000, 30000)),
+                  "\t".join(("ACGT"[random.randint(0, 3)] * random.randint(0, 12), str(i))))
+                 for i in xrange(20000)]
+        ## a small flush size so the records are spread over several partition file writes
+        flushBytes = read_index.FLUSH_BYTES_TOTAL
+        read_index.FLUSH_BYTES_TOTAL = 1 << 16
+        try:
+            index = make_index(tempDir, reads)
+        finally:
+            read_index.FLUSH_BYTES_TOTAL = flushBytes
+        assert len(index) == len(reads)
+        for (readId, payload) in reads:
+            assert index.get(readId) == payload
+        assert index.get("@not_a_read") is None
+        assert index.get("@not_a_read", "") == ""
+        index.close()
+        ## only the index file is left
+        assert os.listdir(tempDir) == ["test.index"]
+    finally:
+        shutil.rmtree(tempDir)
+
+def test_empty_index():
+    """ An index with no reads finds nothing
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        index = make_index(tempDir, [])
+        assert len(index) == 0
+        assert index.get("@read1") is None
+        index.close()
+    finally:
+        shutil.rmtree(tempDir)
+
+def test_duplicate_read_id():
+    """ A read id added twice is an error
+    """
+    tempDir = tempfile.mkdtemp()
+    try:
+        try:
+            make_index(tempDir, [("@read1", "A"), ("@read2", "C"), ("@read1", "G")])
+        except Exception as ex:
+            assert "duplicate read id" in str(ex)
+        else:
+            assert False, "duplicate read id not detected"
+    finally:
+        shutil.rmtree(tempDir)
@@ -0,0 +1,110 @@
+import random
+
+import core.umi_cluster as umi_cluster
+
+BC_LEN = 12
+
+
+def random_barcode(length, pctN = 0.05):
+    """ Random barcode, with some N bases
+
+    length : int ; barcode length
+    pctN : float ; chance of an N at each base
+    """
+    return "".join("N" if random.random() < pctN else random.choice("ACGT") for i in xrange(length))
+
+def mutate(bc, numChanges):
+    """ Change numChanges random bases of a barcode, to any base including N
+
+    bc : str ; barcode
+    numChanges : int ; number of bases to change
+    """
+    bc = list(bc)
+    for i in xrange(numChanges):
+        bc[random.randint(0, len(bc) - 1)] = random.choice("ACGTN")
+    return "".join(bc)
+
+def test_is_similar_packed():
+    """ The packed barcode check gives the same result and mismatch position as the string check
+    """
+    random.seed(1)
+    for trial in xrange(50000):
+        length = random.choice((BC_LEN - 3, BC_LEN - 1, BC_LEN, BC_LEN))
+        bcA = random_barcode(length)
+        bcB = mutate(bcA, random.choice((0, 1, 1, 2, 3)))
+        expected = umi_cluster.isSimilar(bcA, bcB, BC_LEN)
+        assert umi_cluster.isSimilarPacked(umi_cluster.encode(bcA), umi_cluster.encode(bcB), BC_LEN) == expected, (bcA, bcB)
+
+def test_encode_non_acgtn():
+    """ Barcodes with other characters are not packed, so the string check is used for them
+    """
+    assert umi_cluster.encode("ACGTNACGTNAC") is not None
+    assert umi_cluster.encode("ACGT.ACGTNAC") is None
+    assert umi_cluster.encode("A" * (umi_cluster.MAX_BC_LEN + 1)) is None
+
+def test_bucket_keys():
+    """ Packed prefix and suffix keys are equal exactly when the prefix and suffix strings are
+    """
+    random.seed(2)
+    prefixLen = BC_LEN / 2
+    barcodes = [random_barcode(random.choice((BC_LEN - 3, BC_LEN)), 0.2) for i in xrange(300)]
+    barcodes.extend(mutate(bc, 1) for bc in list(barcodes))
+    keys = [umi_cluster.getBucketKeys(bc, umi_cluster.encode(bc), prefixLen) for bc in barcodes]
+    strings = [umi_cluster.getBucketKeys(bc, None, prefixLen) for bc in barcodes]
+    for i in xrange(len(barcodes)):
+        for j in xrange(len(barcodes)):
+            assert (keys[i][0] == keys[j][0]) == (strings[i][0] == strings[j][0]), (barcodes[i], barcodes[j])
+            assert (keys[i][1] == keys[j][1]) == (strings[i][1] == strings[j][1]), (barcodes[i], barcodes[j])
+
+def edit_distance(a, b):
+    """ Levenshtein distance, for checking the fallback index
+
+    a : str ; barcode
+    b : str ; barcode
+    """
+    last = range(len(b) + 1)
+    for i in xrange(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in xrange(1, len(b) + 1):
+            row[j] = min(last[j] + 1, row[j - 1] + 1, last[j - 1] + (a[i - 1] != b[j - 1]))
+        last = row
+    return last[len(b)]
+
+def edit(bc, numEdits):
+    """ Apply random substitutions, insertions and deletions to a barcode
+
+    bc : str ; barcode
+    numEdits : int ; number of edits
+    """
+    for i in xrange(numEdits):
+        pos = random.randint(0, len(bc) - 1)
+        op = random.choice(("sub", "ins", "del"))
+        if op == "sub":
+            bc = bc[:pos] + random.choice("ACGT") + bc[pos + 1:]
+        elif op == "ins":
+            bc = bc[:pos] + random.choice("ACGT") + bc[pos:]
+        elif len(bc) > 1:
+            bc = bc[:pos] + bc[pos + 1:]
+    return bc
+
+def test_find_candidates():
+    """ The fallback index finds every real barcode within edit distance 2, or matching after a 3 base
+    truncation, in barcode rank order - so the first match is the one a scan of the sorted barcodes finds
+    """
+    random.seed(3)
+    for trial in xrange(3):
+        reals = list(set(random_barcode(BC_LEN, 0) for i in xrange(150)))
+        rank = dict((bc, i) for (i, bc) in enumerate(reals))
+        index = ({}, {})
+        for bc in reals:
+            umi_cluster.addToIndex(index, bc, BC_LEN)
+        queries = [edit(random.choice(reals), random.choice((1, 2, 3))) for i in xrange(100)]
+        queries.extend(random.choice(reals)[3:] for i in xrange(10))
+        queries.extend(random.choice(reals)[:BC_LEN - 3] for i in xrange(10))
+        queries.extend(random_barcode(BC_LEN, 0) for i in xrange(10))
+        for bcA in queries:
+            candidates = umi_cluster.findCandidates(index, bcA, BC_LEN, rank)
+            assert candidates == sorted(candidates, key = rank.get)
+            expected = set(bcB for bcB in reals if edit_distance(bcB, bcA) <= 2 or
+                (len(bcA) == BC_LEN - 3 and (bcA == bcB[3:] or bcA == bcB[0:BC_LEN - 3])))
+            assert expected <= set(candidates), (bcA, expected - set(candidates))
@@ -0,0 +1,118 @@
+import math
+import random
+import StringIO
+
+import numpy as np
+import scipy.special
+
+import metrics.umi_depths as umi_depths
+
+
+def write_island_events(bedIn, fileout):
+    """ Bedgraph of one locus island from a sorted list of fragment start/end events - the original
+    umi_depths code, for comparison
+
+    bedIn : list ; (chrom, locL, locR) fragments
+    fileout : file ; bedgraph output
+    """
+    if len(bedIn) == 0:
+        return
+    vec = []
+    for (chrom, locL, locR) in bedIn:
+        vec.append((chrom, locL,  1))
+        vec.append((chrom, locR, -1))
+    vec.sort()
+    depthVec = []
+    depthNet = 0
+    for (chrom, loc, depth) in vec:
+        depthNet += depth
+        depthVec.append((chrom, loc, depthNet))
+    (chrom_, loc_, depth_) = depthVec[0]
+    for (chrom, loc, depth) in depthVec[1:]:
+        if loc != loc_ or chrom != chrom_:
+            fileout.write("\t".join((str(x) for x in (chrom, loc_, loc, depth_))))
+            fileout.write("\n")
+        chrom_ = chrom
+        loc_   = loc
+        depth_ = depth
+
+def random_fragments(numFrags, span):
+    """ Random fragments of an island - mostly left to right, some empty or right to left
+
+    numFrags : int ; number of fragments
+    span : int ; island size in bp
+    """
+    frags = []
+    start = random.randint(0, 10 ** 7)
+    for i in xrange(numFrags):
+        locL = start + random.randint(0, span)
+        locR = locL + random.choice((0, random.randint(1, 300), random.randint(1, 300), -random.randint(1, 50)))
+        frags.append(("chr1", locL, locR))
+    return frags
+
+def test_island():
+    """ The difference array island writes the same bedgraph rows as the sorted event list
+    """
+    random.seed(1)
+    for trial in xrange(3000):
+        frags = random_fragments(random.randint(0, 40), random.choice((50, 500, 5000, 20000)))
+        expected = StringIO.StringIO()
+        write_island_events(frags, expected)
+        island = umi_depths.Island("chr1")
+        for (chrom, locL, locR) in frags:
+            island.add(locL, locR)
+        got = StringIO.StringIO()
+        island.write(got)
+        assert got.getvalue() == expected.getvalue(), frags
+
+def test_find_root():
+    """ Roots are within the R uniroot() tolerance, and uniroot's end point and no sign change cases
+    """
+    tol = umi_depths.LOD_TOL
+    assert abs(umi_depths.findRoot(lambda x: x * x - 2, 0.0, 2.0) - math.sqrt(2)) <= tol
+    assert abs(umi_depths.findRoot(lambda x: math.cos(x) - x, 0.0, 1.0) - 0.7390851332151607) <= tol
+    assert abs(umi_depths.findRoot(lambda x: x ** 3 - 0.001, -1.0, 1.0) - 0.1) <= tol
+    assert umi_depths.findRoot(lambda x: x - 1.0, 0.0, 1.0) == 1.0
+    assert umi_depths.findRoot(lambda x: x * x + 1, -1.0, 1.0) is None
+
+def test_lod():
+    """ LOD is the allele fraction where P(# of variant UMIs >= barcodesNeeded) = 0.95 - the exact root from the
+    inverse regularized beta function, to the 4 decimals reported
+    """
+    for umiDepth in (5, 6, 10, 50, 200, 1000, 3000, 10000):
+        for barcodesNeeded in (1, 2, 3, 5, 8, 16):
+            if barcodesNeeded > umiDepth:
+                continue
+            ## P(X <= k - 1) = I_(1-p)(n - k + 1, k)
+            expected = 1.0 - scipy.special.betaincinv(umiDepth - barcodesNeeded + 1, barcodesNeeded, 0.05)
+            lod = umi_depths.getLod(umiDepth, barcodesNeeded)
+            assert abs(lod - expected) <= 0.00005 + umi_depths.LOD_TOL, (umiDepth, barcodesNeeded, lod, expected)
+
+def test_lod_low_depth():
+    """ Fewer than 5 UMIs, or fewer UMIs than needed to call, give LOD 1
+    """
+    assert umi_depths.getLod(0, 3) == 1.0
+    assert umi_depths.getLod(4, 1) == 1.0
+    assert umi_depths.getLod(6, 7) == 1.0
+
+def test_quantiles():
+    """ Quantiles match R quantile() type 7 - R interpolates only between different values, so ties are exact
+    """
+    probs = (0.01, 0.05, 0.10, 0.50, 0.90, 0.95, 0.99)
+    ## quantile(c(15, 1, 100, 7, 3), probs)
+    got = umi_depths.getQuantiles(np.array([15, 1, 100, 7, 3], dtype = np.float64), probs)
+    assert np.allclose(got, [1.08, 1.4, 1.8, 7.0, 66.0, 83.0, 96.6], rtol = 1e-12, atol = 0)
+    ## quantile(c(0.1, 0.1, 0.1, 0.3), c(0.01, 0.33, 0.5, 0.99))
+    got = umi_depths.getQuantiles(np.array([0.1, 0.1, 0.1, 0.3]), (0.01, 0.33, 0.5, 0.99))
+    assert got[:3].tolist() == [0.1, 0.1, 0.1]
+    assert abs(got[3] - 0.294) <= 1e-12
+    ## a single value
+    assert umi_depths.getQuantiles(np.array([0.25]), probs).tolist() == [0.25] * len(probs)
+
+def test_format_r():
+    """ Numbers are formatted as R as.character() does
+    """
+    expected = {0 : "0", 1.0 : "1", 0.5 : "0.5", 0.00012 : "0.00012", 0.0001 : "1e-04", 1e-05 : "1e-05",
+                100000 : "1e+05", 123456 : "123456", 0.12346 : "0.12346"}
+    for (x, formatted) in expected.iteritems():
+        assert umi_depths.formatR(x) == formatted, x
@@ -0,0 +1,47 @@
+import random
+
+import metrics.uniformity as uniformity
+
+
+def get_uniformity_per_base(depths):
+    """ Uniformity metrics from one depth per base - the original umi_depths code, for comparison
+
+    depths : list ; depth of each base
+    """
+    depthTotal = sum(depths)
+    if depthTotal == 0:
+        return tuple([0] * 5)
+    depths = sorted(depths)
+    depthMean = 1.00 * depthTotal / len(depths)
+    outvec = [depthMean]
+    for pct in (5.0, 10.0, 20.0, 30.0):
+        for idx in range(len(depths)):
+            if 100.00 * depths[idx] / depthMean >= pct:
+                outvec.append(100.00 - (100.00 * idx) / len(depths))
+                break
+    return tuple(outvec)
+
+def test_uniformity_runs():
+    """ Metrics from depth runs match the per-base expansion of the runs exactly
+    """
+    random.seed(1)
+    for trial in xrange(3000):
+        n = random.randint(0, 60)
+        depths = [random.choice((0, 0, 1, 2, 3, random.randint(0, 50), random.randint(0, 5000))) for i in xrange(n)]
+        lengths = [random.randint(1, 30) for i in xrange(n)]
+        expected = get_uniformity_per_base([d for (d, l) in zip(depths, lengths) for i in xrange(l)])
+        assert uniformity.getUniformityMetrics(depths, lengths) == expected, (depths, lengths)
+
+def test_uniformity_per_primer():
+    """ Without run lengths each depth counts once, as for the primer-level metrics
+    """
+    random.seed(2)
+    for trial in xrange(1000):
+        depths = [random.randint(0, 1000) for i in xrange(random.randint(0, 40))]
+        assert uniformity.getUniformityMetrics(depths) == get_uniformity_per_base(depths), depths
+
+def test_uniformity_zero_depth():
+    """ All zero depth gives all zero metrics
+    """
+    assert uniformity.getUniformityMetrics([0, 0, 0], [5, 1, 2]) == (0, 0, 0, 0, 0)
+    assert uniformity.getUniformityMetrics([]) == (0, 0, 0, 0, 0)